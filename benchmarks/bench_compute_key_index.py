@@ -0,0 +1,82 @@
+"""Compares ComputeKeyIndex lookups with scanning the compute key directories per lookup.
+
+Usage: python benchmarks/bench_compute_key_index.py [--users N] [--lookups N]
+"""
+import argparse
+from datetime import datetime, timedelta
+from hashlib import sha256
+from pathlib import Path
+import random
+import tempfile
+import time
+
+from crypt4gh_recryptor_service.keyindex import ComputeKeyIndex
+from crypt4gh_recryptor_service.util import shard_path
+from crypt4gh_recryptor_service.validators import to_iso
+
+KEY_ID_PREFIX = 'cnk:'
+
+
+def populate(compute_keys_dir: Path, num_users: int) -> list[str]:
+    expired = to_iso(datetime.now() - timedelta(days=7))
+    current = to_iso(datetime.now() + timedelta(days=7))
+    user_key_hashes = []
+    for i in range(num_users):
+        user_key_hash = sha256(str(i).encode()).hexdigest()
+        for exp_date in (expired, current):
+            shard_path(compute_keys_dir,
+                       user_key_hash).joinpath(exp_date,
+                                               f'{KEY_ID_PREFIX}{i:08x}').mkdir(parents=True)
+        user_key_hashes.append(user_key_hash)
+    return user_key_hashes
+
+
+def scan_lookup(compute_keys_dir: Path, user_key_hash: str) -> str:
+    # The per-request directory scan previously done in ComputeKeyFile.__init__
+    for exp_date_dir in shard_path(compute_keys_dir, user_key_hash).iterdir():
+        if datetime.fromisoformat(exp_date_dir.name) > datetime.now():
+            for key_id_dir in exp_date_dir.iterdir():
+                return key_id_dir.name
+    raise KeyError(user_key_hash)
+
+
+def report(name: str, elapsed: float, count: int):
+    print(f'{name:>16}: {elapsed:.3f}s total, {elapsed / count * 1e6:.1f} us/op')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=100_000)
+    parser.add_argument('--lookups', type=int, default=100_000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        compute_keys_dir = Path(tmp_dir)
+        start = time.perf_counter()
+        user_key_hashes = populate(compute_keys_dir, args.users)
+        print(f'Populated {args.users} users in {time.perf_counter() - start:.1f}s')
+
+        sample = random.choices(user_key_hashes, k=args.lookups)
+
+        start = time.perf_counter()
+        for user_key_hash in sample:
+            scan_lookup(compute_keys_dir, user_key_hash)
+        report('directory scan', time.perf_counter() - start, args.lookups)
+
+        index = ComputeKeyIndex(compute_keys_dir)
+        start = time.perf_counter()
+        index.load()
+        report('index load', time.perf_counter() - start, args.users)
+
+        start = time.perf_counter()
+        for user_key_hash in sample:
+            index.lookup(user_key_hash)
+        report('index lookup', time.perf_counter() - start, args.lookups)
+
+        start = time.perf_counter()
+        num_pruned = index.prune_expired()
+        report('prune expired', time.perf_counter() - start, num_pruned)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""Compares the in-process recrypt engine with the `crypt4gh-recryptor` subprocess.
+
+Usage: python benchmarks/bench_recrypt.py [--iterations N]
+"""
+import argparse
+import asyncio
+from pathlib import Path
+import shutil
+import tempfile
+import time
+
+from common import generate_keypair, make_header, PASSPHRASE
+from crypt4gh import sodium
+from crypt4gh_recryptor_service.config import RecryptBackend
+from crypt4gh_recryptor_service.crypt import crypt4gh_recrypt_header
+from crypt4gh_recryptor_service.keyholder import PrivateKeyHolder
+from crypt4gh_recryptor_service.storage import HashedStrFile, HeaderFile
+
+
+async def run_backend(backend: RecryptBackend,
+                      iterations: int,
+                      headers_dir: Path,
+                      in_header: bytes,
+                      compute_key_file: HashedStrFile,
+                      user_private_key: PrivateKeyHolder) -> float:
+    in_header_file = HeaderFile.from_bytes(headers_dir, in_header, write_to_storage=True)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        await crypt4gh_recrypt_header(
+            in_header_file, compute_key_file, user_private_key, backend=backend)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--iterations', type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = Path(tmp_dir)
+        user_private_key_path, user_public_key_path = generate_keypair(work_dir, 'user')
+        _, compute_public_key_path = generate_keypair(work_dir, 'compute')
+
+        user_private_key = PrivateKeyHolder(user_private_key_path, PASSPHRASE)
+        user_public_key = sodium.derive_pk(user_private_key.get())
+        in_header = make_header(user_private_key.get(), user_public_key)
+
+        compute_key_file = HashedStrFile(
+            work_dir, compute_public_key_path.read_text(), write_to_storage=True)
+
+        backends = [RecryptBackend.IN_PROCESS]
+        if shutil.which('crypt4gh-recryptor'):
+            backends.append(RecryptBackend.SUBPROCESS)
+        else:
+            print('`crypt4gh-recryptor` not found on PATH, skipping subprocess backend')
+
+        for backend in backends:
+            elapsed = asyncio.run(
+                run_backend(backend,
+                            args.iterations,
+                            work_dir,
+                            in_header,
+                            compute_key_file,
+                            user_private_key))
+            print(f'{backend.value:>12}: {args.iterations} recrypts in {elapsed:.3f}s '
+                  f'({elapsed / args.iterations * 1000:.2f} ms/recrypt)')
+
+
+if __name__ == '__main__':
+    main()
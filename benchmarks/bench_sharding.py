@@ -0,0 +1,91 @@
+"""Compares hashed file creation and lookup cost in a flat and a sharded directory layout.
+
+Usage: python benchmarks/bench_sharding.py [--counts N [N ...]] [--ops N] [--output PATH]
+"""
+import argparse
+from base64 import b64encode
+from hashlib import sha256
+import json
+from pathlib import Path
+import random
+import tempfile
+import time
+from typing import Any
+
+from common import report, summarize
+from crypt4gh_recryptor_service.storage import HeaderFile
+
+
+def contents(i: int) -> str:
+    return b64encode(sha256(str(i).encode()).digest() * 4).decode('ascii')
+
+
+def populate(dir: Path, count: int, shard: bool) -> list[str]:
+    return [
+        HeaderFile(dir, contents(i), write_to_storage=True, shard=shard).path.name
+        for i in range(count)
+    ]
+
+
+def time_each(func, values) -> list[float]:
+    latencies = []
+    for value in values:
+        start = time.perf_counter()
+        func(value)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def bench_layout(dir: Path, count: int, num_ops: int, shard: bool) -> list[dict[str, Any]]:
+    layout = 'sharded' if shard else 'flat'
+    start = time.perf_counter()
+    filenames = populate(dir, count, shard)
+    populate_secs = time.perf_counter() - start
+
+    def create(i: int):
+        HeaderFile(dir, contents(count + i), write_to_storage=True, shard=shard)
+
+    def lookup(filename: str):
+        HeaderFile(dir, filename=filename, shard=shard).read_from_storage()
+
+    def lookup_missing(i: int):
+        HeaderFile(
+            dir, filename=sha256(str(-i).encode()).hexdigest(), shard=shard).exists_in_storage()
+
+    return [
+        summarize('populate', [populate_secs], layout=layout, files=count),
+        summarize('create', time_each(create, range(num_ops)), layout=layout, files=count),
+        summarize(
+            'lookup',
+            time_each(lookup, random.choices(filenames, k=num_ops)),
+            layout=layout,
+            files=count),
+        summarize(
+            'lookup_missing',
+            time_each(lookup_missing, range(1, num_ops + 1)),
+            layout=layout,
+            files=count),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--counts', type=int, nargs='+', default=[1_000, 10_000, 100_000])
+    parser.add_argument('--ops', type=int, default=2_000)
+    parser.add_argument('--output', type=Path)
+    args = parser.parse_args()
+
+    results = []
+    for count in args.counts:
+        for shard in (False, True):
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                for result in bench_layout(Path(tmp_dir), count, args.ops, shard):
+                    report(result)
+                    results.append(result)
+
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""Measures the startup cost of the server modes, and the cost of the settings on the request path.
+
+Each launch runs in a fresh interpreter, in a working directory set up by a previous launch.
+
+Usage: python benchmarks/bench_startup.py [--launches N] [--iterations N] [--output PATH]
+"""
+import argparse
+from datetime import datetime, timezone
+import json
+import os
+from pathlib import Path
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any
+
+from common import report, summarize
+from crypt4gh_recryptor_service.config import get_settings, ServerMode, setup_files
+
+# Run in the child interpreter, timing the stages of a launch up to the app being importable
+LAUNCH_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+from crypt4gh_recryptor_service.config import get_settings, ServerMode, setup_files
+imported = time.perf_counter()
+server_mode = ServerMode(sys.argv[1])
+setup_files(server_mode)
+get_settings(server_mode)
+set_up = time.perf_counter()
+__import__(f'crypt4gh_recryptor_service.{server_mode.value}')
+app_imported = time.perf_counter()
+print(json.dumps({
+    'config_import': imported - start,
+    'setup_files': set_up - imported,
+    'app_import': app_imported - set_up,
+}))
+"""
+
+
+def bench_launches(server_mode: ServerMode, launches: int) -> list[dict[str, Any]]:
+    stages: dict[str, list[float]] = {}
+    total = []
+    for _ in range(launches):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', LAUNCH_SCRIPT, server_mode.value],
+                                check=True,
+                                capture_output=True,
+                                text=True).stdout
+        total.append(time.perf_counter() - start)
+        for stage, elapsed in json.loads(output).items():
+            stages.setdefault(stage, []).append(elapsed)
+
+    results = [
+        summarize(f'launch.{stage}', latencies, mode=server_mode.value) for stage,
+        latencies in stages.items()
+    ]
+    results.append(summarize('launch.total', total, mode=server_mode.value))
+    return results
+
+
+def bench_settings_access(server_mode: ServerMode, iterations: int) -> list[dict[str, Any]]:
+    setup_files(server_mode)
+    settings = get_settings(server_mode)
+    results = []
+    for name in ('working_dir', 'user_keys_dir', 'headers_dir'):
+        latencies = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            getattr(settings, name)
+            latencies.append(time.perf_counter() - start)
+        results.append(summarize(f'settings.{name}', latencies, mode=server_mode.value))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--launches', type=int, default=10)
+    parser.add_argument('--iterations', type=int, default=10_000)
+    parser.add_argument('--output', type=Path, default=Path('benchmark_startup_results.json'))
+    args = parser.parse_args()
+    output_path = args.output.absolute()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+        for server_mode in ServerMode:
+            results += bench_launches(server_mode, args.launches)
+            results += bench_settings_access(server_mode, args.iterations)
+
+    for result in results:
+        report(result)
+
+    output = {
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'args': {
+            key: value for key, value in vars(args).items() if key != 'output'
+        },
+        'results': results,
+    }
+    output_path.write_text(json.dumps(output, indent=2) + '\n')
+    print(f'Results written to {output_path}')
+
+
+if __name__ == '__main__':
+    main()
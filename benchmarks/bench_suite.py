@@ -0,0 +1,414 @@
+"""Benchmark and load-test suite for the user and compute server modes.
+
+The compute and user apps run in-process, in a temporary working directory. The compute app
+acts as the local compute node of the user app. The suite measures throughput and p50/p99
+latency of `/get_compute_key_info`, `/recrypt_header` and `/recrypt_header_binary` at each of the
+given concurrency levels, followed by microbenchmarks of the building blocks: hashed file storage
+(including the event loop lag while writing), the compute key stores and the recrypt backends.
+Results are written as JSON, to track regressions between runs.
+
+Usage: python benchmarks/bench_suite.py [--concurrency N [N ...]] [--requests N] [--headers N]
+                                        [--user-keys N] [--iterations N] [--output PATH]
+"""
+import argparse
+import asyncio
+import base64
+from datetime import datetime, timezone
+from hashlib import sha256
+import json
+import os
+from pathlib import Path
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from typing import Any, Awaitable, Callable
+
+from common import make_header, make_public_key, report, running_app, summarize
+from crypt4gh import sodium
+from crypt4gh_recryptor_service.config import (get_compute_settings,
+                                               get_user_settings,
+                                               RecryptBackend,
+                                               ServerMode,
+                                               setup_files,
+                                               VERSION)
+from crypt4gh_recryptor_service.crypt import (crypt4gh_recrypt_header,
+                                              generate_keypair,
+                                              write_keypair)
+from crypt4gh_recryptor_service.exchange import ComputeNodeRouter
+from crypt4gh_recryptor_service.executor import CryptoExecutor
+from crypt4gh_recryptor_service.keyholder import (init_worker_private_key,
+                                                  load_private_key,
+                                                  PrivateKeyHolder)
+from crypt4gh_recryptor_service.keyindex import ComputeKeyIndex
+from crypt4gh_recryptor_service.keystore import FileSystemComputeKeyStore, SqliteComputeKeyStore
+from crypt4gh_recryptor_service.storage import (DISK_STORAGE,
+                                                HashedStrFile,
+                                                HeaderFile,
+                                                MemoryStorage)
+from crypt4gh_recryptor_service.streaming import BINARY_MEDIA_TYPE
+import httpx
+from starlette.types import ASGIApp
+
+LOAD_TEST_TIMEOUT_SECS = 300
+STORAGE_IO_TICK_SECS = 0.001
+
+
+async def load_test(asgi: ASGIApp,
+                    path: str,
+                    payloads: list[dict[str, Any] | bytes],
+                    concurrency: int) -> tuple[list[float], float, int]:
+    # Sends the payloads in order, keeping `concurrency` requests in flight. Bytes payloads are
+    # sent as raw request bodies, other payloads as JSON.
+    latencies: list[float] = []
+    errors = 0
+    next_payload = iter(payloads)
+    transport = httpx.ASGITransport(app=asgi)
+    async with httpx.AsyncClient(
+            transport=transport, base_url='http://bench', timeout=LOAD_TEST_TIMEOUT_SECS) as client:
+
+        async def worker():
+            nonlocal errors
+            for payload in next_payload:
+                start = time.perf_counter()
+                if isinstance(payload, bytes):
+                    response = await client.post(
+                        path, content=payload, headers={'Content-Type': BINARY_MEDIA_TYPE})
+                else:
+                    response = await client.post(path, json=payload)
+                latencies.append(time.perf_counter() - start)
+                if response.status_code != 200:
+                    errors += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return latencies, time.perf_counter() - start, errors
+
+
+def time_each(func: Callable[[], Any], iterations: int) -> list[float]:
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+async def time_each_async(func: Callable[[], Awaitable[Any]], iterations: int) -> list[float]:
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        await func()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+async def bench_endpoints(args: argparse.Namespace) -> list[dict[str, Any]]:
+    # Importing the apps only now, as the settings depend on the working directory
+    from crypt4gh_recryptor_service.compute import app as compute_app
+    from crypt4gh_recryptor_service.user import app as user_app
+
+    results = []
+    user_settings = get_user_settings()
+    user_public_keys = [make_public_key() for _ in range(args.user_keys)]
+
+    async with running_app(compute_app) as (compute_asgi, _):
+        for concurrency in args.concurrency:
+            # Cold: a compute keypair is created for every user key. The user keys are new for
+            # every concurrency level, to keep the runs comparable.
+            cold_keys = [make_public_key() for _ in range(args.user_keys)]
+            latencies, elapsed, errors = await load_test(
+                compute_asgi,
+                '/get_compute_key_info', [{'crypt4gh_user_public_key': key} for key in cold_keys],
+                concurrency)
+            results.append(
+                summarize(
+                    'get_compute_key_info[cold]',
+                    latencies,
+                    elapsed,
+                    errors,
+                    concurrency=concurrency,
+                    user_keys=args.user_keys))
+
+        for key in user_public_keys:
+            await load_test(compute_asgi,
+                            '/get_compute_key_info', [{
+                                'crypt4gh_user_public_key': key
+                            }],
+                            1)
+        for concurrency in args.concurrency:
+            payloads = [{
+                'crypt4gh_user_public_key': random.choice(user_public_keys)
+            } for _ in range(args.requests)]
+            latencies, elapsed, errors = await load_test(compute_asgi,
+                                                         '/get_compute_key_info',
+                                                         payloads,
+                                                         concurrency)
+            results.append(
+                summarize(
+                    'get_compute_key_info[warm]',
+                    latencies,
+                    elapsed,
+                    errors,
+                    concurrency=concurrency,
+                    user_keys=args.user_keys))
+
+        async with running_app(user_app) as (user_asgi, user_state):
+            # Route the requests to the compute node to the in-process compute app
+            compute_router = ComputeNodeRouter(
+                user_settings, transport=httpx.ASGITransport(app=compute_asgi))
+            async with compute_router:
+                user_state['compute_router'] = compute_router
+
+                user_private_key = load_private_key(user_settings.user_private_key_path,
+                                                    user_settings.private_key_passphrase)
+                user_public_key = sodium.derive_pk(user_private_key)
+                headers = [
+                    make_header(user_private_key, user_public_key) for _ in range(args.headers)
+                ]
+                for concurrency in args.concurrency:
+                    json_payloads = [{
+                        'crypt4gh_header': base64.b64encode(headers[i % len(headers)]).decode()
+                    } for i in range(args.requests)]
+                    binary_payloads = [headers[i % len(headers)] for i in range(args.requests)]
+                    for name, path, payloads in (
+                        ('recrypt_header', '/recrypt_header', json_payloads),
+                        ('recrypt_header[binary]', '/recrypt_header_binary', binary_payloads),
+                    ):
+                        latencies, elapsed, errors = await load_test(user_asgi,
+                                                                     path,
+                                                                     payloads,
+                                                                     concurrency)
+                        results.append(
+                            summarize(
+                                name,
+                                latencies,
+                                elapsed,
+                                errors,
+                                concurrency=concurrency,
+                                headers=args.headers,
+                                backend=RecryptBackend(user_settings.recrypt_backend).value))
+    return results
+
+
+def bench_hashed_files(args: argparse.Namespace, work_dir: Path) -> list[dict[str, Any]]:
+    results = []
+    headers_dir = work_dir.joinpath('bench_headers')
+    headers_dir.mkdir()
+    for storage in (DISK_STORAGE, MemoryStorage(args.iterations)):
+        storage_name = type(storage).__name__
+        contents = [base64.b64encode(os.urandom(124)).decode() for _ in range(args.iterations)]
+        header_files = []
+
+        def write():
+            header_files.append(
+                HeaderFile(headers_dir, contents.pop(), write_to_storage=True, storage=storage))
+
+        results.append(
+            summarize('hashed_file.write', time_each(write, args.iterations), storage=storage_name))
+
+        to_read = iter(header_files)
+
+        def read():
+            header_file = next(to_read)
+            HeaderFile(
+                headers_dir, filename=header_file.path.name, storage=storage).read_from_storage()
+
+        results.append(
+            summarize('hashed_file.read', time_each(read, args.iterations), storage=storage_name))
+    return results
+
+
+async def bench_storage_io(args: argparse.Namespace, work_dir: Path) -> list[dict[str, Any]]:
+    # Event loop lag while concurrent coroutines write hashed files to disk, either directly on
+    # the event loop or on the storage I/O threads
+    results = []
+    headers_dir = work_dir.joinpath('bench_storage_io')
+    headers_dir.mkdir()
+    for mode in ('blocking', 'async'):
+        header_files = [
+            HeaderFile(headers_dir, base64.b64encode(os.urandom(124)).decode())
+            for _ in range(args.iterations)
+        ]
+        latencies: list[float] = []
+        lags: list[float] = []
+        writing = True
+
+        async def tick():
+            while writing:
+                start = time.perf_counter()
+                await asyncio.sleep(STORAGE_IO_TICK_SECS)
+                lags.append(time.perf_counter() - start - STORAGE_IO_TICK_SECS)
+
+        async def write(header_file: HeaderFile):
+            start = time.perf_counter()
+            if mode == 'async':
+                await header_file.async_write_to_storage()
+            else:
+                header_file.write_to_storage()
+            latencies.append(time.perf_counter() - start)
+
+        ticker = asyncio.create_task(tick())
+        await asyncio.sleep(0)
+        start = time.perf_counter()
+        await asyncio.gather(*(write(header_file) for header_file in header_files))
+        elapsed = time.perf_counter() - start
+        writing = False
+        await ticker
+        results.append(summarize('storage_write', latencies, elapsed, mode=mode))
+        results.append(summarize('event_loop_lag[storage_write]', lags, mode=mode))
+    return results
+
+
+def bench_compute_key_stores(args: argparse.Namespace, work_dir: Path) -> list[dict[str, Any]]:
+    # Run after the endpoint benchmarks, which populated the compute key directories
+    settings = get_compute_settings()
+    index = ComputeKeyIndex(settings.compute_keys_dir)
+    start = time.perf_counter()
+    num_keys = index.load()
+    results = [summarize('compute_key_index.load', [time.perf_counter() - start], keys=num_keys)]
+
+    keypair = generate_keypair(settings.private_key_passphrase, settings.private_key_comment)
+    stores = {
+        'filesystem':
+            FileSystemComputeKeyStore(
+                work_dir.joinpath('bench_compute_keys'),
+                settings.locks_dir,
+                settings.compute_key_id_prefix,
+                settings.compute_key_expiration_delta_secs),
+        'sqlite':
+            SqliteComputeKeyStore(
+                work_dir.joinpath('bench_compute_keys.sqlite3'),
+                settings.compute_key_id_prefix,
+                settings.compute_key_expiration_delta_secs),
+    }
+    for backend, store in stores.items():
+        store.load()
+        user_key_hashes = [
+            sha256(f'{backend}{i}'.encode()).hexdigest() for i in range(args.iterations)
+        ]
+        to_create = iter(user_key_hashes)
+
+        def create():
+            store.create(next(to_create), store.new_entry(), keypair)
+
+        def lookup():
+            user_key_hash = random.choice(user_key_hashes)
+            store.discard(user_key_hash)
+            assert store.lookup(user_key_hash) is not None
+
+        def lookup_cached():
+            assert store.lookup(random.choice(user_key_hashes)) is not None
+
+        results.append(
+            summarize(
+                'compute_key_store.create', time_each(create, args.iterations), backend=backend))
+        results.append(
+            summarize(
+                'compute_key_store.lookup', time_each(lookup, args.iterations), backend=backend))
+        results.append(
+            summarize(
+                'compute_key_store.lookup[cached]',
+                time_each(lookup_cached, args.iterations),
+                backend=backend))
+        store.close()
+    return results
+
+
+async def bench_recrypt_backends(args: argparse.Namespace, work_dir: Path) -> list[dict[str, Any]]:
+    settings = get_user_settings()
+    user_private_key = PrivateKeyHolder(settings.user_private_key_path,
+                                        settings.private_key_passphrase)
+    in_header = make_header(user_private_key.get(), sodium.derive_pk(user_private_key.get()))
+    in_header_file = HeaderFile.from_bytes(work_dir, in_header, write_to_storage=True)
+    compute_key_file = HashedStrFile(work_dir, make_public_key(), write_to_storage=True)
+
+    backends = [RecryptBackend.IN_PROCESS]
+    if shutil.which('crypt4gh-recryptor'):
+        backends.append(RecryptBackend.SUBPROCESS)
+    else:
+        print('`crypt4gh-recryptor` not found on PATH, skipping subprocess backend')
+
+    results = []
+    for backend in backends:
+        latencies = await time_each_async(
+            lambda: crypt4gh_recrypt_header(
+                in_header_file, compute_key_file, user_private_key, backend=backend),
+            args.iterations)
+        results.append(summarize('recrypt_backend', latencies, backend=backend.value))
+
+    executor = CryptoExecutor(
+        settings.crypto_executor_workers,
+        settings.crypto_executor_max_queue,
+        initializer=init_worker_private_key,
+        initargs=(settings.user_private_key_path, settings.private_key_passphrase))
+    await executor.start()
+    try:
+        latencies = await time_each_async(
+            lambda: crypt4gh_recrypt_header(
+                in_header_file, compute_key_file, user_private_key, executor=executor),
+            args.iterations)
+        results.append(
+            summarize(
+                'recrypt_backend',
+                latencies,
+                backend=f'{RecryptBackend.IN_PROCESS.value}+executor',
+                workers=executor.max_workers))
+    finally:
+        await executor.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--requests', type=int, default=1000, help='requests per load test')
+    parser.add_argument('--headers', type=int, default=100, help='distinct crypt4gh headers')
+    parser.add_argument('--user-keys', type=int, default=100, help='distinct user public keys')
+    parser.add_argument('--iterations', type=int, default=1000, help='microbenchmark iterations')
+    parser.add_argument('--output', type=Path, default=Path('benchmark_results.json'))
+    args = parser.parse_args()
+    output_path = args.output.absolute()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = Path(tmp_dir)
+        # The working directories of both server modes are relative to the current directory
+        os.chdir(work_dir)
+        for server_mode in ServerMode:
+            setup_files(server_mode)
+        user_settings = get_user_settings()
+        write_keypair(
+            generate_keypair(user_settings.private_key_passphrase,
+                             user_settings.private_key_comment),
+            user_settings.user_private_key_path,
+            user_settings.user_public_key_path)
+
+        results = asyncio.run(bench_endpoints(args))
+        results += bench_hashed_files(args, work_dir)
+        results += asyncio.run(bench_storage_io(args, work_dir))
+        results += bench_compute_key_stores(args, work_dir)
+        results += asyncio.run(bench_recrypt_backends(args, work_dir))
+
+    for result in results:
+        report(result)
+
+    output = {
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'version': VERSION,
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'args': {
+            key: value for key, value in vars(args).items() if key != 'output'
+        },
+        'results': results,
+    }
+    output_path.write_text(json.dumps(output, indent=2) + '\n')
+    print(f'Results written to {output_path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""Helpers shared by the benchmark scripts."""
+from base64 import b64encode
+import os
+from pathlib import Path
+import statistics
+import sys
+from typing import Any, Optional
+
+from crypt4gh import header, sodium
+from crypt4gh.keys import c4gh
+from crypt4gh_recryptor_service.crypt import X25519_CHACHA20_POLY1305
+
+# The app runner is shared with the tests, which live next to the benchmarks
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from tests.conftest import running_app  # noqa: E402,F401 isort:skip
+
+PASSPHRASE = 'benchmark'
+
+
+def generate_keypair(dir: Path, name: str) -> tuple[Path, Path]:
+    private_key_path = dir.joinpath(f'{name}.priv')
+    public_key_path = dir.joinpath(f'{name}.pub')
+    c4gh.generate(private_key_path, public_key_path, PASSPHRASE.encode(), b'benchmark')
+    return private_key_path, public_key_path
+
+
+def make_header(user_private_key: bytes, user_public_key: bytes) -> bytes:
+    packet = header.make_packet_data_enc(X25519_CHACHA20_POLY1305, os.urandom(32))
+    keys = [(X25519_CHACHA20_POLY1305, user_private_key, user_public_key)]
+    return header.serialize(header.encrypt(packet, keys))
+
+
+def make_public_key() -> str:
+    # A crypt4gh public key of a throwaway user, without the cost of encoding the private key
+    public_key = b64encode(sodium.derive_pk(os.urandom(32))).decode()
+    return f'-----BEGIN CRYPT4GH PUBLIC KEY-----\n{public_key}\n-----END CRYPT4GH PUBLIC KEY-----\n'
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    # Nearest-rank percentile
+    if not sorted_values:
+        return 0.0
+    rank = max(int(round(q / 100 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def summarize(name: str,
+              latencies: list[float],
+              elapsed: Optional[float] = None,
+              errors: int = 0,
+              **params: Any) -> dict[str, Any]:
+    latencies = sorted(latencies)
+    elapsed = sum(latencies) if elapsed is None else elapsed
+    return {
+        'name': name,
+        'params': params,
+        'ops': len(latencies),
+        'errors': errors,
+        'elapsed_secs': elapsed,
+        'throughput_ops_per_sec': len(latencies) / elapsed if elapsed else 0.0,
+        'mean_ms': statistics.fmean(latencies) * 1000 if latencies else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+    }
+
+
+def report(result: dict[str, Any]):
+    params = ' '.join(f'{key}={value}' for key, value in result['params'].items())
+    print(f'{result["name"]:>32} {params:<40} {result["throughput_ops_per_sec"]:>10.1f} ops/s  '
+          f'p50 {result["p50_ms"]:>8.3f} ms  p99 {result["p99_ms"]:>8.3f} ms  '
+          f'errors {result["errors"]}')
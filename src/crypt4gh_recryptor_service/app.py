@@ -1,34 +1,39 @@
-from contextlib import asynccontextmanager
-import ssl
+from contextlib import asynccontextmanager, AsyncExitStack
+from typing import Any, AsyncContextManager, Callable
 
 from crypt4gh_recryptor_service.config import Settings, VERSION
+from crypt4gh_recryptor_service.metrics import MetricsMiddleware
 from fastapi import FastAPI
-import httpx
 from starlette.middleware.cors import CORSMiddleware
-import truststore
 
-
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    # Use the truststore of the local OS
-    ctx = truststore.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-
-    # Initialise the Client on startup and add it to the state
-    async with httpx.AsyncClient(verify=ctx) as client:
-        yield {'client': client}
-        # The Client closes on shutdown
-
-
-app = FastAPI(lifespan=lifespan)
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=['*'],
-    allow_credentials=True,
-    allow_methods=['POST', 'GET'],
-    allow_headers=['*'],
-    max_age=3600,
-)
+LifespanHook = Callable[[], AsyncContextManager[dict[str, Any]]]
+
+
+def create_app(*lifespan_hooks: LifespanHook) -> FastAPI:
+    # Each server mode gets its own app, adding its own state to the lifespan through the hooks.
+    # Keeping the apps apart allows running both modes in the same process (e.g. benchmarks).
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        async with AsyncExitStack() as stack:
+            state: dict[str, Any] = {}
+            for hook in lifespan_hooks:
+                state.update(await stack.enter_async_context(hook()))
+
+            yield state
+            # The hook contexts close on shutdown
+
+    app = FastAPI(lifespan=lifespan)
+
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=['*'],
+        allow_credentials=True,
+        allow_methods=['POST', 'GET'],
+        allow_headers=['*'],
+        max_age=3600,
+    )
+    app.add_middleware(MetricsMiddleware)
+    return app
 
 
 def common_info(settings: Settings) -> dict:
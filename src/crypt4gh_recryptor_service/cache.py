@@ -0,0 +1,162 @@
+import asyncio
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Generic, Hashable, TypeVar
+
+from crypt4gh_recryptor_service.metrics import CACHE_LOOKUPS
+from crypt4gh_recryptor_service.models import ComputeKeyInfo, ComputeKeyInfoResponse
+from crypt4gh_recryptor_service.storage import HeaderFile
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+
+class SingleFlight(Generic[K, V]):
+    # Collapses concurrent calls for the same key into a single task
+    def __init__(self):
+        self._in_flight: dict[K, asyncio.Task[V]] = {}
+
+    def in_flight(self, key: K) -> bool:
+        return key in self._in_flight
+
+    def run(self, key: K, func: Callable[[], Awaitable[V]]) -> asyncio.Task[V]:
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        return task
+
+    async def do(self, key: K, func: Callable[[], Awaitable[V]]) -> V:
+        # Shielded, so that one cancelled caller does not cancel the call for all the others
+        return await asyncio.shield(self.run(key, func))
+
+    def _forget(self, key: K, task: asyncio.Task[V]):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        if not task.cancelled():
+            # Mark exceptions of background calls as retrieved
+            task.exception()
+
+    async def cancel_all(self):
+        tasks = list(self._in_flight.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+@dataclass(frozen=True)
+class _ComputeKeyInfoEntry:
+    key_info: ComputeKeyInfoResponse
+    stale_at: datetime
+    refresh_at: datetime
+
+
+class ComputeKeyInfoCache:
+    def __init__(self, safety_margin_secs: int, refresh_ahead_secs: int):
+        self._safety_margin = timedelta(seconds=safety_margin_secs)
+        self._refresh_ahead = timedelta(seconds=refresh_ahead_secs)
+        self._entries: dict[Hashable, _ComputeKeyInfoEntry] = {}
+        self._fetches: SingleFlight[Hashable, ComputeKeyInfoResponse] = SingleFlight()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def get(self, key: Hashable,
+                  fetch: Callable[[], Awaitable[ComputeKeyInfoResponse]]) -> ComputeKeyInfoResponse:
+        now = datetime.now()
+        entry = self._entries.get(key)
+
+        if entry is not None and now < entry.stale_at:
+            CACHE_LOOKUPS.inc(cache='compute_key_info', result='hit')
+            if now >= entry.refresh_at and not self._fetches.in_flight(key):
+                self._fetches.run(key, lambda: self._fetch_and_store(key, fetch))
+            return entry.key_info
+
+        CACHE_LOOKUPS.inc(cache='compute_key_info', result='miss')
+        return await self._fetches.do(key, lambda: self._fetch_and_store(key, fetch))
+
+    async def _fetch_and_store(
+            self, key: Hashable,
+            fetch: Callable[[], Awaitable[ComputeKeyInfoResponse]]) -> ComputeKeyInfoResponse:
+        key_info = await fetch()
+
+        now = datetime.now()
+        expiration_date = datetime.fromisoformat(key_info.crypt4gh_compute_keypair_expiration_date)
+        stale_at = expiration_date - self._safety_margin
+
+        if now < stale_at:
+            # Refreshes ahead of expiry, but at most halfway through the remaining lifetime, so
+            # that repeated refreshes of an unchanged keypair stay infrequent
+            refresh_at = max(stale_at - self._refresh_ahead, now + (stale_at - now) / 2)
+            self._entries[key] = _ComputeKeyInfoEntry(key_info, stale_at, refresh_at)
+        else:
+            self._entries.pop(key, None)
+
+        return key_info
+
+    async def close(self):
+        await self._fetches.cancel_all()
+        self._entries.clear()
+
+
+@dataclass(frozen=True)
+class _RecryptResultEntry:
+    out_header_file: HeaderFile
+    expires_at: datetime
+
+
+class RecryptResultCache:
+    # Recrypted headers by (input header hash, compute public key hash), held in memory only.
+    # Keypair ids are only unique per compute node, while the public key identifies the recipient
+    # across nodes. An entry lives until its TTL passes or the compute keypair expires, whichever
+    # comes first.
+    def __init__(self, max_entries: int, ttl_secs: int):
+        self._max_entries = max_entries
+        self._ttl = timedelta(seconds=ttl_secs)
+        self._entries: OrderedDict[tuple[str, str], _RecryptResultEntry] = OrderedDict()
+        self._recrypts: SingleFlight[tuple[str, str], HeaderFile] = SingleFlight()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def get(self,
+                  in_header_hash: str,
+                  compute_public_key_hash: str,
+                  key_info: ComputeKeyInfo,
+                  recrypt: Callable[[], Awaitable[HeaderFile]]) -> HeaderFile:
+        key = (in_header_hash, compute_public_key_hash)
+        entry = self._entries.get(key)
+
+        if entry is not None:
+            if datetime.now() < entry.expires_at:
+                CACHE_LOOKUPS.inc(cache='recrypt_result', result='hit')
+                self._entries.move_to_end(key)
+                return entry.out_header_file
+            del self._entries[key]
+
+        # Concurrent identical requests share a single recrypt
+        result = 'coalesced' if self._recrypts.in_flight(key) else 'miss'
+        CACHE_LOOKUPS.inc(cache='recrypt_result', result=result)
+        return await self._recrypts.do(key, lambda: self._recrypt_and_store(key, key_info, recrypt))
+
+    async def _recrypt_and_store(self,
+                                 key: tuple[str, str],
+                                 key_info: ComputeKeyInfo,
+                                 recrypt: Callable[[], Awaitable[HeaderFile]]) -> HeaderFile:
+        out_header_file = await recrypt()
+
+        expires_at = min(datetime.now() + self._ttl,
+                         datetime.fromisoformat(key_info.crypt4gh_compute_keypair_expiration_date))
+        if self._max_entries > 0:
+            self._entries[key] = _RecryptResultEntry(out_header_file, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+        return out_header_file
+
+    async def close(self):
+        await self._recrypts.cancel_all()
+        self._entries.clear()
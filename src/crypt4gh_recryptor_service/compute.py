@@ -1,12 +1,105 @@
 import asyncio
-from typing import Annotated
+from contextlib import asynccontextmanager, AsyncExitStack
+from functools import partial
+import secrets
+import sqlite3
+from typing import Annotated, Optional
 
-from crypt4gh_recryptor_service.app import app, common_info
+from crypt4gh_recryptor_service.app import common_info, create_app
+from crypt4gh_recryptor_service.cache import SingleFlight
 from crypt4gh_recryptor_service.config import ComputeSettings, get_compute_settings
-from crypt4gh_recryptor_service.crypt import crypt4gh_generate_keypair
-from crypt4gh_recryptor_service.models import ComputeKeyInfoParams, ComputeKeyInfoResponse
-from crypt4gh_recryptor_service.storage import ComputeKeyFile, HashedStrFile
-from fastapi import Depends
+from crypt4gh_recryptor_service.executor import CryptoExecutor
+from crypt4gh_recryptor_service.keypool import KeypairPool
+from crypt4gh_recryptor_service.keystore import (ComputeKeyStore,
+                                                 create_compute_key_store,
+                                                 StoredComputeKey)
+from crypt4gh_recryptor_service.metrics import (flush_metrics_periodically,
+                                                PROMETHEUS_CONTENT_TYPE,
+                                                render_metrics)
+from crypt4gh_recryptor_service.models import (ComputeKeyInfoParams,
+                                               ComputeKeyInfoResponse,
+                                               ComputeKeyProvisionParams,
+                                               ComputeKeyProvisionResponse)
+from crypt4gh_recryptor_service.provisioning import (provision_user_public_keys,
+                                                     rotate_compute_keys_periodically)
+from crypt4gh_recryptor_service.retention import (collect_garbage_periodically,
+                                                  enforce_retention,
+                                                  RetentionPolicy)
+from crypt4gh_recryptor_service.storage import HashedStrFile
+from crypt4gh_recryptor_service.util import run_storage_io, set_storage_io_threads
+from fastapi import Depends, Header, HTTPException, Request, Response
+from fastapi.responses import PlainTextResponse
+
+
+async def _sweep_expired_compute_keys(compute_key_store: ComputeKeyStore,
+                                      settings: ComputeSettings):
+    while True:
+        await asyncio.sleep(settings.compute_key_sweep_interval_secs)
+        try:
+            await asyncio.to_thread(compute_key_store.prune_expired,
+                                    settings.compute_key_retention_after_expiry_secs)
+        except (OSError, sqlite3.Error):
+            pass  # Try again at the next sweep
+
+
+@asynccontextmanager
+async def compute_lifespan():
+    settings = get_compute_settings()
+    set_storage_io_threads(settings.storage_io_threads)
+
+    compute_key_store = create_compute_key_store(settings)
+    await asyncio.to_thread(compute_key_store.load)
+    sweeper = asyncio.create_task(_sweep_expired_compute_keys(compute_key_store, settings))
+
+    crypto_executor = CryptoExecutor(settings.effective_crypto_executor_workers,
+                                     settings.crypto_executor_max_queue)
+    await crypto_executor.start()
+    keypair_pool = KeypairPool(settings.compute_keypair_pool_size,
+                               settings.private_key_passphrase,
+                               settings.private_key_comment,
+                               crypto_executor)
+    keypair_pool.start()
+    try:
+        async with AsyncExitStack() as stack:
+            if settings.compute_key_rotation_interval_secs > 0:
+                await stack.enter_async_context(
+                    rotate_compute_keys_periodically(compute_key_store,
+                                                     settings.compute_key_rotation_interval_secs,
+                                                     settings.compute_key_rotation_ahead_secs,
+                                                     settings.compute_key_expiration_delta_secs,
+                                                     settings.private_key_passphrase,
+                                                     settings.private_key_comment,
+                                                     crypto_executor))
+            yield {
+                'keypair_pool': keypair_pool,
+                'compute_key_store': compute_key_store,
+                'keypair_creation': SingleFlight(),
+                'crypto_executor': crypto_executor,
+            }
+    finally:
+        sweeper.cancel()
+        await keypair_pool.stop()
+        await crypto_executor.stop()
+        compute_key_store.close()
+
+
+def compute_metrics_lifespan():
+    settings = get_compute_settings()
+    return flush_metrics_periodically(settings.metrics_dir, settings.metrics_flush_interval_secs)
+
+
+def compute_retention_lifespan():
+    # The compute keypair directories are pruned after expiry by the compute lifespan
+    settings = get_compute_settings()
+    user_keys_policy = RetentionPolicy(settings.user_keys_retention_max_age_secs,
+                                       settings.user_keys_retention_max_count,
+                                       settings.user_keys_retention_max_bytes)
+    return collect_garbage_periodically(
+        settings.retention_sweep_interval_secs,
+        [partial(enforce_retention, settings.user_keys_dir, user_keys_policy)])
+
+
+app = create_app(compute_lifespan, compute_metrics_lifespan, compute_retention_lifespan)
 
 
 @app.get('/info')
@@ -14,61 +107,81 @@ async def info(settings: Annotated[ComputeSettings, Depends(get_compute_settings
     return common_info(settings)
 
 
+@app.get('/metrics', response_class=PlainTextResponse)
+async def metrics(settings: Annotated[ComputeSettings, Depends(get_compute_settings)]) -> Response:
+    content = await asyncio.to_thread(render_metrics, settings.metrics_dir)
+    return PlainTextResponse(content, media_type=PROMETHEUS_CONTENT_TYPE)
+
+
+async def _create_compute_keypair(request: Request, user_key_hash: str) -> StoredComputeKey:
+    compute_key_store: ComputeKeyStore = request.state.compute_key_store
+    key_entry = compute_key_store.new_entry()
+    keypair = await request.state.keypair_pool.get()
+    stored = await run_storage_io(compute_key_store.create, user_key_hash, key_entry, keypair)
+    if stored.entry != key_entry:
+        # Another worker or replica stored a keypair first
+        request.state.keypair_pool.put_back(keypair)
+    return stored
+
+
 @app.post('/get_compute_key_info')
 async def get_compute_key_info(
     params: ComputeKeyInfoParams,
     settings: Annotated[ComputeSettings, Depends(get_compute_settings)],
+    request: Request,
 ) -> ComputeKeyInfoResponse:
-    lock = asyncio.Lock()
-    await lock.acquire()
-
-    user_public_key_file = HashedStrFile(
-        settings.user_keys_dir, params.crypt4gh_user_public_key, write_to_storage=True)
-    compute_public_key_file = ComputeKeyFile(
-        settings.compute_keys_dir,
-        user_public_key_file,
-        settings.compute_key_id_prefix,
-        settings.compute_key_expiration_delta_secs,
-        public=True)
-    compute_private_key_file = ComputeKeyFile(
-        settings.compute_keys_dir,
-        user_public_key_file,
-        settings.compute_key_id_prefix,
-        settings.compute_key_expiration_delta_secs,
-        public=False)
-
-    existing_key_files: int = sum(
-        1 for f in (compute_private_key_file, compute_public_key_file) if f.path.exists())
-
-    if existing_key_files == 0:
-        await crypt4gh_generate_keypair(
-            compute_private_key_file.path,
-            compute_public_key_file.path,
-            settings.private_key_passphrase,
-            settings.private_key_comment,
-            verbose=settings.dev_mode)
-    elif existing_key_files == 1:
-        # TODO: Fix special case when key expires in between the checks of the public and private
-        #       keys. Suggestion: allow a couple of retries.
-        raise Exception('Only one of the compute node public/private keypair files exists!'
-                        f' Key id: {compute_public_key_file.key_id}')
-    else:
-        assert existing_key_files == 2
-
-    compute_public_key_file.read_from_storage()
-    compute_private_key_file.read_from_storage()
-
-    assert compute_public_key_file.key_id == compute_private_key_file.key_id
-
-    lock.release()
+    user_public_key_file = HashedStrFile(settings.user_keys_dir, params.crypt4gh_user_public_key)
+    await user_public_key_file.async_write_to_storage()
+    user_key_hash = user_public_key_file.sha256
+    compute_key_store: ComputeKeyStore = request.state.compute_key_store
+
+    if settings.compute_key_rotation_interval_secs > 0:
+        # Tracked for the rotation only, which also forgets users no longer served
+        compute_key_store.mark_used(user_key_hash)
+    stored = compute_key_store.lookup_cached(user_key_hash)
+    if stored is None:
+        stored = await run_storage_io(compute_key_store.lookup, user_key_hash)
+    if stored is None:
+        # Concurrent requests for the same user key within this worker wait for a single creation
+        stored = await request.state.keypair_creation.do(
+            user_key_hash, lambda: _create_compute_keypair(request, user_key_hash))
+    return _compute_key_info(stored)
+
 
+def _compute_key_info(stored: StoredComputeKey) -> ComputeKeyInfoResponse:
     return ComputeKeyInfoResponse(
-        crypt4gh_compute_public_key=compute_public_key_file.contents,
-        crypt4gh_compute_keypair_id=compute_public_key_file.key_id,
-        crypt4gh_compute_keypair_expiration_date=compute_public_key_file.expiration_date,
+        crypt4gh_compute_public_key=stored.public_key,
+        crypt4gh_compute_keypair_id=stored.entry.key_id,
+        crypt4gh_compute_keypair_expiration_date=stored.entry.expiration_date,
     )
 
 
+async def _require_admin_token(settings: Annotated[ComputeSettings, Depends(get_compute_settings)],
+                               authorization: Annotated[Optional[str], Header()] = None):
+    if not settings.admin_token:
+        raise HTTPException(status_code=404, detail='Not Found')
+    expected = f'Bearer {settings.admin_token}'
+    if authorization is None or not secrets.compare_digest(authorization.encode(),
+                                                           expected.encode()):
+        raise HTTPException(
+            status_code=401, detail='Invalid admin token', headers={'WWW-Authenticate': 'Bearer'})
+
+
+@app.post('/admin/provision_compute_keys', dependencies=[Depends(_require_admin_token)])
+async def provision_compute_keys(
+    params: ComputeKeyProvisionParams,
+    settings: Annotated[ComputeSettings, Depends(get_compute_settings)],
+    request: Request,
+) -> ComputeKeyProvisionResponse:
+    stored_keys = await provision_user_public_keys(request.state.compute_key_store,
+                                                   settings,
+                                                   params.crypt4gh_user_public_keys,
+                                                   params.rotate,
+                                                   request.state.crypto_executor)
+    return ComputeKeyProvisionResponse(
+        compute_keys=[_compute_key_info(stored) for stored in stored_keys])
+
+
 # @app.post('/recrypt_header')
 # async def recrypt_header(params: ComputeRecryptParams) -> ComputeRecryptResponse:
 #     return ComputeRecryptResponse(
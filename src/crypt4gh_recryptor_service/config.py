@@ -1,14 +1,15 @@
 import abc
+from dataclasses import dataclass
 from datetime import timedelta
 from enum import Enum
 from functools import lru_cache
 import os
 from pathlib import Path
-from typing import Any, Callable, TypeAlias, Union
+from typing import Any, Callable, Optional, TypeAlias, Union
 
-from crypt4gh_recryptor_service.util import ensure_dirs
+from crypt4gh_recryptor_service.util import available_cpus, ensure_dirs
 from dotenv import dotenv_values
-from pydantic import BaseSettings
+from pydantic import BaseSettings, validator
 from pydantic.env_settings import SettingsSourceCallable
 import yaml
 
@@ -30,16 +31,59 @@ DEFAULT_PRIVATE_KEY_PASSPHRASE = 'Override me using C4GH_RECRYPTOR_PRIVATE_KEY_P
                                  'environment variable or in .env!'
 DEFAULT_PRIVATE_KEY_COMMENT = 'Generated by crypt4gh-recryptor-service!'
 DEFAULT_USER_PRIVATE_KEY_FILE = 'user_key.priv'
+DEFAULT_USER_PRIVATE_KEY_RELOAD_INTERVAL_SECS = 10.0
 DEFAULT_USER_PUBLIC_KEY_FILE = 'user_key.pub'
 DEFAULT_COMPUTE_PRIVATE_KEY_FILE = 'compute_node_key.priv'
 DEFAULT_COMPUTE_PUBLIC_KEY_FILE = 'compute_node_key.pub'
+DEFAULT_METRICS_FLUSH_INTERVAL_SECS = 5.0
+DEFAULT_SUBPROCESS_TIMEOUT_SECS = 30.0
+DEFAULT_MAX_CONCURRENT_SUBPROCESSES = 8
+DEFAULT_STORAGE_IO_THREADS = 8
+DEFAULT_CRYPTO_EXECUTOR_WORKERS = 0  # Number of available CPUs
+DEFAULT_CRYPTO_EXECUTOR_MAX_QUEUE = 64
 DEFAULT_COMPUTE_KEY_ID_PREFIX = 'cnk:'
 DEFAULT_COMPUTE_KEY_EXPIRATION_DELTA_SECS = int(timedelta(days=7).total_seconds())
+DEFAULT_COMPUTE_KEYPAIR_POOL_SIZE = 8
+DEFAULT_COMPUTE_KEY_SWEEP_INTERVAL_SECS = int(timedelta(hours=1).total_seconds())
+DEFAULT_COMPUTE_KEY_RETENTION_AFTER_EXPIRY_SECS = int(timedelta(days=1).total_seconds())
+DEFAULT_COMPUTE_KEY_ROTATION_INTERVAL_SECS = int(timedelta(hours=1).total_seconds())
+DEFAULT_COMPUTE_KEY_ROTATION_AHEAD_SECS = int(timedelta(days=1).total_seconds())
+DEFAULT_COMPUTE_KEY_STORE_SQLITE_FILE = 'compute_keys.sqlite3'
+DEFAULT_COMPUTE_KEY_STORE_SQLITE_BUSY_TIMEOUT_SECS = 10.0
+DEFAULT_RECRYPT_MEMORY_STORAGE_MAX_ENTRIES = 1024
+DEFAULT_RECRYPT_BATCH_CONCURRENCY = 8
+DEFAULT_RECRYPT_BATCH_MAX_ITEMS = 1000
+DEFAULT_COMPUTE_CLIENT_HTTP2 = True
+DEFAULT_COMPUTE_CLIENT_MAX_CONNECTIONS = 100
+DEFAULT_COMPUTE_CLIENT_MAX_KEEPALIVE_CONNECTIONS = 20
+DEFAULT_COMPUTE_CLIENT_KEEPALIVE_EXPIRY_SECS = 60.0
+DEFAULT_COMPUTE_CLIENT_CONNECT_TIMEOUT_SECS = 5.0
+DEFAULT_COMPUTE_CLIENT_READ_TIMEOUT_SECS = 30.0
+DEFAULT_COMPUTE_CLIENT_RETRIES = 3
+DEFAULT_COMPUTE_CLIENT_RETRY_BACKOFF_SECS = 0.1
+DEFAULT_COMPUTE_CLIENT_RETRY_MAX_BACKOFF_SECS = 2.0
+DEFAULT_COMPUTE_HEALTH_CHECK_INTERVAL_SECS = 10.0
+DEFAULT_COMPUTE_HEALTH_CHECK_TIMEOUT_SECS = 2.0
+DEFAULT_COMPUTE_KEY_INFO_CACHE_SAFETY_MARGIN_SECS = int(timedelta(minutes=5).total_seconds())
+DEFAULT_COMPUTE_KEY_INFO_CACHE_REFRESH_AHEAD_SECS = int(timedelta(hours=1).total_seconds())
+DEFAULT_RECRYPT_RESULT_CACHE_MAX_ENTRIES = 4096
+DEFAULT_RECRYPT_RESULT_CACHE_TTL_SECS = int(timedelta(hours=1).total_seconds())
+DEFAULT_RETENTION_SWEEP_INTERVAL_SECS = int(timedelta(minutes=10).total_seconds())
+DEFAULT_RETENTION_MAX_COUNT = 100_000
+DEFAULT_HEADERS_RETENTION_MAX_AGE_SECS = int(timedelta(days=1).total_seconds())
+# Hashed key files are rewritten whenever used, so they only age out after the keypair expired
+DEFAULT_KEYS_RETENTION_MAX_AGE_SECS = \
+    DEFAULT_COMPUTE_KEY_EXPIRATION_DELTA_SECS + int(timedelta(days=1).total_seconds())
+DEFAULT_SERVER_WORKERS = 0  # Number of available CPUs
+DEFAULT_SERVER_BACKLOG = 2048
+DEFAULT_SERVER_KEEP_ALIVE_TIMEOUT_SECS = 5
 
 USER_KEYS_DIR = 'user_keys'
 COMPUTE_KEYS_DIR = 'compute_keys'
 HEADERS_DIR = 'headers'
 CERT_DIR = 'certs'
+LOCKS_DIR = 'locks'
+METRICS_DIR = 'metrics'
 
 _builtin_dict: TypeAlias = dict
 
@@ -49,6 +93,34 @@ class ServerMode(str, Enum):
     COMPUTE = 'compute'
 
 
+class RecryptBackend(str, Enum):
+    IN_PROCESS = 'in_process'
+    SUBPROCESS = 'subprocess'
+
+
+class ComputeRouting(str, Enum):
+    # Consistent hashing on the user public key keeps the compute keypair of a user on one node
+    CONSISTENT_HASH = 'consistent_hash'
+    LEAST_OUTSTANDING = 'least_outstanding'
+
+
+class ComputeKeyStoreBackend(str, Enum):
+    FILESYSTEM = 'filesystem'
+    SQLITE = 'sqlite'
+
+
+class ServerLoop(str, Enum):
+    AUTO = 'auto'
+    ASYNCIO = 'asyncio'
+    UVLOOP = 'uvloop'
+
+
+class ServerHttp(str, Enum):
+    AUTO = 'auto'
+    H11 = 'h11'
+    HTTPTOOLS = 'httptools'
+
+
 C4ghSettingsSourceCallable = Callable[['Settings'], dict[str, Any]]
 
 
@@ -83,6 +155,19 @@ class Settings(BaseSettings):
     private_key_passphrase: str = DEFAULT_PRIVATE_KEY_PASSPHRASE
     private_key_comment: str = DEFAULT_PRIVATE_KEY_COMMENT
     dev_mode: bool = False
+    metrics_flush_interval_secs: float = DEFAULT_METRICS_FLUSH_INTERVAL_SECS
+    subprocess_timeout_secs: float = DEFAULT_SUBPROCESS_TIMEOUT_SECS
+    max_concurrent_subprocesses: int = DEFAULT_MAX_CONCURRENT_SUBPROCESSES
+    storage_io_threads: int = DEFAULT_STORAGE_IO_THREADS
+    crypto_executor_workers: int = DEFAULT_CRYPTO_EXECUTOR_WORKERS
+    crypto_executor_max_queue: int = DEFAULT_CRYPTO_EXECUTOR_MAX_QUEUE
+    server_workers: int = DEFAULT_SERVER_WORKERS
+    server_loop: ServerLoop = ServerLoop.AUTO
+    server_http: ServerHttp = ServerHttp.AUTO
+    server_backlog: int = DEFAULT_SERVER_BACKLOG
+    server_keep_alive_timeout_secs: int = DEFAULT_SERVER_KEEP_ALIVE_TIMEOUT_SECS
+    server_limit_concurrency: Optional[int] = None
+    retention_sweep_interval_secs: int = DEFAULT_RETENTION_SWEEP_INTERVAL_SECS
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -104,29 +189,54 @@ class Settings(BaseSettings):
         return super_dict
 
     @property
-    @abc.abstractmethod
     def working_dir(self) -> Path:
+        return self.paths.working_dir
+
+    @property
+    def effective_server_workers(self) -> int:
+        # Auto-detected from the CPU affinity and cgroup CPU quota. Reloading needs one worker.
+        if self.dev_mode:
+            return 1
+        return self.server_workers or available_cpus()
+
+    @property
+    def effective_crypto_executor_workers(self) -> int:
+        # By default, the available CPUs are shared among the crypto executors of all workers
+        return self.crypto_executor_workers or max(
+            available_cpus() // self.effective_server_workers, 1)
+
+    @property
+    @abc.abstractmethod
+    def paths(self) -> 'Paths':
         pass
 
     @property
     def yml_config_file_path(self) -> Path:
-        return _get_yml_config_file_path(self.working_dir)
+        return self.paths.yml_config_file
 
     @property
     def user_keys_dir(self) -> Path:
-        return Path(self.working_dir, USER_KEYS_DIR)
+        return self.paths.user_keys_dir
 
     @property
     def compute_keys_dir(self) -> Path:
-        return Path(self.working_dir, COMPUTE_KEYS_DIR)
+        return self.paths.compute_keys_dir
 
     @property
     def headers_dir(self) -> Path:
-        return Path(self.working_dir, HEADERS_DIR)
+        return self.paths.headers_dir
 
     @property
     def cert_dir(self) -> Path:
-        return Path(self.working_dir, CERT_DIR)
+        return self.paths.cert_dir
+
+    @property
+    def locks_dir(self) -> Path:
+        return self.paths.locks_dir
+
+    @property
+    def metrics_dir(self) -> Path:
+        return self.paths.metrics_dir
 
     @property
     def certfile_path(self) -> Path:
@@ -142,12 +252,58 @@ class UserSettings(Settings):
     port: int = DEFAULT_PORT_USER
     compute_host: str = DEFAULT_HOST
     compute_port: int = DEFAULT_PORT_COMPUTE
+    # "host:port" of each compute node replica, defaulting to `compute_host` and `compute_port`
+    compute_endpoints: list[str] = []
+    compute_routing: ComputeRouting = ComputeRouting.CONSISTENT_HASH
+    compute_health_check_interval_secs: float = DEFAULT_COMPUTE_HEALTH_CHECK_INTERVAL_SECS
+    compute_health_check_timeout_secs: float = DEFAULT_COMPUTE_HEALTH_CHECK_TIMEOUT_SECS
     user_private_key: str = DEFAULT_USER_PRIVATE_KEY_FILE
     user_public_key: str = DEFAULT_USER_PUBLIC_KEY_FILE
+    # Interval for checking whether the user private key file was replaced
+    user_private_key_reload_interval_secs: float = DEFAULT_USER_PRIVATE_KEY_RELOAD_INTERVAL_SECS
+    recrypt_backend: RecryptBackend = RecryptBackend.IN_PROCESS
+    # In-process recrypts run in the crypto executor workers, which then are the only processes
+    # holding the unlocked user private key. Otherwise, they run in threads of the server process.
+    recrypt_in_crypto_executor: bool = True
+    recrypt_audit_to_disk: bool = False
+    recrypt_memory_storage_max_entries: int = DEFAULT_RECRYPT_MEMORY_STORAGE_MAX_ENTRIES
+    recrypt_batch_concurrency: int = DEFAULT_RECRYPT_BATCH_CONCURRENCY
+    # Larger `/recrypt_headers` batches are rejected. The streaming routes hold a bounded number of
+    # headers in memory, and take batches of any size.
+    recrypt_batch_max_items: int = DEFAULT_RECRYPT_BATCH_MAX_ITEMS
+    compute_client_http2: bool = DEFAULT_COMPUTE_CLIENT_HTTP2
+    compute_client_max_connections: int = DEFAULT_COMPUTE_CLIENT_MAX_CONNECTIONS
+    compute_client_max_keepalive_connections: int = \
+        DEFAULT_COMPUTE_CLIENT_MAX_KEEPALIVE_CONNECTIONS
+    compute_client_keepalive_expiry_secs: float = DEFAULT_COMPUTE_CLIENT_KEEPALIVE_EXPIRY_SECS
+    compute_client_connect_timeout_secs: float = DEFAULT_COMPUTE_CLIENT_CONNECT_TIMEOUT_SECS
+    compute_client_read_timeout_secs: float = DEFAULT_COMPUTE_CLIENT_READ_TIMEOUT_SECS
+    compute_client_retries: int = DEFAULT_COMPUTE_CLIENT_RETRIES
+    compute_client_retry_backoff_secs: float = DEFAULT_COMPUTE_CLIENT_RETRY_BACKOFF_SECS
+    compute_client_retry_max_backoff_secs: float = DEFAULT_COMPUTE_CLIENT_RETRY_MAX_BACKOFF_SECS
+    compute_key_info_cache_safety_margin_secs: int = \
+        DEFAULT_COMPUTE_KEY_INFO_CACHE_SAFETY_MARGIN_SECS
+    compute_key_info_cache_refresh_ahead_secs: int = \
+        DEFAULT_COMPUTE_KEY_INFO_CACHE_REFRESH_AHEAD_SECS
+    recrypt_result_cache_max_entries: int = DEFAULT_RECRYPT_RESULT_CACHE_MAX_ENTRIES
+    recrypt_result_cache_ttl_secs: int = DEFAULT_RECRYPT_RESULT_CACHE_TTL_SECS
+    headers_retention_max_age_secs: int = DEFAULT_HEADERS_RETENTION_MAX_AGE_SECS
+    headers_retention_max_count: int = DEFAULT_RETENTION_MAX_COUNT
+    headers_retention_max_bytes: int = 0
+    compute_keys_retention_max_age_secs: int = DEFAULT_KEYS_RETENTION_MAX_AGE_SECS
+    compute_keys_retention_max_count: int = DEFAULT_RETENTION_MAX_COUNT
+    compute_keys_retention_max_bytes: int = 0
+
+    @validator('compute_endpoints', each_item=True)
+    def _check_compute_endpoint(cls, v: str) -> str:
+        _parse_endpoint(v)
+        return v
 
     @property
-    def working_dir(self) -> Path:
-        return _get_working_dir(ServerMode.USER)
+    def compute_endpoint_list(self) -> list[tuple[str, int]]:
+        if not self.compute_endpoints:
+            return [(self.compute_host, self.compute_port)]
+        return [_parse_endpoint(endpoint) for endpoint in self.compute_endpoints]
 
     @property
     def user_private_key_path(self) -> Path:
@@ -161,19 +317,56 @@ class UserSettings(Settings):
     def compute_public_key_path(self) -> Path:
         return Path(self.compute_keys_dir, DEFAULT_COMPUTE_PUBLIC_KEY_FILE)
 
+    @property
+    def paths(self) -> 'Paths':
+        return get_paths(ServerMode.USER)
+
     class Config(BaseConfig):
         pass
 
 
+def _parse_endpoint(endpoint: str) -> tuple[str, int]:
+    host, sep, port = endpoint.rpartition(':')
+    if not sep or not host or not port.isdigit():
+        raise ValueError(f'Endpoint "{endpoint}" is not of the form "host:port"')
+    return host, int(port)
+
+
 class ComputeSettings(Settings):
     server_mode: ServerMode = ServerMode.COMPUTE
     port: int = DEFAULT_PORT_COMPUTE
     compute_key_id_prefix: str = DEFAULT_COMPUTE_KEY_ID_PREFIX
     compute_key_expiration_delta_secs: int = DEFAULT_COMPUTE_KEY_EXPIRATION_DELTA_SECS
+    compute_keypair_pool_size: int = DEFAULT_COMPUTE_KEYPAIR_POOL_SIZE
+    compute_key_sweep_interval_secs: int = DEFAULT_COMPUTE_KEY_SWEEP_INTERVAL_SECS
+    compute_key_retention_after_expiry_secs: int = DEFAULT_COMPUTE_KEY_RETENTION_AFTER_EXPIRY_SECS
+    # Every interval (0 disables rotation), keypairs of recently served users expiring within
+    # `compute_key_rotation_ahead_secs` are rotated
+    compute_key_rotation_interval_secs: int = DEFAULT_COMPUTE_KEY_ROTATION_INTERVAL_SECS
+    compute_key_rotation_ahead_secs: int = DEFAULT_COMPUTE_KEY_ROTATION_AHEAD_SECS
+    # Enables the `/admin` endpoints, for requests with an "Authorization: Bearer <token>" header
+    admin_token: Optional[str] = None
+    compute_key_store: ComputeKeyStoreBackend = ComputeKeyStoreBackend.FILESYSTEM
+    # Defaults to a file in the working dir. Point to shared storage to share keys between replicas.
+    compute_key_store_sqlite_path: Optional[str] = None
+    # Opt-in for single-host setups only: WAL breaks with processes on other hosts, as WAL
+    # relies on shared memory. Keep it disabled with the database on shared storage.
+    compute_key_store_sqlite_wal: bool = False
+    compute_key_store_sqlite_busy_timeout_secs: float = \
+        DEFAULT_COMPUTE_KEY_STORE_SQLITE_BUSY_TIMEOUT_SECS
+    user_keys_retention_max_age_secs: int = DEFAULT_KEYS_RETENTION_MAX_AGE_SECS
+    user_keys_retention_max_count: int = DEFAULT_RETENTION_MAX_COUNT
+    user_keys_retention_max_bytes: int = 0
 
     @property
-    def working_dir(self) -> Path:
-        return _get_working_dir(ServerMode.COMPUTE)
+    def compute_key_store_sqlite_file_path(self) -> Path:
+        if self.compute_key_store_sqlite_path:
+            return Path(self.compute_key_store_sqlite_path)
+        return Path(self.working_dir, DEFAULT_COMPUTE_KEY_STORE_SQLITE_FILE)
+
+    @property
+    def paths(self) -> 'Paths':
+        return get_paths(ServerMode.COMPUTE)
 
     class Config(BaseConfig):
         pass
@@ -214,7 +407,46 @@ def yml_config_setting(settings: Settings) -> dict[str, Any]:
         return {}
 
 
+@dataclass(frozen=True)
+class Paths:
+    # Resolved once per process, as the paths are used on the request path
+    working_dir: Path
+    yml_config_file: Path
+    user_keys_dir: Path
+    compute_keys_dir: Path
+    headers_dir: Path
+    cert_dir: Path
+    locks_dir: Path
+    metrics_dir: Path
+
+    @classmethod
+    def from_working_dir(cls, working_dir: Path) -> 'Paths':
+        return cls(
+            working_dir=working_dir,
+            yml_config_file=_get_yml_config_file_path(working_dir),
+            user_keys_dir=Path(working_dir, USER_KEYS_DIR),
+            compute_keys_dir=Path(working_dir, COMPUTE_KEYS_DIR),
+            headers_dir=Path(working_dir, HEADERS_DIR),
+            cert_dir=Path(working_dir, CERT_DIR),
+            locks_dir=Path(working_dir, LOCKS_DIR),
+            metrics_dir=Path(working_dir, METRICS_DIR),
+        )
+
+
+@lru_cache
+def get_paths(server_mode: ServerMode) -> Paths:
+    return Paths.from_working_dir(_get_working_dir(server_mode))
+
+
+def _resolved_working_dir_env_var(server_mode: ServerMode) -> str:
+    return f'{ENV_PREFIX}RESOLVED_WORKING_DIR_{server_mode.value.upper()}'
+
+
 def _get_working_dir(server_mode: ServerMode) -> Path:
+    # Server workers inherit the working dir resolved by the main process
+    if resolved_working_dir := os.environ.get(_resolved_working_dir_env_var(server_mode)):
+        return Path(resolved_working_dir)
+
     default_working_dir_attr = f'DEFAULT_WORKING_DIR_{server_mode.value.upper()}'
     if env_working_dir := dotenv_values().get(default_working_dir_attr):
         return Path(env_working_dir)
@@ -227,21 +459,29 @@ def _get_yml_config_file_path(working_dir: Path) -> Path:
 
 
 def setup_files(server_mode: ServerMode):
-    working_dir = _get_working_dir(server_mode)
-    yml_config_file_path = _get_yml_config_file_path(working_dir)
-
-    ensure_dirs(working_dir)
-    ensure_dirs(Path(working_dir, USER_KEYS_DIR))
-    ensure_dirs(Path(working_dir, COMPUTE_KEYS_DIR))
-    ensure_dirs(Path(working_dir, HEADERS_DIR))
-    ensure_dirs(Path(working_dir, CERT_DIR))
-
-    if not os.path.exists(yml_config_file_path):
-        with open(yml_config_file_path, 'w') as f:
+    paths = get_paths(server_mode)
+    os.environ[_resolved_working_dir_env_var(server_mode)] = str(paths.working_dir)
+
+    ensure_dirs(paths.working_dir)
+    ensure_dirs(paths.user_keys_dir)
+    ensure_dirs(paths.compute_keys_dir)
+    ensure_dirs(paths.headers_dir)
+    ensure_dirs(paths.cert_dir)
+    ensure_dirs(paths.locks_dir)
+    ensure_dirs(paths.metrics_dir)
+
+    # Metrics are aggregated from per-worker snapshots, which start afresh at every launch
+    for snapshot_path in paths.metrics_dir.glob('*.json'):
+        snapshot_path.unlink()
+
+    if not os.path.exists(paths.yml_config_file):
+        with open(paths.yml_config_file, 'w') as f:
             f.write('')
-        yml_config_file_path.chmod(mode=0o600)
+        paths.yml_config_file.chmod(mode=0o600)
 
-    settings = get_settings(server_mode).dict()
+    settings_yml = yaml.safe_dump(get_settings(server_mode).dict())
 
-    with open(yml_config_file_path, 'w') as f:
-        yaml.safe_dump(settings, f)
+    # Only rewritten when changed, e.g. at the first launch or after an upgrade adding settings
+    if paths.yml_config_file.read_text() != settings_yml:
+        with open(paths.yml_config_file, 'w') as f:
+            f.write(settings_yml)
@@ -1,48 +1,246 @@
+import asyncio
+from base64 import b64decode, b64encode
+import io
+import os
 from pathlib import Path
-from subprocess import CalledProcessError
+import shutil
+from subprocess import CalledProcessError, TimeoutExpired
+import tempfile
+from typing import Any, Callable, NamedTuple, Optional, TypeVar
 
+from crypt4gh import header, sodium
+from crypt4gh.keys import c4gh, ssh
+from crypt4gh_recryptor_service.config import RecryptBackend
+from crypt4gh_recryptor_service.executor import CryptoExecutor, CryptoExecutorSaturatedError
+from crypt4gh_recryptor_service.keyholder import PrivateKeyHolder, worker_private_key
+from crypt4gh_recryptor_service.metrics import STAGE_SECONDS
 from crypt4gh_recryptor_service.storage import HashedStrFile, HeaderFile
-from crypt4gh_recryptor_service.util import async_run_in_subprocess
+from crypt4gh_recryptor_service.util import (async_run_in_subprocess,
+                                             atomic_write,
+                                             ensure_dirs_durable,
+                                             fsync_dir,
+                                             run_storage_io,
+                                             TEMP_FILE_PREFIX,
+                                             write_new_file)
 from fastapi import HTTPException
 
+X25519_CHACHA20_POLY1305 = 0
+
+T = TypeVar('T')
+
+
+def _header_not_decryptable() -> HTTPException:
+    return HTTPException(
+        status_code=406,
+        detail='The key header was not able to decode the header. '
+        'Please make sure that the encrypted header is '
+        "decryptable by the user's private key")
+
+
+def _invalid_compute_public_key() -> HTTPException:
+    return HTTPException(
+        status_code=502, detail='The compute node returned a public key that could not be parsed')
+
+
+def parse_public_key(contents: str) -> bytes:
+    lines = [line.strip() for line in contents.splitlines() if line.strip()]
+    if not lines:
+        raise ValueError('Empty key')
+
+    if 'CRYPT4GH' in lines[0]:
+        public_key = b64decode(''.join(lines[1:-1]))
+    elif lines[0].startswith('ssh-'):
+        try:
+            public_key = ssh.get_public_key(lines[0].encode('ascii'))
+        except (AssertionError, NotImplementedError) as e:
+            # Raised by crypt4gh for malformed and unsupported SSH keys
+            raise ValueError(f'Unsupported SSH key: {e}') from e
+    else:
+        raise ValueError('Unsupported key format')
+
+    if len(public_key) != 32:
+        raise ValueError('Not an X25519 public key')
+    return public_key
+
+
+def recrypt_header(in_header: bytes, user_private_key: bytes | bytearray,
+                   compute_public_key: bytes) -> bytes:
+    header_packets = header.parse(io.BytesIO(in_header))
+    decryption_keys = [(X25519_CHACHA20_POLY1305, user_private_key, None)]
+    recipient_keys = [(X25519_CHACHA20_POLY1305, user_private_key, compute_public_key)]
+    return header.serialize(header.reencrypt(header_packets, decryption_keys, recipient_keys))
+
+
+async def _run_crypto_job(executor: Optional[CryptoExecutor], func: Callable[..., T], *args:
+                          Any) -> T:
+    # In the crypto executor if there is one, otherwise in a thread
+    if executor is None:
+        return await asyncio.to_thread(func, *args)
+    try:
+        return await executor.run(func, *args)
+    except CryptoExecutorSaturatedError as e:
+        raise HTTPException(
+            status_code=503, detail='Server too busy', headers={'Retry-After': '1'}) from e
+
+
+def _recrypt_header_with_worker_key(in_header: bytes, compute_public_key: bytes) -> bytes:
+    return recrypt_header(in_header, worker_private_key(), compute_public_key)
+
+
+async def _recrypt_header_in_process(in_header: bytes,
+                                     user_private_key: PrivateKeyHolder,
+                                     compute_public_key: str,
+                                     executor: Optional[CryptoExecutor]) -> bytes:
+    try:
+        parsed_compute_public_key = parse_public_key(compute_public_key)
+    except ValueError as e:
+        raise _invalid_compute_public_key() from e
+    try:
+        with STAGE_SECONDS.time(stage='recrypt'):
+            if executor is not None:
+                # The executor workers unlock their own copy of the user key at startup, so only
+                # the header and the recipient key are sent along with every job
+                return await _run_crypto_job(executor,
+                                             _recrypt_header_with_worker_key,
+                                             in_header,
+                                             parsed_compute_public_key)
+            # The key is unlocked at startup, so getting it does not block
+            return await _run_crypto_job(None,
+                                         recrypt_header,
+                                         in_header,
+                                         user_private_key.get(),
+                                         parsed_compute_public_key)
+    except ValueError as e:
+        raise _header_not_decryptable() from e
+
 
 async def crypt4gh_recrypt_header(in_header_file: HeaderFile,
                                   compute_key_file: HashedStrFile,
-                                  user_private_key_path: Path,
-                                  verbose: bool):
-    headers_dir = in_header_file.path.parent
-    out_header_file = HeaderFile(headers_dir)
+                                  user_private_key: PrivateKeyHolder,
+                                  backend: RecryptBackend = RecryptBackend.IN_PROCESS,
+                                  timeout: Optional[float] = None,
+                                  executor: Optional[CryptoExecutor] = None,
+                                  verbose: bool = False) -> HeaderFile:
+    if backend == RecryptBackend.SUBPROCESS:
+        return await _crypt4gh_recrypt_header_in_subprocess(
+            in_header_file, compute_key_file, user_private_key.path, timeout, verbose=verbose)
+
+    out_header = await _recrypt_header_in_process(
+        in_header_file.raw_contents,
+        user_private_key,
+        compute_key_file.contents,
+        executor,
+    )
+    out_header_file = HeaderFile.from_bytes(
+        in_header_file.dir, out_header, storage=in_header_file.storage)
+    if in_header_file.storage.persistent:
+        await out_header_file.async_write_to_storage()
+    return out_header_file
+
+
+async def _crypt4gh_recrypt_header_in_subprocess(in_header_file: HeaderFile,
+                                                 compute_key_file: HashedStrFile,
+                                                 user_private_key_path: Path,
+                                                 timeout: Optional[float],
+                                                 verbose: bool) -> HeaderFile:
+    # The crypt4gh-recryptor command line tool reads and writes the files on disk
+    assert in_header_file.storage.persistent and compute_key_file.storage.persistent
+
+    headers_dir = in_header_file.dir
+    out_header_file = await run_storage_io(HeaderFile, headers_dir)
+    cmd = [
+        'crypt4gh-recryptor',
+        'recrypt',
+        '--encryption-key',
+        str(compute_key_file.path),
+        '-i',
+        str(in_header_file.path),
+        '-o',
+        str(out_header_file.path),
+        '--decryption-key',
+        str(user_private_key_path),
+    ]
 
     try:
-        await async_run_in_subprocess(
-            f'crypt4gh-recryptor recrypt '
-            f'--encryption-key {compute_key_file.path} '
-            f'-i {in_header_file.path} '
-            f'-o {out_header_file.path} '
-            f'--decryption-key {user_private_key_path}',
-            verbose=verbose)
+        with STAGE_SECONDS.time(stage='recrypt_subprocess'):
+            await async_run_in_subprocess(cmd, timeout=timeout, verbose=verbose)
+    except TimeoutExpired as e:
+        await run_storage_io(lambda: out_header_file.path.unlink(missing_ok=True))
+        raise HTTPException(status_code=503, detail='Recryption timed out') from e
     except CalledProcessError as e:
+        await run_storage_io(lambda: out_header_file.path.unlink(missing_ok=True))
         if e.returncode == 1:
-            raise HTTPException(
-                status_code=406,
-                detail='The key header was not able to decode the header. '
-                'Please make sure that the encrypted header is '
-                "decryptable by the user's private key") from e
+            raise _header_not_decryptable() from e
         else:
             raise e
 
-    out_header_file.read_from_storage()
+    await out_header_file.async_read_from_storage()
     return out_header_file
 
 
+class Keypair(NamedTuple):
+    private_key: bytes
+    public_key: bytes
+
+
+def generate_keypair(passphrase: str, comment: str) -> Keypair:
+    private_key = os.urandom(32)
+    encoded_private_key = c4gh.encode_private_key(private_key,
+                                                  passphrase.encode() if passphrase else None,
+                                                  comment.encode() or None)
+    return Keypair(
+        private_key=_to_pem(encoded_private_key, 'CRYPT4GH PRIVATE KEY'),
+        public_key=_to_pem(sodium.derive_pk(private_key), 'CRYPT4GH PUBLIC KEY'),
+    )
+
+
+async def async_generate_keypair(passphrase: str,
+                                 comment: str,
+                                 executor: Optional[CryptoExecutor] = None,
+                                 background: bool = False) -> Keypair:
+    # Background generations (e.g. pool refills) are not subject to the executor queue limit.
+    # Only the async generations are timed, as the sync ones are only used outside of the servers.
+    with STAGE_SECONDS.time(stage='keypair_generation'):
+        if executor is not None and background:
+            return await executor.run(generate_keypair, passphrase, comment, bounded=False)
+        return await _run_crypto_job(executor, generate_keypair, passphrase, comment)
+
+
+def _to_pem(key: bytes, label: str) -> bytes:
+    return b'-----BEGIN %s-----\n%s\n-----END %s-----\n' % (
+        label.encode(), b64encode(key), label.encode())
+
+
+def write_keypair(keypair: Keypair, private_key_path: Path, public_key_path: Path):
+    # Each key file is replaced atomically, the private key first, so that a public key file is
+    # never left without its private key
+    atomic_write(private_key_path, keypair.private_key)
+    atomic_write(public_key_path, keypair.public_key)
+
+
+def commit_keypair_dir(keypair: Keypair, private_key_path: Path, public_key_path: Path):
+    # Creates the directory of both key files at once. The key files are written to a staging
+    # directory next to it, which is then renamed, so that readers (also after a crash) see either
+    # both key files or no directory at all.
+    key_dir = private_key_path.parent
+    assert public_key_path.parent == key_dir
+    ensure_dirs_durable(key_dir.parent)
+    staging_dir = Path(tempfile.mkdtemp(prefix=TEMP_FILE_PREFIX, dir=key_dir.parent))
+    try:
+        write_new_file(staging_dir.joinpath(private_key_path.name), keypair.private_key)
+        write_new_file(staging_dir.joinpath(public_key_path.name), keypair.public_key)
+        fsync_dir(staging_dir)
+        staging_dir.rename(key_dir)
+    except BaseException:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+    fsync_dir(key_dir.parent)
+
+
 async def crypt4gh_generate_keypair(private_key_path: Path,
                                     public_key_path: Path,
                                     passphrase: str,
                                     comment: str,
-                                    verbose: bool = False):
-    await async_run_in_subprocess(
-        f'crypt4gh-recryptor generate-keypair'
-        f' --private {private_key_path}'
-        f' --public {public_key_path}' + (f' --passphrase "{passphrase}"' if passphrase else '') +
-        (f' --comment "{comment}"' if comment else ''),
-        verbose=verbose)
+                                    executor: Optional[CryptoExecutor] = None):
+    keypair = await async_generate_keypair(passphrase, comment, executor)
+    write_keypair(keypair, private_key_path, public_key_path)
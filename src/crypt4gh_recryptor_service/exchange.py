@@ -1,15 +1,224 @@
+import asyncio
+from contextlib import AsyncExitStack
+from functools import lru_cache
+from hashlib import sha256
+import logging
+import random
+import ssl
+from typing import Any, Awaitable, Callable, Optional, TypeVar
+
+from crypt4gh_recryptor_service.config import ComputeRouting, UserSettings
+from crypt4gh_recryptor_service.metrics import (COMPUTE_HEALTH_CHECKS,
+                                                COMPUTE_NODE_FAILOVERS,
+                                                STAGE_SECONDS)
 from crypt4gh_recryptor_service.models import ComputeKeyInfoParams, ComputeKeyInfoResponse
+import httpx
 from pydantic import parse_obj_as
+import truststore
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+RETRY_STATUS_CODES = frozenset({502, 503, 504})
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+class ComputeNodeClient:
+    # Long-lived, pooled client to a compute node, keeping connections warm between requests
+    def __init__(self,
+                 settings: UserSettings,
+                 transport: Optional[httpx.AsyncBaseTransport] = None,
+                 endpoint: Optional[tuple[str, int]] = None):
+        self._host, self._port = endpoint or (settings.compute_host, settings.compute_port)
+        self._health_check_timeout_secs = settings.compute_health_check_timeout_secs
+        self.healthy = True
+        self.outstanding = 0
+        self._retries = settings.compute_client_retries
+        self._retry_backoff_secs = settings.compute_client_retry_backoff_secs
+        self._retry_max_backoff_secs = settings.compute_client_retry_max_backoff_secs
+
+        # Use the truststore of the local OS
+        ctx = truststore.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+
+        self._client = httpx.AsyncClient(
+            base_url=f'https://{self._host}:{self._port}',
+            verify=ctx,
+            http2=self._use_http2(settings),
+            limits=httpx.Limits(
+                max_connections=settings.compute_client_max_connections,
+                max_keepalive_connections=settings.compute_client_max_keepalive_connections,
+                keepalive_expiry=settings.compute_client_keepalive_expiry_secs,
+            ),
+            timeout=httpx.Timeout(
+                settings.compute_client_read_timeout_secs,
+                connect=settings.compute_client_connect_timeout_secs,
+            ),
+            transport=transport,
+        )
+
+    def _use_http2(self, settings: UserSettings) -> bool:
+        if settings.compute_client_http2 and not HTTP2_AVAILABLE:
+            logger.warning(
+                'HTTP/2 is enabled for compute node %s, but the "h2" package is not installed. '
+                'Falling back to HTTP/1.1. Install "httpx[http2]" or set compute_client_http2 to '
+                'false.',
+                self.name)
+            return False
+        return settings.compute_client_http2
+
+    @property
+    def host(self) -> str:
+        return self._host
+
+    @property
+    def port(self) -> int:
+        return self._port
+
+    @property
+    def name(self) -> str:
+        return f'{self._host}:{self._port}'
+
+    async def __aenter__(self) -> 'ComputeNodeClient':
+        await self._client.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self._client.__aexit__(*exc_info)
+
+    async def check_health(self) -> bool:
+        try:
+            response = await self._client.get('/info', timeout=self._health_check_timeout_secs)
+            self.healthy = response.status_code == 200
+        except httpx.HTTPError:
+            self.healthy = False
+        COMPUTE_HEALTH_CHECKS.inc(node=self.name, result='healthy' if self.healthy else 'unhealthy')
+        return self.healthy
+
+    async def post_idempotent(self, path: str, json: Any) -> httpx.Response:
+        self.outstanding += 1
+        try:
+            return await self._post_idempotent(path, json)
+        finally:
+            self.outstanding -= 1
+
+    async def _post_idempotent(self, path: str, json: Any) -> httpx.Response:
+        # Retries transport errors and gateway errors with jittered exponential backoff. Only to
+        # be used for requests that can safely be repeated.
+        for attempt in range(self._retries + 1):
+            try:
+                response = await self._client.post(path, json=json)
+                if response.status_code not in RETRY_STATUS_CODES or attempt == self._retries:
+                    response.raise_for_status()
+                    return response
+            except httpx.TransportError:
+                if attempt == self._retries:
+                    raise
+            await asyncio.sleep(self._backoff_secs(attempt))
+        raise AssertionError('unreachable')
+
+    def _backoff_secs(self, attempt: int) -> float:
+        # "Full jitter" backoff
+        return random.uniform(
+            0, min(self._retry_max_backoff_secs, self._retry_backoff_secs * 2**attempt))
+
+    async def get_compute_key_info(self, user_public_key: str) -> ComputeKeyInfoResponse:
+        payload = ComputeKeyInfoParams(crypt4gh_user_public_key=user_public_key)
+        with STAGE_SECONDS.time(stage='compute_key_fetch'):
+            response = await self.post_idempotent('/get_compute_key_info', json=payload.dict())
+        return parse_obj_as(ComputeKeyInfoResponse, response.json())
+
+
+def _is_node_failure(e: Exception) -> bool:
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code in RETRY_STATUS_CODES
+    return isinstance(e, httpx.TransportError)
+
+
+class ComputeNodeRouter:
+    # Routes requests over the compute node replicas. Nodes are health checked in the background
+    # against `/info`, and marked unhealthy when requests to them fail, in which case the
+    # requests fail over to the next node.
+    def __init__(self,
+                 settings: UserSettings,
+                 transport: Optional[httpx.AsyncBaseTransport] = None):
+        self._routing = settings.compute_routing
+        self._health_check_interval_secs = settings.compute_health_check_interval_secs
+        self._nodes = [
+            ComputeNodeClient(settings, transport, endpoint)
+            for endpoint in settings.compute_endpoint_list
+        ]
+        self._node_names = tuple(node.name for node in self._nodes)
+        self._exit_stack = AsyncExitStack()
+        self._health_check_task: Optional[asyncio.Task] = None
+
+    @property
+    def nodes(self) -> list[ComputeNodeClient]:
+        return self._nodes
+
+    async def __aenter__(self) -> 'ComputeNodeRouter':
+        for node in self._nodes:
+            await self._exit_stack.enter_async_context(node)
+        if len(self._nodes) > 1:
+            self._health_check_task = asyncio.create_task(self._check_health_periodically())
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        if self._health_check_task is not None:
+            self._health_check_task.cancel()
+        await self._exit_stack.aclose()
+
+    async def _check_health_periodically(self):
+        while True:
+            await asyncio.gather(*(node.check_health() for node in self._nodes))
+            await asyncio.sleep(self._health_check_interval_secs)
+
+    def candidates(self, routing_key: str) -> list[ComputeNodeClient]:
+        # Nodes in order of preference. Unhealthy nodes come last, as a last resort.
+        if self._routing == ComputeRouting.LEAST_OUTSTANDING:
+            nodes = sorted(self._nodes, key=lambda node: (node.outstanding, random.random()))
+        else:
+            nodes = [self._nodes[i] for i in _rendezvous_order(routing_key, self._node_names)]
+        return sorted(nodes, key=lambda node: not node.healthy)
+
+    async def request(self, routing_key: str, func: Callable[[ComputeNodeClient],
+                                                             Awaitable[T]]) -> T:
+        candidates = self.candidates(routing_key)
+        for node in candidates:
+            try:
+                return await func(node)
+            except httpx.HTTPError as e:
+                if not _is_node_failure(e):
+                    raise
+                # Until the next successful health check
+                node.healthy = False
+                if node is candidates[-1]:
+                    raise
+                COMPUTE_NODE_FAILOVERS.inc(node=node.name)
+        raise AssertionError('unreachable')
+
 
+@lru_cache(maxsize=1024)
+def _rendezvous_order(routing_key: str, node_names: tuple[str, ...]) -> list[int]:
+    # Rendezvous (highest random weight) hashing: removing a node only moves the keys of that node
+    def weight(i: int) -> bytes:
+        return sha256(f'{node_names[i]}|{routing_key}'.encode()).digest()
 
-async def fetch_compute_key_info(request, settings):
-    with open(settings.user_public_key_path, 'r') as user_public_key:
-        client = request.state.client
+    return sorted(range(len(node_names)), key=weight, reverse=True)
 
-        url = f'https://{settings.compute_host}:{settings.compute_port}/get_compute_key_info'
-        payload = ComputeKeyInfoParams(crypt4gh_user_public_key=user_public_key.read())
 
-        response = await client.post(url, json=payload.dict())
-        response.raise_for_status()
+async def fetch_compute_key_info(request):
+    user_public_key: str = request.state.user_private_key.public_key
+    router: ComputeNodeRouter = request.state.compute_router
+    cache = request.state.compute_key_info_cache
 
-    return parse_obj_as(ComputeKeyInfoResponse, response.json())
+    # Compute keypairs are specific to the node issuing them, so key info is cached per node
+    return await router.request(
+        user_public_key,
+        lambda node: cache.get((node.host, node.port, user_public_key),
+                               lambda: node.get_compute_key_info(user_public_key)))
@@ -0,0 +1,121 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import signal
+from typing import Any, Callable, Optional, TypeVar
+
+from crypt4gh_recryptor_service.metrics import CRYPTO_EXECUTOR_JOBS
+from crypt4gh_recryptor_service.util import available_cpus
+
+T = TypeVar('T')
+
+
+class CryptoExecutorSaturatedError(RuntimeError):
+    ...
+
+
+def _init_worker(initializer: Optional[Callable[..., None]], initargs: tuple[Any, ...]):
+    # Shutdown is driven by the server process. A Ctrl+C sent to the whole process group should
+    # not interrupt the workers halfway through a job.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Import the crypto libraries up front, to keep the import cost off the first jobs
+    import crypt4gh.header  # noqa: F401
+    import crypt4gh.keys.c4gh  # noqa: F401
+    import crypt4gh_recryptor_service.crypt  # noqa: F401
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def _warm_up() -> None:
+    return None
+
+
+class CryptoExecutor:
+    # Long-lived pool of worker processes for the CPU-bound crypto operations, keeping them off
+    # the event loop and out of the GIL. Jobs beyond `max_workers` wait in a queue of at most
+    # `max_queue` jobs. Further jobs are rejected, to keep latency bounded under overload.
+    def __init__(self,
+                 max_workers: int = 0,
+                 max_queue: int = 0,
+                 initializer: Optional[Callable[..., None]] = None,
+                 initargs: tuple[Any, ...] = ()):
+        self._max_workers = max_workers or available_cpus()
+        self._initializer = initializer
+        self._initargs = initargs
+        self._max_pending = self._max_workers + max_queue
+        self._pending = 0
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    @property
+    def max_workers(self) -> int:
+        return self._max_workers
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def _new_pool(self) -> ProcessPoolExecutor:
+        # Spawned rather than forked, as the server process is multi-threaded
+        return ProcessPoolExecutor(
+            self._max_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(self._initializer, self._initargs))
+
+    async def _start_workers(self, pool: ProcessPoolExecutor):
+        # Worker processes are started on demand. Submitting a job per worker starts them all.
+        await asyncio.gather(
+            *(asyncio.wrap_future(pool.submit(_warm_up)) for _ in range(self._max_workers)))
+
+    async def start(self):
+        self._pool = self._new_pool()
+        await self._start_workers(self._pool)
+
+    async def restart(self):
+        # Replaces the workers, e.g. to have them load a replaced private key. The new workers
+        # take the new jobs, while jobs already running complete on the previous workers.
+        pool = self._new_pool()
+        try:
+            await self._start_workers(pool)
+        except BaseException:
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+        previous_pool, self._pool = self._pool, pool
+        if previous_pool is not None:
+            await asyncio.to_thread(previous_pool.shutdown)
+
+    async def stop(self):
+        if self._pool is not None:
+            pool, self._pool = self._pool, None
+            await asyncio.to_thread(pool.shutdown, cancel_futures=True)
+
+    async def run(self, func: Callable[..., T], *args: Any, bounded: bool = True) -> T:
+        # Background jobs (e.g. refilling the keypair pool) are not bounded, as they are not
+        # waited upon by clients
+        job = func.__name__
+        if bounded and self._pending >= self._max_pending:
+            CRYPTO_EXECUTOR_JOBS.inc(job=job, result='rejected')
+            raise CryptoExecutorSaturatedError(f'Crypto executor is saturated ({self._pending} '
+                                               f'jobs pending)')
+        if self._pool is None:
+            self._pool = self._new_pool()
+
+        self._pending += 1
+        pool = self._pool
+        try:
+            result = await asyncio.wrap_future(pool.submit(func, *args))
+        except BrokenProcessPool:
+            # A worker died (e.g. killed by the OOM killer). Replace the pool for the next jobs.
+            CRYPTO_EXECUTOR_JOBS.inc(job=job, result='failed')
+            if self._pool is pool:
+                self._pool = None
+                pool.shutdown(wait=False)
+            raise
+        except Exception:
+            CRYPTO_EXECUTOR_JOBS.inc(job=job, result='error')
+            raise
+        finally:
+            self._pending -= 1
+        CRYPTO_EXECUTOR_JOBS.inc(job=job, result='completed')
+        return result
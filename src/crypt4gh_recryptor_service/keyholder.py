@@ -0,0 +1,178 @@
+import asyncio
+from contextlib import asynccontextmanager
+import ctypes
+import ctypes.util
+import logging
+import multiprocessing.util
+import os
+from pathlib import Path
+import threading
+from typing import Awaitable, Callable, Optional
+
+from crypt4gh.keys import get_private_key
+
+logger = logging.getLogger(__name__)
+
+
+def _mlock(buffer: bytearray) -> bool:
+    # Best effort: keep the key out of swap where the platform allows it
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        address = ctypes.addressof((ctypes.c_char * len(buffer)).from_buffer(buffer))
+        return libc.mlock(ctypes.c_void_p(address), ctypes.c_size_t(len(buffer))) == 0
+    except (AttributeError, OSError, TypeError):
+        return False
+
+
+def load_private_key(private_key_path: Path, passphrase: str) -> bytes:
+    try:
+        return get_private_key(private_key_path, lambda: passphrase)
+    except SystemExit as e:
+        # crypt4gh exits the interpreter on an invalid key or passphrase
+        raise ValueError(f'Unable to unlock private key "{private_key_path}"') from e
+
+
+def _zero(buffer: bytearray):
+    for i in range(len(buffer)):
+        buffer[i] = 0
+
+
+def _stat_signature(*paths: Path) -> tuple[int, ...]:
+    signature: tuple[int, ...] = ()
+    for path in paths:
+        stat = os.stat(path)
+        signature += (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    return signature
+
+
+class PrivateKeyHolder:
+    # Holds the unlocked private key, and optionally the public key of the same keypair, so that
+    # both are replaced together when the key files change
+    def __init__(self,
+                 private_key_path: Path,
+                 passphrase: str,
+                 public_key_path: Optional[Path] = None):
+        self._path = private_key_path
+        self._passphrase = passphrase
+        self._public_key_path = public_key_path
+        self._key: Optional[bytearray] = None
+        self._public_key: Optional[str] = None
+        self._signature: Optional[tuple[int, ...]] = None
+        self._lock = threading.Lock()
+
+    @property
+    def public_key(self) -> str:
+        assert self._public_key is not None
+        return self._public_key
+
+    def _key_paths(self) -> tuple[Path, ...]:
+        if self._public_key_path is None:
+            return self._path,
+        return self._path, self._public_key_path
+
+    @property
+    def path(self) -> Path:
+        return self._path
+
+    @property
+    def is_unlocked(self) -> bool:
+        return self._key is not None
+
+    def get(self) -> bytearray:
+        # Never checks the key file, so that it can be called on the request path once unlocked.
+        # Changes to the key file are picked up by `reload_if_changed()`.
+        key = self._key
+        if key is not None:
+            return key
+        with self._lock:
+            if self._key is None:
+                self._unlock(_stat_signature(*self._key_paths()))
+            assert self._key is not None
+            return self._key
+
+    def load_public_key(self) -> str:
+        # Reads the public key without unlocking the private key, for processes leaving the use of
+        # the private key to others (e.g. the crypto executor workers)
+        with self._lock:
+            if self._public_key is None:
+                self._read_public_key(_stat_signature(*self._key_paths()))
+            return self.public_key
+
+    def reload_if_changed(self) -> bool:
+        # Reloads what was loaded before: the unlocked private key, or only the public key
+        signature = _stat_signature(*self._key_paths())
+        with self._lock:
+            if self._signature is None or signature == self._signature:
+                return False
+            if self._key is None:
+                self._read_public_key(signature)
+            else:
+                self._unlock(signature)
+            return True
+
+    def _read_public_key(self, signature: tuple[int, ...]):
+        assert self._public_key_path is not None
+        self._public_key = self._public_key_path.read_text()
+        self._signature = signature
+
+    def _unlock(self, signature: tuple[int, ...]):
+        key = bytearray(load_private_key(self._path, self._passphrase))
+        _mlock(key)
+        if self._public_key_path is not None:
+            self._public_key = self._public_key_path.read_text()
+        if self._key is not None:
+            _zero(self._key)
+        self._key = key
+        self._signature = signature
+
+    def wipe(self):
+        with self._lock:
+            if self._key is not None:
+                _zero(self._key)
+            self._key = None
+            self._signature = None
+
+
+@asynccontextmanager
+async def reload_private_key_periodically(private_key: PrivateKeyHolder,
+                                          interval_secs: float,
+                                          on_reload: Optional[Callable[[],
+                                                                       Awaitable[None]]] = None):
+    # Picks up a replaced private key file, off the request path
+    async def _reload():
+        while True:
+            await asyncio.sleep(interval_secs)
+            try:
+                reloaded = await asyncio.to_thread(private_key.reload_if_changed)
+            except (OSError, ValueError):
+                continue  # Keep the current key until the key file is valid again
+            if reloaded and on_reload is not None:
+                try:
+                    await on_reload()
+                except Exception:
+                    logger.exception('Unable to apply the reloaded private key')
+
+    task = asyncio.create_task(_reload())
+    try:
+        yield {}
+    finally:
+        task.cancel()
+
+
+# Crypto executor workers unlock their own copy of the private key once, at worker startup, so that
+# the key is never sent along with the jobs
+_worker_private_key: Optional[PrivateKeyHolder] = None
+
+
+def init_worker_private_key(private_key_path: Path, passphrase: str):
+    global _worker_private_key
+    _worker_private_key = PrivateKeyHolder(private_key_path, passphrase)
+    _worker_private_key.get()
+    # Run when the worker process exits
+    multiprocessing.util.Finalize(_worker_private_key, _worker_private_key.wipe, exitpriority=0)
+
+
+def worker_private_key() -> bytearray:
+    if _worker_private_key is None:
+        raise RuntimeError('No private key is loaded in this process')
+    return _worker_private_key.get()
@@ -0,0 +1,152 @@
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+import logging
+from pathlib import Path
+import shutil
+import threading
+from typing import Optional
+
+from crypt4gh_recryptor_service.metrics import CACHE_LOOKUPS
+from crypt4gh_recryptor_service.retention import record_reclaimed
+from crypt4gh_recryptor_service.util import list_sharded, shard_path, TEMP_FILE_PREFIX
+
+logger = logging.getLogger(__name__)
+
+
+def _exp_date(exp_date_dir: Path) -> Optional[datetime]:
+    # Entries that are not expiration date directories (e.g. left behind by other programs or
+    # by operators) are skipped, rather than failing lookups and sweeps
+    if exp_date_dir.name.startswith(TEMP_FILE_PREFIX):
+        return None
+    try:
+        return datetime.fromisoformat(exp_date_dir.name)
+    except ValueError:
+        logger.warning('Skipping unexpected entry in compute keys dir: %s', exp_date_dir)
+        return None
+
+
+@dataclass(frozen=True)
+class ComputeKeyEntry:
+    key_id: str
+    expiration_date: str
+    expires_at: datetime
+
+    @classmethod
+    def from_dir_names(cls, exp_date_dir_name: str, key_id_dir_name: str) -> 'ComputeKeyEntry':
+        return cls(key_id_dir_name, exp_date_dir_name, datetime.fromisoformat(exp_date_dir_name))
+
+    def is_expired(self, now: Optional[datetime] = None) -> bool:
+        return self.expires_at <= (now or datetime.now())
+
+
+class ComputeKeyIndex:
+    # In-memory index from user public key hash to the current compute keypair. The
+    # `compute_keys/ab/cd/<user key hash>/<expiration date>/<key id>/` directory tree remains the
+    # source of truth, so that keys created by other workers are picked up on index misses.
+    def __init__(self, compute_keys_dir: Path):
+        self._dir = compute_keys_dir
+        self._entries: dict[str, ComputeKeyEntry] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def user_dir(self, user_key_hash: str) -> Path:
+        return shard_path(self._dir, user_key_hash)
+
+    def key_id_dir(self, user_key_hash: str, entry: ComputeKeyEntry) -> Path:
+        return self.user_dir(user_key_hash).joinpath(entry.expiration_date, entry.key_id)
+
+    def load(self) -> int:
+        entries = {}
+        if self._dir.exists():
+            now = datetime.now()
+            for user_dir in list_sharded(self._dir):
+                if entry := self._scan_user_dir(user_dir, now):
+                    entries[user_dir.name] = entry
+        with self._lock:
+            self._entries = entries
+        return len(entries)
+
+    def lookup(self, user_key_hash: str) -> Optional[ComputeKeyEntry]:
+        now = datetime.now()
+        entry = self._entries.get(user_key_hash)
+        if entry is None or entry.is_expired(now):
+            CACHE_LOOKUPS.inc(cache='compute_key_index', result='miss')
+            # Index miss: the key might have been created by another worker
+            entry = self._scan_user_dir(self.user_dir(user_key_hash), now)
+            with self._lock:
+                if entry:
+                    self._entries[user_key_hash] = entry
+                else:
+                    self._entries.pop(user_key_hash, None)
+        else:
+            CACHE_LOOKUPS.inc(cache='compute_key_index', result='hit')
+        return entry
+
+    def add(self, user_key_hash: str, entry: ComputeKeyEntry):
+        with self._lock:
+            self._entries[user_key_hash] = entry
+
+    def discard(self, user_key_hash: str):
+        with self._lock:
+            self._entries.pop(user_key_hash, None)
+
+    def prune_expired(self, retention_after_expiry_secs: int = 0) -> int:
+        # Removes expired keypair directories from disk and index, keeping them for the given
+        # period after expiry so that recently issued keys can still be used
+        if not self._dir.exists():
+            return 0
+
+        cutoff = datetime.now() - timedelta(seconds=retention_after_expiry_secs)
+        num_pruned = sum(
+            self._prune_user_dir(user_dir, cutoff) for user_dir in list_sharded(self._dir))
+
+        now = datetime.now()
+        with self._lock:
+            for user_key_hash, entry in list(self._entries.items()):
+                if entry.is_expired(now):
+                    del self._entries[user_key_hash]
+        return num_pruned
+
+    def _prune_user_dir(self, user_dir: Path, cutoff: datetime) -> int:
+        try:
+            exp_date_dirs = list(user_dir.iterdir())
+        except FileNotFoundError:
+            return 0  # Removed by another worker
+
+        num_pruned = 0
+        for exp_date_dir in exp_date_dirs:
+            exp_date = _exp_date(exp_date_dir)
+            if exp_date is not None and exp_date <= cutoff:
+                # Other workers might be pruning the same directories
+                shutil.rmtree(exp_date_dir, ignore_errors=True)
+                record_reclaimed(self._dir, 'expired')
+                num_pruned += 1
+        try:
+            # Only succeeds if no keypairs are left for the user
+            user_dir.rmdir()
+        except OSError:
+            pass
+        return num_pruned
+
+    @staticmethod
+    def _scan_user_dir(user_dir: Path, now: datetime) -> Optional[ComputeKeyEntry]:
+        # The current keypair is the one expiring last, with the lowest key id if several were
+        # committed (e.g. by rotation). Keypairs being committed are skipped.
+        try:
+            exp_date_dirs = sorted(user_dir.iterdir(), reverse=True)
+        except FileNotFoundError:
+            return None
+        for exp_date_dir in exp_date_dirs:
+            exp_date = _exp_date(exp_date_dir)
+            if exp_date is None:
+                continue
+            if exp_date <= now:
+                break
+            key_ids = sorted(path.name
+                             for path in exp_date_dir.iterdir()
+                             if not path.name.startswith(TEMP_FILE_PREFIX))
+            if key_ids:
+                return ComputeKeyEntry.from_dir_names(exp_date_dir.name, key_ids[0])
+        return None
@@ -0,0 +1,71 @@
+import asyncio
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+
+from crypt4gh_recryptor_service.crypt import async_generate_keypair, Keypair
+from crypt4gh_recryptor_service.executor import CryptoExecutor
+from crypt4gh_recryptor_service.metrics import KEYPAIR_GENERATIONS
+
+REFILL_RETRY_DELAY_SECS = 1.0
+
+
+class KeypairPool:
+    def __init__(self,
+                 size: int,
+                 passphrase: str,
+                 comment: str,
+                 executor: Optional[CryptoExecutor] = None):
+        self._size = size
+        self._passphrase = passphrase
+        self._comment = comment
+        self._executor = executor
+        self._queue: asyncio.Queue[Keypair] = asyncio.Queue(maxsize=max(size, 1))
+        self._refill_task: Optional[asyncio.Task] = None
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def available(self) -> int:
+        return self._queue.qsize()
+
+    def start(self):
+        if self._size > 0 and self._refill_task is None:
+            self._refill_task = asyncio.create_task(self._refill())
+
+    async def stop(self):
+        if self._refill_task is not None:
+            self._refill_task.cancel()
+            try:
+                await self._refill_task
+            except asyncio.CancelledError:
+                pass
+            self._refill_task = None
+
+    async def get(self) -> Keypair:
+        try:
+            return self._queue.get_nowait()
+        except asyncio.QueueEmpty:
+            # Pool drained (or disabled): fall back to generating the keypair on demand
+            KEYPAIR_GENERATIONS.inc(source='on_demand')
+            return await async_generate_keypair(self._passphrase, self._comment, self._executor)
+
+    def put_back(self, keypair: Keypair):
+        # Returns an unused keypair, e.g. when another worker stored its keypair first
+        try:
+            self._queue.put_nowait(keypair)
+        except asyncio.QueueFull:
+            pass
+
+    async def _refill(self):
+        while True:
+            try:
+                keypair = await async_generate_keypair(
+                    self._passphrase, self._comment, self._executor, background=True)
+            except BrokenProcessPool:
+                # The executor replaces its worker processes for the next job
+                await asyncio.sleep(REFILL_RETRY_DELAY_SECS)
+                continue
+            KEYPAIR_GENERATIONS.inc(source='pool')
+            await self._queue.put(keypair)
@@ -0,0 +1,327 @@
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+import os
+from pathlib import Path
+import secrets
+import sqlite3
+import threading
+import time
+from typing import NamedTuple, Optional
+
+from crypt4gh_recryptor_service.config import ComputeKeyStoreBackend, ComputeSettings
+from crypt4gh_recryptor_service.crypt import commit_keypair_dir, Keypair
+from crypt4gh_recryptor_service.keyindex import ComputeKeyEntry, ComputeKeyIndex
+from crypt4gh_recryptor_service.metrics import CACHE_LOOKUPS
+from crypt4gh_recryptor_service.retention import record_reclaimed
+from crypt4gh_recryptor_service.storage import ComputeKeyFile
+from crypt4gh_recryptor_service.util import file_lock
+from crypt4gh_recryptor_service.validators import to_iso
+
+KEY_ID_BYTES = 4
+COMPUTE_KEY_LOCK_STRIPE_CHARS = 3
+
+
+class StoredComputeKey(NamedTuple):
+    entry: ComputeKeyEntry
+    public_key: str
+
+
+def valid_for(stored: Optional[StoredComputeKey], secs: float) -> bool:
+    valid_until = datetime.now() + timedelta(seconds=secs)
+    return stored is not None and not stored.entry.is_expired(valid_until)
+
+
+class ComputeKeyStore(ABC):
+    # Stores the current compute keypair of each user public key (by hash), i.e. the one expiring
+    # last. Keypairs never change once stored, so the current keypairs are cached in memory. Cached
+    # keypairs are looked up again once about to expire, to pick up keypairs rotated by others.
+    def __init__(self,
+                 compute_key_id_prefix: str,
+                 compute_key_expiration_delta_secs: int,
+                 cache_refresh_ahead_secs: int = 0):
+        self._key_id_prefix = compute_key_id_prefix
+        self._expiration_delta = timedelta(seconds=compute_key_expiration_delta_secs)
+        self._cache_refresh_ahead_secs = cache_refresh_ahead_secs
+        self._cache: dict[str, StoredComputeKey] = {}
+        self._last_used: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def new_entry(self) -> ComputeKeyEntry:
+        exp_date_str = to_iso(datetime.now() + self._expiration_delta)
+        key_id = f'{self._key_id_prefix}{secrets.token_hex(KEY_ID_BYTES)}'
+        return ComputeKeyEntry.from_dir_names(exp_date_str, key_id)
+
+    def lookup_cached(self, user_key_hash: str) -> Optional[StoredComputeKey]:
+        # Never blocks, so it can be called from the event loop
+        stored = self._cache.get(user_key_hash)
+        if not valid_for(stored, self._cache_refresh_ahead_secs):
+            CACHE_LOOKUPS.inc(cache='compute_key_store', result='miss')
+            return None
+        CACHE_LOOKUPS.inc(cache='compute_key_store', result='hit')
+        return stored
+
+    def lookup(self, user_key_hash: str) -> Optional[StoredComputeKey]:
+        if stored := self.lookup_cached(user_key_hash):
+            return stored
+        stored = self._lookup(user_key_hash)
+        self._update_cache(user_key_hash, stored)
+        return stored
+
+    def create(self,
+               user_key_hash: str,
+               entry: ComputeKeyEntry,
+               keypair: Keypair,
+               min_remaining_secs: float = 0) -> StoredComputeKey:
+        # Compare-and-set: stores the keypair, unless the user already has a current keypair that
+        # remains valid for `min_remaining_secs` (e.g. created concurrently by another worker or
+        # replica). A new keypair rotates the current one. Returns the current keypair.
+        stored = self._create(user_key_hash, entry, keypair, min_remaining_secs)
+        self._update_cache(user_key_hash, stored)
+        return stored
+
+    def mark_used(self, user_key_hash: str):
+        self._last_used[user_key_hash] = time.monotonic()
+
+    def recently_used(self, within_secs: float) -> list[str]:
+        # User key hashes marked as used by this process within the given period
+        cutoff = time.monotonic() - within_secs
+        with self._lock:
+            for user_key_hash, last_used in list(self._last_used.items()):
+                if last_used < cutoff:
+                    del self._last_used[user_key_hash]
+            return list(self._last_used)
+
+    def discard(self, user_key_hash: str):
+        with self._lock:
+            self._cache.pop(user_key_hash, None)
+
+    def prune_expired(self, retention_after_expiry_secs: int = 0) -> int:
+        num_pruned = self._prune_expired(retention_after_expiry_secs)
+        now = datetime.now()
+        with self._lock:
+            for user_key_hash, stored in list(self._cache.items()):
+                if stored.entry.is_expired(now):
+                    del self._cache[user_key_hash]
+        return num_pruned
+
+    def _update_cache(self, user_key_hash: str, stored: Optional[StoredComputeKey]):
+        with self._lock:
+            if stored is None:
+                self._cache.pop(user_key_hash, None)
+            else:
+                self._cache[user_key_hash] = stored
+
+    @abstractmethod
+    def load(self) -> int:
+        ...
+
+    def close(self):
+        pass
+
+    @abstractmethod
+    def _lookup(self, user_key_hash: str) -> Optional[StoredComputeKey]:
+        ...
+
+    @abstractmethod
+    def _create(self,
+                user_key_hash: str,
+                entry: ComputeKeyEntry,
+                keypair: Keypair,
+                min_remaining_secs: float) -> StoredComputeKey:
+        ...
+
+    @abstractmethod
+    def _prune_expired(self, retention_after_expiry_secs: int) -> int:
+        ...
+
+
+class FileSystemComputeKeyStore(ComputeKeyStore):
+    # Keypairs in the local `compute_keys/` tree, shared by the workers of a node. Creations are
+    # serialized between the workers by file locks, striped by user key hash.
+    def __init__(self,
+                 compute_keys_dir: Path,
+                 locks_dir: Path,
+                 compute_key_id_prefix: str,
+                 compute_key_expiration_delta_secs: int,
+                 cache_refresh_ahead_secs: int = 0):
+        super().__init__(compute_key_id_prefix,
+                         compute_key_expiration_delta_secs,
+                         cache_refresh_ahead_secs)
+        self._dir = compute_keys_dir
+        self._locks_dir = locks_dir
+        self._index = ComputeKeyIndex(compute_keys_dir)
+
+    def load(self) -> int:
+        return self._index.load()
+
+    def _key_files(self, user_key_hash: str,
+                   entry: ComputeKeyEntry) -> tuple[ComputeKeyFile, ComputeKeyFile]:
+        return (ComputeKeyFile(self._dir, user_key_hash, entry, public=True),
+                ComputeKeyFile(self._dir, user_key_hash, entry, public=False))
+
+    def _lookup(self, user_key_hash: str) -> Optional[StoredComputeKey]:
+        if (entry := self._index.lookup(user_key_hash)) is None:
+            return None
+        public_key_file, _ = self._key_files(user_key_hash, entry)
+        try:
+            public_key_file.read_from_storage()
+        except FileNotFoundError:
+            # Pruned by another worker since it was indexed
+            self._index.discard(user_key_hash)
+            return None
+        return StoredComputeKey(entry, public_key_file.contents)
+
+    def _create(self,
+                user_key_hash: str,
+                entry: ComputeKeyEntry,
+                keypair: Keypair,
+                min_remaining_secs: float) -> StoredComputeKey:
+        # Lookups stay lock-free. Lock stripes are shared by all workers, and bound the number of
+        # lock files.
+        lock_path = self._locks_dir.joinpath(
+            f'compute_key_{user_key_hash[:COMPUTE_KEY_LOCK_STRIPE_CHARS]}.lock')
+        with file_lock(lock_path):
+            # Another worker might have created the keypair while we waited for the lock
+            self._index.discard(user_key_hash)
+            stored = self._lookup(user_key_hash)
+            if valid_for(stored, min_remaining_secs):
+                return stored
+            public_key_file, private_key_file = self._key_files(user_key_hash, entry)
+            commit_keypair_dir(keypair, private_key_file.path, public_key_file.path)
+            self._index.discard(user_key_hash)
+            stored = self._lookup(user_key_hash)
+            assert stored is not None
+            return stored
+
+    def _prune_expired(self, retention_after_expiry_secs: int) -> int:
+        return self._index.prune_expired(retention_after_expiry_secs)
+
+
+class SqliteComputeKeyStore(ComputeKeyStore):
+    # Keypairs in a SQLite database, which can be shared by the workers of a node and by replicas
+    # using shared storage. Creation runs in a write transaction, so that exactly one keypair is
+    # stored per user. The rollback journal is used by default, which works on shared storage.
+    # WAL mode is faster, but requires all processes to run on the same host.
+    def __init__(self,
+                 db_path: Path,
+                 compute_key_id_prefix: str,
+                 compute_key_expiration_delta_secs: int,
+                 cache_refresh_ahead_secs: int = 0,
+                 wal: bool = False,
+                 busy_timeout_secs: float = 10.0):
+        super().__init__(compute_key_id_prefix,
+                         compute_key_expiration_delta_secs,
+                         cache_refresh_ahead_secs)
+        self._db_path = db_path
+        self._wal = wal
+        self._busy_timeout_secs = busy_timeout_secs
+        self._local = threading.local()
+        self._connections: list[sqlite3.Connection] = []
+
+    def _connection(self) -> sqlite3.Connection:
+        # One connection per thread, in autocommit mode with explicit transactions
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            if not self._db_path.exists():
+                # Keep the private keys readable by the owner only
+                os.close(os.open(self._db_path, os.O_WRONLY | os.O_CREAT, 0o600))
+            connection = sqlite3.connect(
+                self._db_path,
+                timeout=self._busy_timeout_secs,
+                isolation_level=None,
+                check_same_thread=False)
+            connection.execute('PRAGMA synchronous = FULL')
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def load(self) -> int:
+        connection = self._connection()
+        connection.execute(f'PRAGMA journal_mode = {"WAL" if self._wal else "DELETE"}')
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS compute_keys (
+                user_key_hash TEXT NOT NULL,
+                key_id TEXT NOT NULL,
+                expiration_date TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                public_key TEXT NOT NULL,
+                private_key BLOB NOT NULL,
+                PRIMARY KEY (user_key_hash, key_id)
+            )""")
+        connection.execute("""
+            CREATE INDEX IF NOT EXISTS compute_keys_expiry
+            ON compute_keys (user_key_hash, expires_at)""")
+        return connection.execute(
+            'SELECT COUNT(DISTINCT user_key_hash) FROM compute_keys '
+            'WHERE expires_at > ?', (datetime.now().timestamp(),)).fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections.clear()
+
+    def _select_current(self, connection: sqlite3.Connection,
+                        user_key_hash: str) -> Optional[StoredComputeKey]:
+        row = connection.execute(
+            'SELECT expiration_date, key_id, public_key FROM compute_keys '
+            'WHERE user_key_hash = ? AND expires_at > ? '
+            'ORDER BY expires_at DESC, key_id LIMIT 1',
+            (user_key_hash, datetime.now().timestamp())).fetchone()
+        if row is None:
+            return None
+        expiration_date, key_id, public_key = row
+        return StoredComputeKey(ComputeKeyEntry.from_dir_names(expiration_date, key_id), public_key)
+
+    def _lookup(self, user_key_hash: str) -> Optional[StoredComputeKey]:
+        return self._select_current(self._connection(), user_key_hash)
+
+    def _create(self,
+                user_key_hash: str,
+                entry: ComputeKeyEntry,
+                keypair: Keypair,
+                min_remaining_secs: float) -> StoredComputeKey:
+        connection = self._connection()
+        # Takes the database write lock, serializing creations across processes
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            stored = self._select_current(connection, user_key_hash)
+            if not valid_for(stored, min_remaining_secs):
+                stored = StoredComputeKey(entry, keypair.public_key.decode())
+                connection.execute('INSERT INTO compute_keys VALUES (?, ?, ?, ?, ?, ?)',
+                                   (user_key_hash,
+                                    entry.key_id,
+                                    entry.expiration_date,
+                                    entry.expires_at.timestamp(),
+                                    stored.public_key,
+                                    keypair.private_key))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return stored
+
+    def _prune_expired(self, retention_after_expiry_secs: int) -> int:
+        cutoff = datetime.now() - timedelta(seconds=retention_after_expiry_secs)
+        cursor = self._connection().execute('DELETE FROM compute_keys WHERE expires_at <= ?',
+                                            (cutoff.timestamp(),))
+        if cursor.rowcount:
+            record_reclaimed(self._db_path, 'expired', num_files=cursor.rowcount)
+        return cursor.rowcount
+
+
+def create_compute_key_store(settings: ComputeSettings) -> ComputeKeyStore:
+    # Cached keypairs are looked up again within the rotation period, to pick up rotated keypairs
+    if settings.compute_key_store == ComputeKeyStoreBackend.SQLITE:
+        return SqliteComputeKeyStore(settings.compute_key_store_sqlite_file_path,
+                                     settings.compute_key_id_prefix,
+                                     settings.compute_key_expiration_delta_secs,
+                                     settings.compute_key_rotation_ahead_secs,
+                                     settings.compute_key_store_sqlite_wal,
+                                     settings.compute_key_store_sqlite_busy_timeout_secs)
+    return FileSystemComputeKeyStore(settings.compute_keys_dir,
+                                     settings.locks_dir,
+                                     settings.compute_key_id_prefix,
+                                     settings.compute_key_expiration_delta_secs,
+                                     settings.compute_key_rotation_ahead_secs)
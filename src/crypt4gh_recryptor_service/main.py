@@ -3,17 +3,49 @@ from pathlib import Path
 from typing import cast
 
 from crypt4gh_recryptor_service.cert import generate_uvicorn_ssl_cert_options, setup_ssl_cert
-from crypt4gh_recryptor_service.config import get_settings, ServerMode, setup_files, UserSettings
+from crypt4gh_recryptor_service.config import (ComputeSettings,
+                                               get_settings,
+                                               ServerMode,
+                                               setup_files,
+                                               UserSettings)
 from crypt4gh_recryptor_service.crypt import crypt4gh_generate_keypair
-from crypt4gh_recryptor_service.util import run_in_subprocess
+from crypt4gh_recryptor_service.executor import CryptoExecutor
+from crypt4gh_recryptor_service.keystore import create_compute_key_store
+from crypt4gh_recryptor_service.provisioning import provision_user_public_keys
+from crypt4gh_recryptor_service.storage import migrate_to_sharded_layout
 import typer
+import uvicorn
+from uvicorn.main import STARTUP_FAILURE
+from uvicorn.supervisors import ChangeReload, Multiprocess
 
 app = typer.Typer()
 
 
+def _run_server(config: uvicorn.Config):
+    # As uvicorn.run(), but in-process, without the uvicorn command line in between
+    server = uvicorn.Server(config)
+    if config.should_reload:
+        ChangeReload(config, target=server.run, sockets=[config.bind_socket()]).run()
+    elif config.workers > 1:
+        Multiprocess(config, target=server.run, sockets=[config.bind_socket()]).run()
+    else:
+        server.run()
+
+    if not server.started and not config.should_reload and config.workers == 1:
+        raise typer.Exit(code=STARTUP_FAILURE)
+
+
+def _migrate_storage(server_mode: ServerMode):
+    paths = get_settings(server_mode).paths
+    for dir in (paths.user_keys_dir, paths.compute_keys_dir, paths.headers_dir):
+        if num_migrated := migrate_to_sharded_layout(dir):
+            print(f'Migrated {num_migrated} entries of "{dir}" to the sharded layout')
+
+
 def _setup_and_run(server_mode: ServerMode):
     setup_files(server_mode)
     settings = get_settings(server_mode)
+    _migrate_storage(server_mode)
 
     if settings.use_https:
         setup_ssl_cert(settings)
@@ -32,17 +64,26 @@ def _setup_and_run(server_mode: ServerMode):
                     Path(private_key),
                     Path(public_key),
                     settings.private_key_passphrase,
-                    settings.private_key_comment,
-                    verbose=settings.dev_mode))
+                    settings.private_key_comment))
         for key_path in keypair_paths:
             if not key_path.exists():
                 raise ValueError(f'User key file "{key_path}" is missing!')
 
-    run_in_subprocess(
-        f'uvicorn --host {settings.host} --port {settings.port} '
-        f'{uvicorn_ssl_options}{"--reload " if settings.dev_mode else "--workers 4 "}'
-        f'--app-dir {Path(__file__).parent} {server_mode.value}:app',
-        verbose=settings.dev_mode)
+    config = uvicorn.Config(
+        f'crypt4gh_recryptor_service.{server_mode.value}:app',
+        host=settings.host,
+        port=settings.port,
+        loop=settings.server_loop,
+        http=settings.server_http,
+        workers=settings.effective_server_workers,
+        reload=settings.dev_mode,
+        reload_dirs=[str(Path(__file__).parent)] if settings.dev_mode else None,
+        backlog=settings.server_backlog,
+        timeout_keep_alive=settings.server_keep_alive_timeout_secs,
+        limit_concurrency=settings.server_limit_concurrency,
+        **uvicorn_ssl_options,
+    )
+    _run_server(config)
 
 
 @app.command()
@@ -57,5 +98,43 @@ def compute():
     _setup_and_run(ServerMode.COMPUTE)
 
 
+@app.command()
+def migrate(server_mode: ServerMode):
+    """Migrates the working dir of a stopped server to the current storage layout"""
+    setup_files(server_mode)
+    _migrate_storage(server_mode)
+
+
+async def _provision_compute_keys(settings: ComputeSettings,
+                                  user_public_keys: list[str],
+                                  rotate: bool):
+    store = create_compute_key_store(settings)
+    store.load()
+    # All CPUs are available, as the server is not sharing them
+    crypto_executor = CryptoExecutor(settings.crypto_executor_workers)
+    await crypto_executor.start()
+    try:
+        return await provision_user_public_keys(store,
+                                                settings,
+                                                user_public_keys,
+                                                rotate,
+                                                crypto_executor)
+    finally:
+        await crypto_executor.stop()
+        store.close()
+
+
+@app.command()
+def provision_compute_keys(user_public_key_files: list[Path], rotate: bool = False):
+    """Pre-generates compute keypairs for the given user public key files"""
+    setup_files(ServerMode.COMPUTE)
+    settings = cast(ComputeSettings, get_settings(ServerMode.COMPUTE))
+    user_public_keys = [key_file.read_text() for key_file in user_public_key_files]
+    stored_keys = asyncio.run(_provision_compute_keys(settings, user_public_keys, rotate))
+    for key_file, stored in zip(user_public_key_files, stored_keys):
+        print(f'{key_file}: compute keypair {stored.entry.key_id} '
+              f'expiring {stored.entry.expiration_date}')
+
+
 if __name__ == '__main__':
     app()
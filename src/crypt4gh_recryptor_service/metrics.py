@@ -0,0 +1,275 @@
+import asyncio
+from contextlib import asynccontextmanager, contextmanager
+import json
+import os
+from pathlib import Path
+import tempfile
+import threading
+import time
+from typing import Any, Iterator, Optional
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (0.0005,
+                   0.001,
+                   0.0025,
+                   0.005,
+                   0.01,
+                   0.025,
+                   0.05,
+                   0.1,
+                   0.25,
+                   0.5,
+                   1.0,
+                   2.5,
+                   5.0,
+                   10.0)
+
+# Metrics are kept per process. To aggregate across uvicorn workers, each worker regularly
+# writes a snapshot to `<working_dir>/metrics/<pid>.json`, and the worker serving `/metrics`
+# sums up the snapshots of all workers.
+_REGISTRY: list['_Metric'] = []
+
+
+class _Metric:
+    type = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: dict[tuple[str, ...], Any] = {}
+        self._lock = threading.Lock()
+        _REGISTRY.append(self)
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        return tuple(str(labels[labelname]) for labelname in self.labelnames)
+
+    def snapshot(self) -> dict[str, Any]:
+        with self._lock:
+            samples = [[list(key), value] for key, value in self._values.items()]
+        return {
+            'type': self.type,
+            'help': self.documentation,
+            'labelnames': list(self.labelnames),
+            'samples': samples,
+        }
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self,
+                 name: str,
+                 documentation: str,
+                 labelnames: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            # Non-cumulative bucket counts (the last one being +Inf), followed by sum and count
+            values = self._values.setdefault(key, [0.0] * (len(self.buckets) + 3))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[i] += 1
+                    break
+            else:
+                values[len(self.buckets)] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def snapshot(self) -> dict[str, Any]:
+        return {**super().snapshot(), 'buckets': list(self.buckets)}
+
+
+REQUESTS = Counter('c4gh_recryptor_requests_total',
+                   'HTTP requests handled', ('method', 'path', 'status'))
+REQUEST_ERRORS = Counter('c4gh_recryptor_request_errors_total',
+                         'HTTP requests answered with an error status',
+                         ('method', 'path', 'status'))
+REQUEST_SECONDS = Histogram('c4gh_recryptor_request_duration_seconds',
+                            'HTTP request latency', ('method', 'path'))
+STAGE_SECONDS = Histogram('c4gh_recryptor_stage_duration_seconds',
+                          'Latency of the individual stages of request handling', ('stage',))
+SUBPROCESS_SPAWNS = Counter('c4gh_recryptor_subprocess_spawns_total',
+                            'Subprocesses spawned', ('command',))
+SUBPROCESS_SPAWN_SECONDS = Histogram('c4gh_recryptor_subprocess_spawn_duration_seconds',
+                                     'Time taken to spawn a subprocess', ('command',))
+SUBPROCESS_QUEUE_SECONDS = Histogram('c4gh_recryptor_subprocess_queue_duration_seconds',
+                                     'Time spent waiting for a free subprocess slot', ('command',))
+SUBPROCESS_TIMEOUTS = Counter('c4gh_recryptor_subprocess_timeouts_total',
+                              'Subprocesses killed or not started due to a timeout', ('command',))
+CACHE_LOOKUPS = Counter('c4gh_recryptor_cache_lookups_total',
+                        'Cache lookups, by cache and result (hit, miss or coalesced)',
+                        ('cache', 'result'))
+COMPUTE_HEALTH_CHECKS = Counter('c4gh_recryptor_compute_health_checks_total',
+                                'Health checks of the compute nodes, by node and result',
+                                ('node', 'result'))
+COMPUTE_NODE_FAILOVERS = Counter('c4gh_recryptor_compute_node_failovers_total',
+                                 'Requests failed over to another compute node, by failed node',
+                                 ('node',))
+CRYPTO_EXECUTOR_JOBS = Counter('c4gh_recryptor_crypto_executor_jobs_total',
+                               'Jobs submitted to the crypto executor, by job and result',
+                               ('job', 'result'))
+RETENTION_RECLAIMED_FILES = Counter(
+    'c4gh_recryptor_retention_reclaimed_files_total',
+    'Files and keypair directories deleted by the retention '
+    'policies, by directory and reason', ('directory', 'reason'))
+RETENTION_RECLAIMED_BYTES = Counter('c4gh_recryptor_retention_reclaimed_bytes_total',
+                                    'Bytes reclaimed by the retention policies, by directory',
+                                    ('directory',))
+KEYPAIR_GENERATIONS = Counter('c4gh_recryptor_keypair_generations_total',
+                              'Keypairs generated, by where the generation happened', ('source',))
+
+
+def snapshot() -> dict[str, dict[str, Any]]:
+    return {metric.name: metric.snapshot() for metric in _REGISTRY}
+
+
+def write_snapshot(metrics_dir: Path):
+    if not metrics_dir.exists():
+        return
+    fd, tmp_path = tempfile.mkstemp(dir=metrics_dir, prefix='.tmp-')
+    with os.fdopen(fd, 'w') as snapshot_file:
+        json.dump(snapshot(), snapshot_file)
+    os.replace(tmp_path, metrics_dir.joinpath(f'{os.getpid()}.json'))
+
+
+def _merge(merged: dict[str, dict[str, Any]], snapshot: dict[str, dict[str, Any]]):
+    for name, metric in snapshot.items():
+        merged_metric = merged.setdefault(name, {**metric, 'samples': {}})
+        for labelvalues, value in metric['samples']:
+            key = tuple(labelvalues)
+            if key not in merged_metric['samples']:
+                merged_metric['samples'][key] = value
+            elif isinstance(value, list):
+                merged_metric['samples'][key] = [
+                    a + b for a, b in zip(merged_metric['samples'][key], value)
+                ]
+            else:
+                merged_metric['samples'][key] += value
+
+
+def collect(metrics_dir: Optional[Path] = None) -> dict[str, dict[str, Any]]:
+    merged: dict[str, dict[str, Any]] = {}
+    if metrics_dir is not None and metrics_dir.exists():
+        for snapshot_path in metrics_dir.glob('*.json'):
+            try:
+                _merge(merged, json.loads(snapshot_path.read_text()))
+            except (OSError, ValueError):
+                pass  # Snapshot removed or replaced while reading
+    else:
+        _merge(merged, snapshot())
+    return merged
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format_labels(labelnames: list[str], labelvalues: tuple[str, ...], **extra: str) -> str:
+    pairs = list(zip(labelnames, labelvalues)) + list(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def render(merged: dict[str, dict[str, Any]]) -> str:
+    lines = []
+    for name, metric in sorted(merged.items()):
+        lines.append(f'# HELP {name} {metric["help"]}')
+        lines.append(f'# TYPE {name} {metric["type"]}')
+        labelnames = metric['labelnames']
+        for labelvalues, value in sorted(metric['samples'].items()):
+            if metric['type'] == 'histogram':
+                cumulative = 0.0
+                for bound, count in zip(metric['buckets'] + ['+Inf'], value):
+                    cumulative += count
+                    labels = _format_labels(labelnames, labelvalues, le=str(bound))
+                    lines.append(f'{name}_bucket{labels} {cumulative}')
+                labels = _format_labels(labelnames, labelvalues)
+                lines.append(f'{name}_sum{labels} {value[-2]}')
+                lines.append(f'{name}_count{labels} {value[-1]}')
+            else:
+                lines.append(f'{name}{_format_labels(labelnames, labelvalues)} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def render_metrics(metrics_dir: Path) -> str:
+    write_snapshot(metrics_dir)
+    return render(collect(metrics_dir if metrics_dir.exists() else None))
+
+
+@asynccontextmanager
+async def flush_metrics_periodically(metrics_dir: Path, interval_secs: float):
+    async def _flush():
+        while True:
+            await asyncio.sleep(interval_secs)
+            await asyncio.to_thread(write_snapshot, metrics_dir)
+
+    task = asyncio.create_task(_flush())
+    try:
+        yield {}
+    finally:
+        task.cancel()
+        write_snapshot(metrics_dir)
+
+
+class MetricsMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self._route_paths: Optional[set[str]] = None
+
+    def _path_label(self, scope: Scope) -> str:
+        # Unknown paths are grouped, to keep the number of label values bounded
+        if self._route_paths is None:
+            self._route_paths = {
+                route.path for route in scope['app'].routes if hasattr(route, 'path')
+            }
+        path = scope['path']
+        return path if path in self._route_paths else 'other'
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        method = scope['method']
+        path = self._path_label(scope)
+        status = 500
+
+        async def _send(message: Message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            REQUEST_SECONDS.observe(time.perf_counter() - start, method=method, path=path)
+            REQUESTS.inc(method=method, path=path, status=str(status))
+            if status >= 400:
+                REQUEST_ERRORS.inc(method=method, path=path, status=str(status))
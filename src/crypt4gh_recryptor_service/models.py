@@ -1,8 +1,8 @@
 from datetime import datetime
-from typing import Union
+from typing import Optional, Union
 
 from crypt4gh_recryptor_service.validators import to_iso
-from pydantic import BaseModel, Field, validator
+from pydantic import BaseModel, constr, Field, validator
 
 
 class ComputeKeyInfo(BaseModel):
@@ -20,6 +20,20 @@ class UserRecryptResponse(ComputeKeyInfo):
     crypt4gh_header: str = Field(..., min_length=1)
 
 
+class UserRecryptBatchParams(BaseModel):
+    crypt4gh_headers: list[constr(min_length=1)] = Field(..., min_items=1)  # type: ignore
+
+
+class UserRecryptBatchResult(BaseModel):
+    status_code: int
+    crypt4gh_header: Optional[str] = None
+    error: Optional[str] = None
+
+
+class UserRecryptBatchResponse(ComputeKeyInfo):
+    results: list[UserRecryptBatchResult]
+
+
 class ComputeKeyInfoParams(BaseModel):
     crypt4gh_user_public_key: str = Field(..., min_length=1)
 
@@ -28,6 +42,15 @@ class ComputeKeyInfoResponse(ComputeKeyInfo):
     crypt4gh_compute_public_key: str = Field(..., min_length=1)
 
 
+class ComputeKeyProvisionParams(BaseModel):
+    crypt4gh_user_public_keys: list[constr(min_length=1)] = Field(..., min_items=1)  # type: ignore
+    rotate: bool = False
+
+
+class ComputeKeyProvisionResponse(BaseModel):
+    compute_keys: list[ComputeKeyInfoResponse]
+
+
 # class ComputeRecryptParams(BaseModel):
 #     crypt4gh_header: str = Field(..., min_length=1)
 #
@@ -0,0 +1,97 @@
+import asyncio
+from contextlib import asynccontextmanager
+import sqlite3
+from typing import Optional
+
+from crypt4gh_recryptor_service.config import ComputeSettings
+from crypt4gh_recryptor_service.crypt import async_generate_keypair
+from crypt4gh_recryptor_service.executor import CryptoExecutor
+from crypt4gh_recryptor_service.keystore import ComputeKeyStore, StoredComputeKey, valid_for
+from crypt4gh_recryptor_service.metrics import KEYPAIR_GENERATIONS
+from crypt4gh_recryptor_service.storage import HashedStrFile
+
+
+async def provision_compute_keys(store: ComputeKeyStore,
+                                 user_key_hashes: list[str],
+                                 passphrase: str,
+                                 comment: str,
+                                 min_remaining_secs: float,
+                                 executor: Optional[CryptoExecutor] = None,
+                                 source: str = 'provisioning') -> list[StoredComputeKey]:
+    # Creates a keypair for each user key without a current keypair valid for at least
+    # `min_remaining_secs`, generating the keypairs in parallel on the crypto executor
+    semaphore = asyncio.Semaphore(executor.max_workers if executor is not None else 1)
+
+    async def provision(user_key_hash: str) -> StoredComputeKey:
+        async with semaphore:
+            stored = await asyncio.to_thread(store.lookup, user_key_hash)
+            if valid_for(stored, min_remaining_secs):
+                return stored
+            keypair = await async_generate_keypair(passphrase, comment, executor, background=True)
+            KEYPAIR_GENERATIONS.inc(source=source)
+            return await asyncio.to_thread(store.create,
+                                           user_key_hash,
+                                           store.new_entry(),
+                                           keypair,
+                                           min_remaining_secs)
+
+    return await asyncio.gather(*(provision(user_key_hash) for user_key_hash in user_key_hashes))
+
+
+def _store_user_public_keys(settings: ComputeSettings, user_public_keys: list[str]) -> list[str]:
+    return [
+        HashedStrFile(settings.user_keys_dir, user_public_key, write_to_storage=True).sha256
+        for user_public_key in user_public_keys
+    ]
+
+
+async def provision_user_public_keys(store: ComputeKeyStore,
+                                     settings: ComputeSettings,
+                                     user_public_keys: list[str],
+                                     rotate: bool = False,
+                                     executor: Optional[CryptoExecutor] = None,
+                                     source: str = 'provisioning') -> list[StoredComputeKey]:
+    # Pre-generates the keypairs of users without a keypair, or with a keypair due for rotation.
+    # With `rotate`, all keypairs are replaced.
+    user_key_hashes = await asyncio.to_thread(_store_user_public_keys, settings, user_public_keys)
+    min_remaining_secs = settings.compute_key_expiration_delta_secs if rotate \
+        else settings.compute_key_rotation_ahead_secs
+    return await provision_compute_keys(store,
+                                        user_key_hashes,
+                                        settings.private_key_passphrase,
+                                        settings.private_key_comment,
+                                        min_remaining_secs,
+                                        executor,
+                                        source)
+
+
+@asynccontextmanager
+async def rotate_compute_keys_periodically(store: ComputeKeyStore,
+                                           interval_secs: float,
+                                           rotation_ahead_secs: float,
+                                           active_within_secs: float,
+                                           passphrase: str,
+                                           comment: str,
+                                           executor: Optional[CryptoExecutor] = None):
+    # Rotates the keypairs of the users served recently by this process ahead of expiry, so that
+    # keypairs are (almost) never generated on the request path
+    async def _rotate():
+        while True:
+            await asyncio.sleep(interval_secs)
+            try:
+                await provision_compute_keys(
+                    store,
+                    store.recently_used(active_within_secs),
+                    passphrase,
+                    comment,
+                    rotation_ahead_secs,
+                    executor,
+                    source='rotation')
+            except (OSError, RuntimeError, sqlite3.Error):
+                pass  # Try again at the next rotation
+
+    task = asyncio.create_task(_rotate())
+    try:
+        yield {}
+    finally:
+        task.cancel()
@@ -0,0 +1,101 @@
+import asyncio
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+import os
+from pathlib import Path
+import time
+from typing import Callable
+
+from crypt4gh_recryptor_service.metrics import RETENTION_RECLAIMED_BYTES, RETENTION_RECLAIMED_FILES
+
+
+@dataclass(frozen=True)
+class RetentionPolicy:
+    # Zero means unlimited
+    max_age_secs: int = 0
+    max_count: int = 0
+    max_bytes: int = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.max_age_secs or self.max_count or self.max_bytes)
+
+
+def record_reclaimed(dir: Path, reason: str, num_files: int = 1, num_bytes: int = 0):
+    RETENTION_RECLAIMED_FILES.inc(num_files, directory=dir.name, reason=reason)
+    RETENTION_RECLAIMED_BYTES.inc(num_bytes, directory=dir.name)
+
+
+def _list_files(dir: Path) -> list[tuple[float, int, str]]:
+    # (modification time, size, path) of the files in `dir` and its shard directories, oldest
+    # first
+    files = []
+    dirs = [dir]
+    while dirs:
+        try:
+            entries = os.scandir(dirs.pop())
+        except FileNotFoundError:
+            continue  # Deleted in the meantime
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(Path(entry.path))
+                    elif entry.is_file(follow_symlinks=False):
+                        stat = entry.stat(follow_symlinks=False)
+                        files.append((stat.st_mtime, stat.st_size, entry.path))
+                except FileNotFoundError:
+                    pass  # Deleted in the meantime
+    files.sort()
+    return files
+
+
+def enforce_retention(dir: Path, policy: RetentionPolicy) -> int:
+    # Deletes the files in `dir`, oldest (by modification time) first, until all files
+    # are within the policy. As hashed files are touched when used, files in use stay young.
+    if not policy.enabled or not dir.exists():
+        return 0
+
+    files = _list_files(dir)
+    cutoff = time.time() - policy.max_age_secs if policy.max_age_secs else None
+    count = len(files)
+    total_bytes = sum(size for _, size, _ in files)
+    num_reclaimed = 0
+    for mtime, size, path in files:
+        if cutoff is not None and mtime <= cutoff:
+            reason = 'max_age'
+        elif policy.max_count and count > policy.max_count:
+            reason = 'max_count'
+        elif policy.max_bytes and total_bytes > policy.max_bytes:
+            reason = 'max_bytes'
+        else:
+            break
+
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass  # Other workers enforce the same policy
+        else:
+            record_reclaimed(dir, reason, num_bytes=size)
+            num_reclaimed += 1
+        count -= 1
+        total_bytes -= size
+    return num_reclaimed
+
+
+@asynccontextmanager
+async def collect_garbage_periodically(interval_secs: float, sweeps: list[Callable[[], object]]):
+    async def _collect():
+        while True:
+            await asyncio.sleep(interval_secs)
+            for sweep in sweeps:
+                try:
+                    await asyncio.to_thread(sweep)
+                except OSError:
+                    pass  # Try again at the next sweep
+
+    task = asyncio.create_task(_collect())
+    try:
+        yield {}
+    finally:
+        task.cancel()
@@ -1,35 +1,190 @@
-from abc import abstractmethod
+from abc import ABC, abstractmethod
 from base64 import b64decode, b64encode
-from datetime import datetime, timedelta
+from collections import OrderedDict
 from hashlib import sha256
+import os
 from pathlib import Path
+import re
+import shutil
 import tempfile
+import threading
 from typing import Generic, Optional, TypeVar
 
-from crypt4gh_recryptor_service.util import ensure_dirs
-from crypt4gh_recryptor_service.validators import to_iso
+from crypt4gh_recryptor_service.keyindex import ComputeKeyEntry
+from crypt4gh_recryptor_service.metrics import STAGE_SECONDS
+from crypt4gh_recryptor_service.util import (atomic_write,
+                                             ensure_dirs_durable,
+                                             fsync_dir,
+                                             run_storage_io,
+                                             shard_path,
+                                             TEMP_FILE_PREFIX)
 
 T = TypeVar('T', bytes, str)
 
+DEFAULT_MEMORY_STORAGE_MAX_ENTRIES = 1024
+
+_HASH_NAME_REGEX = re.compile('[0-9a-f]{64}')
+
+
+class StorageBackend(ABC):
+    @property
+    @abstractmethod
+    def persistent(self) -> bool:
+        ...
+
+    @abstractmethod
+    def write(self, path: Path, contents: bytes):
+        ...
+
+    @abstractmethod
+    def read(self, path: Path) -> bytes:
+        ...
+
+    @abstractmethod
+    def touch(self, path: Path) -> bool:
+        # Marks an existing file as recently used, returning whether it exists
+        ...
+
+    @abstractmethod
+    def exists(self, path: Path) -> bool:
+        ...
+
+    @abstractmethod
+    def rename(self, path: Path, new_path: Path):
+        ...
+
+
+class DiskStorage(StorageBackend):
+    @property
+    def persistent(self) -> bool:
+        return True
+
+    def write(self, path: Path, contents: bytes):
+        try:
+            atomic_write(path, contents)
+        except FileNotFoundError:
+            # First file in its shard directory
+            ensure_dirs_durable(path.parent)
+            atomic_write(path, contents)
+
+    def read(self, path: Path) -> bytes:
+        with open(path, 'rb') as hashed_file:
+            return hashed_file.read()
+
+    def touch(self, path: Path) -> bool:
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def exists(self, path: Path) -> bool:
+        return path.exists()
+
+    def rename(self, path: Path, new_path: Path):
+        # Files written by other programs (e.g. crypt4gh-recryptor) are synced before they get
+        # their final name, so that they are never seen partially written after a crash
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        ensure_dirs_durable(new_path.parent)
+        path.rename(new_path)
+        fsync_dir(new_path.parent)
+
+
+class MemoryStorage(StorageBackend):
+    # Bounded, least-recently-used in-memory storage. Hashed files are content-addressed, so
+    # an evicted entry can always be recreated from the same contents.
+    def __init__(self, max_entries: int = DEFAULT_MEMORY_STORAGE_MAX_ENTRIES):
+        self._max_entries = max_entries
+        self._entries: OrderedDict[Path, bytes] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def persistent(self) -> bool:
+        return False
+
+    def write(self, path: Path, contents: bytes):
+        with self._lock:
+            self._entries[path] = contents
+            self._entries.move_to_end(path)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def read(self, path: Path) -> bytes:
+        with self._lock:
+            try:
+                self._entries.move_to_end(path)
+                return self._entries[path]
+            except KeyError:
+                raise FileNotFoundError(path) from None
+
+    def touch(self, path: Path) -> bool:
+        with self._lock:
+            if path not in self._entries:
+                return False
+            self._entries.move_to_end(path)
+            return True
+
+    def exists(self, path: Path) -> bool:
+        return path in self._entries
+
+    def rename(self, path: Path, new_path: Path):
+        with self._lock:
+            self._entries[new_path] = self._entries.pop(path)
+
+
+DISK_STORAGE = DiskStorage()
+
 
 class HashedFile(Generic[T]):
     def __init__(self,
                  dir: Path,
                  contents: Optional[T] = None,
                  filename: Optional[str] = None,
-                 write_to_storage: bool = False):
+                 write_to_storage: bool = False,
+                 storage: StorageBackend = DISK_STORAGE,
+                 shard: bool = True):
         self._dir: Path = dir
-        self._contents: Optional[bytes] = self._to_bytes(contents) if contents else None
+        self._storage = storage
+        self._contents: Optional[bytes] = self._to_bytes(contents) if contents is not None else None
+        self._shard = shard
 
         self._rename_to_hash = False if filename else True
 
+        # Files without a name or contents yet (to be written by other programs) are created empty
+        # and uniquely named directly in `dir`, and only moved to their shard when renamed after
+        # their hash
+        self._sharded = shard and (filename is not None or self._contents is not None)
         if not filename:
-            filename = self.sha256 if self._contents else tempfile.mktemp(dir=self._dir)
+            filename = self.sha256 if self._contents is not None else self._create_temp_file()
         self._filename = filename
 
         if write_to_storage:
             self.write_to_storage()
 
+    def _create_temp_file(self) -> str:
+        fd, temp_path = tempfile.mkstemp(dir=self._dir, prefix=TEMP_FILE_PREFIX)
+        os.close(fd)
+        return Path(temp_path).name
+
+    @classmethod
+    def from_bytes(cls,
+                   dir: Path,
+                   contents: bytes,
+                   write_to_storage: bool = False,
+                   storage: StorageBackend = DISK_STORAGE):
+        hashed_file = cls(dir, filename=sha256(contents).hexdigest(), storage=storage)
+        hashed_file._contents = contents
+        if write_to_storage:
+            hashed_file.write_to_storage()
+        return hashed_file
+
     @classmethod
     def _to_bytes(cls, contents: T) -> bytes:
         assert isinstance(contents, bytes)
@@ -40,25 +195,64 @@ class HashedFile(Generic[T]):
     def contents(self) -> T:
         ...
 
+    @property
+    def raw_contents(self) -> bytes:
+        assert self._contents is not None
+        return self._contents
+
     @property
     def sha256(self):
         return sha256(self._contents).hexdigest()
 
+    @property
+    def dir(self) -> Path:
+        return self._dir
+
     @property
     def path(self) -> Path:
+        if self._sharded:
+            return shard_path(self._dir, self._filename)
         return self._dir.joinpath(self._filename)
 
+    @property
+    def storage(self) -> StorageBackend:
+        return self._storage
+
+    def exists_in_storage(self) -> bool:
+        return self._storage.exists(self.path)
+
     def write_to_storage(self):
         assert self._contents is not None
-        with open(self.path, 'wb') as hashed_file:
-            hashed_file.write(self._contents)
-        self.path.chmod(mode=0o600)
+        with STAGE_SECONDS.time(stage='storage_write'):
+            # Content-addressed files already stored have the same contents, so they are only
+            # marked as recently used, instead of being rewritten and synced again
+            if self._filename == self.sha256 and self._storage.touch(self.path):
+                return
+            self._storage.write(self.path, self._contents)
 
     def read_from_storage(self):
-        with open(self.path, 'rb') as hashed_file:
-            self._contents = hashed_file.read()
-            if self._rename_to_hash and self._filename != self.sha256:
-                self.path.rename(self._dir.joinpath(self.sha256))
+        with STAGE_SECONDS.time(stage='storage_read'):
+            self._contents = self._storage.read(self.path)
+        if self._rename_to_hash and self._filename != self.sha256:
+            new_path = shard_path(self._dir, self.sha256) if self._shard else self._dir.joinpath(
+                self.sha256)
+            self._storage.rename(self.path, new_path)
+            self._filename = self.sha256
+            self._sharded = self._shard
+
+    # Async variants for the request handlers. Disk I/O runs on the storage I/O threads, while
+    # in-memory storage is fast enough to be accessed from the event loop directly.
+    async def async_write_to_storage(self):
+        if self._storage.persistent:
+            await run_storage_io(self.write_to_storage)
+        else:
+            self.write_to_storage()
+
+    async def async_read_from_storage(self):
+        if self._storage.persistent:
+            await run_storage_io(self.read_from_storage)
+        else:
+            self.read_from_storage()
 
 
 class HashedBytesFile(HashedFile[bytes]):
@@ -93,32 +287,16 @@ class HeaderFile(HashedFile[str]):
 class ComputeKeyFile(HashedStrFile):
     def __init__(self,
                  dir: Path,
-                 user_public_key_file: HashedStrFile,
-                 compute_key_id_prefix: str,
-                 compute_key_expiration_delta_secs: int,
+                 user_key_hash: str,
+                 key_entry: ComputeKeyEntry,
                  contents: Optional[str] = None,
                  public: bool = True,
                  write_to_storage: bool = False):
-        dir = dir.joinpath(user_public_key_file.path.name)
-
-        key_id_dir = None
-        if dir.exists():
-            for exp_date_dir in dir.iterdir():
-                exp_date = datetime.fromisoformat(exp_date_dir.name)
-                if exp_date > datetime.now():
-                    for key_id_dir in exp_date_dir.iterdir():
-                        break
-                    break
-
-        if not key_id_dir:
-            exp_date_str = to_iso(datetime.now()
-                                  + timedelta(seconds=compute_key_expiration_delta_secs))
-            exp_id_dir = dir.joinpath(exp_date_str)
-            ensure_dirs(exp_id_dir)
-            key_id_dir = Path(tempfile.mkdtemp(prefix=compute_key_id_prefix, dir=exp_id_dir))
-
+        key_id_dir = shard_path(dir, user_key_hash).joinpath(key_entry.expiration_date,
+                                                             key_entry.key_id)
         filename = key_id_dir.name + ('.pub' if public else '.priv')
-        super().__init__(key_id_dir, contents, filename=filename, write_to_storage=write_to_storage)
+        super().__init__(
+            key_id_dir, contents, filename=filename, write_to_storage=write_to_storage, shard=False)
 
     @property
     def key_id(self) -> str:
@@ -127,3 +305,32 @@ class ComputeKeyFile(HashedStrFile):
     @property
     def expiration_date(self) -> str:
         return self.path.parent.parent.name
+
+
+def _merge_into(path: Path, new_path: Path):
+    if not new_path.exists():
+        new_path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        path.rename(new_path)
+    elif path.is_dir() and new_path.is_dir():
+        # Keys created under the sharded layout before migrating
+        for child in path.iterdir():
+            _merge_into(child, new_path.joinpath(child.name))
+        path.rmdir()
+    elif path.is_dir():
+        shutil.rmtree(path)
+    else:
+        path.unlink()  # Content-addressed, so already present with the same contents
+
+
+def migrate_to_sharded_layout(dir: Path) -> int:
+    # Moves the hashed files and user key directories of working dirs from earlier versions from
+    # `dir/<hash>` to `dir/ab/cd/<hash>`
+    if not dir.exists():
+        return 0
+
+    num_migrated = 0
+    for path in dir.iterdir():
+        if _HASH_NAME_REGEX.fullmatch(path.name):
+            _merge_into(path, shard_path(dir, path.name))
+            num_migrated += 1
+    return num_migrated
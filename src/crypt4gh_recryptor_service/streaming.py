@@ -0,0 +1,117 @@
+import asyncio
+from collections import deque
+import struct
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+from starlette.requests import Request
+from starlette.responses import StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+DEFAULT_MAX_NDJSON_LINE_BYTES = 1024 * 1024
+
+# Binary batches are sequences of frames. Request frames are a 4-byte little-endian length
+# followed by the item. Result frames are a 2-byte little-endian status code, followed by a
+# request frame with the item or the error message.
+BINARY_MEDIA_TYPE = 'application/octet-stream'
+DEFAULT_MAX_FRAME_BYTES = 1024 * 1024
+_FRAME_LENGTH = struct.Struct('<I')
+_RESULT_FRAME_PREFIX = struct.Struct('<HI')
+
+
+class NDJSONLineTooLongError(ValueError):
+    ...
+
+
+class FrameTooLongError(ValueError):
+    ...
+
+
+class TruncatedFrameError(ValueError):
+    ...
+
+
+class RequestStreamingResponse(StreamingResponse):
+    # Starlette's StreamingResponse listens for client disconnects by consuming `receive()`
+    # while streaming, which would steal the chunks of a request body that is still being read.
+    # Disconnects are instead detected by `Request.stream()`, which raises `ClientDisconnect`.
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await self.stream_response(send)
+        if self.background is not None:
+            await self.background()
+
+
+async def ndjson_lines(request: Request,
+                       max_line_bytes: int = DEFAULT_MAX_NDJSON_LINE_BYTES) -> AsyncIterator[bytes]:
+    buffer = b''
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b'\n')
+        for line in lines:
+            if line.strip():
+                yield line
+        if len(buffer) > max_line_bytes:
+            raise NDJSONLineTooLongError(f'NDJSON line exceeds {max_line_bytes} bytes')
+    if buffer.strip():
+        yield buffer
+
+
+async def binary_frames(request: Request,
+                        max_frame_bytes: int = DEFAULT_MAX_FRAME_BYTES) -> AsyncIterator[bytes]:
+    buffer = bytearray()
+    async for chunk in request.stream():
+        buffer += chunk
+        frames = []
+        offset = 0
+        # Zero-copy stops here: each frame is copied out of the buffer once, into bytes. Views
+        # would block resizing the buffer, and the headers are pickled to the crypto executor
+        # workers anyway, which memoryviews do not support.
+        with memoryview(buffer) as view:
+            while len(view) - offset >= _FRAME_LENGTH.size:
+                (length,) = _FRAME_LENGTH.unpack_from(view, offset)
+                if length > max_frame_bytes:
+                    raise FrameTooLongError(f'Frame exceeds {max_frame_bytes} bytes')
+                start = offset + _FRAME_LENGTH.size
+                if len(view) < start + length:
+                    break
+                frames.append(bytes(view[start:start + length]))
+                offset = start + length
+        del buffer[:offset]
+        for frame in frames:
+            yield frame
+    if buffer:
+        raise TruncatedFrameError('Truncated frame at the end of the request body')
+
+
+def result_frame(status_code: int, contents: bytes) -> bytes:
+    return b''.join((_RESULT_FRAME_PREFIX.pack(status_code, len(contents)), contents))
+
+
+async def map_ordered(lines: AsyncIterator[bytes],
+                      func: Callable[[bytes], Awaitable[bytes]],
+                      max_pending: int) -> AsyncIterator[bytes]:
+    # Processes up to `max_pending` lines concurrently, yielding the results in input order. No
+    # more input is read while the window is full, so a slow consumer throttles the producer.
+    # Invalid input (a ValueError) is raised after yielding the results of the preceding lines.
+    pending: deque[asyncio.Task[bytes]] = deque()
+    input_error: Optional[ValueError] = None
+    try:
+        line_iterator = aiter(lines)
+        while True:
+            try:
+                line = await anext(line_iterator)
+            except StopAsyncIteration:
+                break
+            except ValueError as e:
+                input_error = e
+                break
+            if len(pending) >= max_pending:
+                yield await pending.popleft()
+            pending.append(asyncio.create_task(func(line)))
+        while pending:
+            yield await pending.popleft()
+        if input_error is not None:
+            raise input_error
+    finally:
+        for task in pending:
+            task.cancel()
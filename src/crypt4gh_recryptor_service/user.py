@@ -1,12 +1,136 @@
-from typing import Annotated
+import asyncio
+import binascii
+from contextlib import asynccontextmanager
+from functools import partial
+import logging
+from typing import Annotated, AsyncIterator, Optional
 
-from crypt4gh_recryptor_service.app import app, common_info
-from crypt4gh_recryptor_service.config import get_user_settings, UserSettings
+from crypt4gh_recryptor_service.app import common_info, create_app
+from crypt4gh_recryptor_service.cache import ComputeKeyInfoCache, RecryptResultCache
+from crypt4gh_recryptor_service.config import get_user_settings, RecryptBackend, UserSettings
 from crypt4gh_recryptor_service.crypt import crypt4gh_recrypt_header
-from crypt4gh_recryptor_service.exchange import fetch_compute_key_info
-from crypt4gh_recryptor_service.models import UserRecryptParams, UserRecryptResponse
-from crypt4gh_recryptor_service.storage import HashedStrFile, HeaderFile
-from fastapi import Depends, Request
+from crypt4gh_recryptor_service.exchange import ComputeNodeRouter, fetch_compute_key_info
+from crypt4gh_recryptor_service.executor import CryptoExecutor
+from crypt4gh_recryptor_service.keyholder import (init_worker_private_key,
+                                                  PrivateKeyHolder,
+                                                  reload_private_key_periodically)
+from crypt4gh_recryptor_service.metrics import (flush_metrics_periodically,
+                                                PROMETHEUS_CONTENT_TYPE,
+                                                render_metrics)
+from crypt4gh_recryptor_service.models import (ComputeKeyInfoResponse,
+                                               UserRecryptBatchParams,
+                                               UserRecryptBatchResponse,
+                                               UserRecryptBatchResult,
+                                               UserRecryptParams,
+                                               UserRecryptResponse)
+from crypt4gh_recryptor_service.retention import (collect_garbage_periodically,
+                                                  enforce_retention,
+                                                  RetentionPolicy)
+from crypt4gh_recryptor_service.storage import (DISK_STORAGE,
+                                                HashedStrFile,
+                                                HeaderFile,
+                                                MemoryStorage,
+                                                StorageBackend)
+from crypt4gh_recryptor_service.streaming import (binary_frames,
+                                                  BINARY_MEDIA_TYPE,
+                                                  FrameTooLongError,
+                                                  map_ordered,
+                                                  ndjson_lines,
+                                                  NDJSON_MEDIA_TYPE,
+                                                  NDJSONLineTooLongError,
+                                                  RequestStreamingResponse,
+                                                  result_frame,
+                                                  TruncatedFrameError)
+from crypt4gh_recryptor_service.util import set_max_concurrent_subprocesses, set_storage_io_threads
+from fastapi import Depends, Header, HTTPException, Request, Response
+from fastapi.responses import PlainTextResponse
+from pydantic import ValidationError
+
+logger = logging.getLogger(__name__)
+
+
+def _recrypt_storage(settings: UserSettings) -> StorageBackend:
+    # Headers and compute keys only need to go to disk for auditing or for the subprocess backend
+    if settings.recrypt_audit_to_disk or settings.recrypt_backend == RecryptBackend.SUBPROCESS:
+        return DISK_STORAGE
+    return MemoryStorage(settings.recrypt_memory_storage_max_entries)
+
+
+@asynccontextmanager
+async def user_lifespan():
+    settings = get_user_settings()
+    set_max_concurrent_subprocesses(settings.max_concurrent_subprocesses)
+    set_storage_io_threads(settings.storage_io_threads)
+    user_private_key = PrivateKeyHolder(settings.user_private_key_path,
+                                        settings.private_key_passphrase,
+                                        settings.user_public_key_path)
+    crypto_executor = None
+    if settings.recrypt_backend == RecryptBackend.IN_PROCESS and \
+            settings.recrypt_in_crypto_executor:
+        # The workers unlock their own copy of the user key, which is then neither sent along with
+        # the jobs nor unlocked in this process
+        crypto_executor = CryptoExecutor(
+            settings.effective_crypto_executor_workers,
+            settings.crypto_executor_max_queue,
+            initializer=init_worker_private_key,
+            initargs=(settings.user_private_key_path, settings.private_key_passphrase))
+    # Read the keys once at startup to keep the KDF and file reads off the request path. The
+    # subprocess backend reads the private key file itself.
+    if settings.recrypt_backend == RecryptBackend.IN_PROCESS and crypto_executor is None:
+        await asyncio.to_thread(user_private_key.get)
+    else:
+        await asyncio.to_thread(user_private_key.load_public_key)
+
+    compute_key_info_cache = ComputeKeyInfoCache(settings.compute_key_info_cache_safety_margin_secs,
+                                                 settings.compute_key_info_cache_refresh_ahead_secs)
+    recrypt_result_cache = RecryptResultCache(settings.recrypt_result_cache_max_entries,
+                                              settings.recrypt_result_cache_ttl_secs)
+    if crypto_executor is not None:
+        await crypto_executor.start()
+    try:
+        async with ComputeNodeRouter(settings) as compute_router, \
+                reload_private_key_periodically(
+                    user_private_key,
+                    settings.user_private_key_reload_interval_secs,
+                    on_reload=crypto_executor.restart if crypto_executor else None):
+            yield {
+                'user_private_key': user_private_key,
+                'compute_router': compute_router,
+                'compute_key_info_cache': compute_key_info_cache,
+                'recrypt_result_cache': recrypt_result_cache,
+                'recrypt_storage': _recrypt_storage(settings),
+                'crypto_executor': crypto_executor,
+            }
+    finally:
+        await compute_key_info_cache.close()
+        await recrypt_result_cache.close()
+        if crypto_executor is not None:
+            await crypto_executor.stop()
+        user_private_key.wipe()
+
+
+def user_metrics_lifespan():
+    settings = get_user_settings()
+    return flush_metrics_periodically(settings.metrics_dir, settings.metrics_flush_interval_secs)
+
+
+def user_retention_lifespan():
+    settings = get_user_settings()
+    headers_policy = RetentionPolicy(settings.headers_retention_max_age_secs,
+                                     settings.headers_retention_max_count,
+                                     settings.headers_retention_max_bytes)
+    compute_keys_policy = RetentionPolicy(settings.compute_keys_retention_max_age_secs,
+                                          settings.compute_keys_retention_max_count,
+                                          settings.compute_keys_retention_max_bytes)
+    return collect_garbage_periodically(
+        settings.retention_sweep_interval_secs,
+        [
+            partial(enforce_retention, settings.headers_dir, headers_policy),
+            partial(enforce_retention, settings.compute_keys_dir, compute_keys_policy),
+        ])
+
+
+app = create_app(user_lifespan, user_metrics_lifespan, user_retention_lifespan)
 
 
 @app.get('/info')
@@ -14,32 +138,259 @@ async def info(settings: Annotated[UserSettings, Depends(get_user_settings)]) ->
     return common_info(settings)
 
 
-@app.post('/recrypt_header')
-async def recrypt_header(params: UserRecryptParams,
-                         settings: Annotated[UserSettings, Depends(get_user_settings)],
-                         request: Request) -> UserRecryptResponse:
+@app.get('/metrics', response_class=PlainTextResponse)
+async def metrics(settings: Annotated[UserSettings, Depends(get_user_settings)]) -> Response:
+    content = await asyncio.to_thread(render_metrics, settings.metrics_dir)
+    return PlainTextResponse(content, media_type=PROMETHEUS_CONTENT_TYPE)
 
-    key_info = await fetch_compute_key_info(request, settings)
 
-    in_header_file = HeaderFile(
-        settings.headers_dir,
-        params.crypt4gh_header,
-        write_to_storage=True,
-    )
+async def _write_if_persistent(hashed_file: HashedStrFile | HeaderFile):
+    # In-memory storage is never read back, so only the hash of the contents is needed then
+    if hashed_file.storage.persistent:
+        await hashed_file.async_write_to_storage()
+
+
+async def _store_compute_public_key(settings: UserSettings,
+                                    request: Request,
+                                    key_info: ComputeKeyInfoResponse) -> HashedStrFile:
     compute_public_key_file = HashedStrFile(
         settings.compute_keys_dir,
         key_info.crypt4gh_compute_public_key,
-        write_to_storage=True,
+        storage=request.state.recrypt_storage,
     )
+    await _write_if_persistent(compute_public_key_file)
+    return compute_public_key_file
+
+
+async def _store_in_header(header: str | bytes, settings: UserSettings,
+                           request: Request) -> HeaderFile:
+    # Headers arrive base64 encoded in JSON requests, and as raw bytes in binary requests
+    if isinstance(header, bytes):
+        in_header_file = HeaderFile.from_bytes(
+            settings.headers_dir, header, storage=request.state.recrypt_storage)
+    else:
+        try:
+            in_header_file = HeaderFile(
+                settings.headers_dir,
+                header,
+                storage=request.state.recrypt_storage,
+            )
+        except binascii.Error as e:
+            raise HTTPException(
+                status_code=422, detail=f'The header is not valid base64: {e}') from e
+    if not in_header_file.raw_contents:
+        raise HTTPException(status_code=422, detail='The header is empty')
+    await _write_if_persistent(in_header_file)
+    return in_header_file
+
+
+async def _recrypt_header(header: str | bytes,
+                          key_info: ComputeKeyInfoResponse,
+                          compute_public_key_file: HashedStrFile,
+                          settings: UserSettings,
+                          request: Request) -> HeaderFile:
+    in_header_file = await _store_in_header(header, settings, request)
+
+    return await request.state.recrypt_result_cache.get(
+        in_header_file.sha256,
+        compute_public_key_file.sha256,
+        key_info,
+        lambda: crypt4gh_recrypt_header(
+            in_header_file,
+            compute_public_key_file,
+            request.state.user_private_key,
+            backend=settings.recrypt_backend,
+            timeout=settings.subprocess_timeout_secs,
+            executor=request.state.crypto_executor,
+            verbose=settings.dev_mode))
+
 
-    out_header_file = await crypt4gh_recrypt_header(
-        in_header_file,
-        compute_public_key_file,
-        settings.user_private_key_path,
-        verbose=settings.dev_mode)
+async def _recrypt_header_to_result(header: str,
+                                    key_info: ComputeKeyInfoResponse,
+                                    compute_public_key_file: HashedStrFile,
+                                    settings: UserSettings,
+                                    request: Request) -> UserRecryptBatchResult:
+    try:
+        out_header_file = await _recrypt_header(header,
+                                                key_info,
+                                                compute_public_key_file,
+                                                settings,
+                                                request)
+    except HTTPException as e:
+        return UserRecryptBatchResult(status_code=e.status_code, error=e.detail)
+    except Exception:
+        logger.exception('Recrypting a header of a batch failed')
+        return UserRecryptBatchResult(status_code=500, error='Internal Server Error')
+    return UserRecryptBatchResult(status_code=200, crypt4gh_header=out_header_file.contents)
+
+
+def _key_info_headers(key_info: ComputeKeyInfoResponse) -> dict[str, str]:
+    return {
+        'X-Crypt4gh-Compute-Keypair-Id':
+            key_info.crypt4gh_compute_keypair_id,
+        'X-Crypt4gh-Compute-Keypair-Expiration-Date':
+            key_info.crypt4gh_compute_keypair_expiration_date,
+    }
+
+
+@app.post('/recrypt_header')
+async def recrypt_header(params: UserRecryptParams,
+                         settings: Annotated[UserSettings, Depends(get_user_settings)],
+                         request: Request) -> UserRecryptResponse:
+
+    key_info = await fetch_compute_key_info(request)
+    compute_public_key_file = await _store_compute_public_key(settings, request, key_info)
+
+    out_header_file = await _recrypt_header(params.crypt4gh_header,
+                                            key_info,
+                                            compute_public_key_file,
+                                            settings,
+                                            request)
 
     return UserRecryptResponse(
         crypt4gh_header=out_header_file.contents,
         crypt4gh_compute_keypair_id=key_info.crypt4gh_compute_keypair_id,
         crypt4gh_compute_keypair_expiration_date=key_info.crypt4gh_compute_keypair_expiration_date,
     )
+
+
+@app.post('/recrypt_headers')
+async def recrypt_headers(params: UserRecryptBatchParams,
+                          settings: Annotated[UserSettings, Depends(get_user_settings)],
+                          request: Request) -> UserRecryptBatchResponse:
+
+    # The whole batch and its results are held in memory
+    if len(params.crypt4gh_headers) > settings.recrypt_batch_max_items:
+        raise HTTPException(
+            status_code=422,
+            detail=f'The batch exceeds {settings.recrypt_batch_max_items} headers. '
+            'Split it up, or use the streaming routes.')
+
+    key_info = await fetch_compute_key_info(request)
+    compute_public_key_file = await _store_compute_public_key(settings, request, key_info)
+
+    semaphore = asyncio.Semaphore(settings.recrypt_batch_concurrency)
+
+    async def _recrypt_batch_item(header: str) -> UserRecryptBatchResult:
+        async with semaphore:
+            return await _recrypt_header_to_result(header,
+                                                   key_info,
+                                                   compute_public_key_file,
+                                                   settings,
+                                                   request)
+
+    results = await asyncio.gather(
+        *(_recrypt_batch_item(header) for header in params.crypt4gh_headers))
+
+    return UserRecryptBatchResponse(
+        results=results,
+        crypt4gh_compute_keypair_id=key_info.crypt4gh_compute_keypair_id,
+        crypt4gh_compute_keypair_expiration_date=key_info.crypt4gh_compute_keypair_expiration_date,
+    )
+
+
+@app.post('/recrypt_headers_stream', response_class=RequestStreamingResponse)
+async def recrypt_headers_stream(settings: Annotated[UserSettings, Depends(get_user_settings)],
+                                 request: Request) -> RequestStreamingResponse:
+    # Takes newline-delimited UserRecryptParams objects as the request body and streams back
+    # one UserRecryptBatchResult per line, in input order. The compute keypair id and expiration
+    # date are returned as response headers.
+
+    key_info = await fetch_compute_key_info(request)
+    compute_public_key_file = await _store_compute_public_key(settings, request, key_info)
+
+    async def _recrypt_line(line: bytes) -> bytes:
+        try:
+            header = UserRecryptParams.parse_raw(line).crypt4gh_header
+        except ValidationError as e:
+            result = UserRecryptBatchResult(status_code=422, error=str(e))
+        else:
+            result = await _recrypt_header_to_result(header,
+                                                     key_info,
+                                                     compute_public_key_file,
+                                                     settings,
+                                                     request)
+        return result.json().encode() + b'\n'
+
+    async def _recrypt_stream() -> AsyncIterator[bytes]:
+        try:
+            async for out_line in map_ordered(
+                    ndjson_lines(request), _recrypt_line, settings.recrypt_batch_concurrency):
+                yield out_line
+        except NDJSONLineTooLongError as e:
+            yield UserRecryptBatchResult(status_code=413, error=str(e)).json().encode() + b'\n'
+
+    return RequestStreamingResponse(
+        _recrypt_stream(), media_type=NDJSON_MEDIA_TYPE, headers=_key_info_headers(key_info))
+
+
+async def _require_binary_body(content_type: Annotated[Optional[str], Header()] = None):
+    # Other bodies (e.g. JSON or forms) would be misread as headers or frames
+    media_type = (content_type or '').split(';', 1)[0].strip().lower()
+    if media_type != BINARY_MEDIA_TYPE:
+        raise HTTPException(
+            status_code=415, detail=f'The request body must be of type {BINARY_MEDIA_TYPE}')
+
+
+@app.post(
+    '/recrypt_header_binary', response_class=Response, dependencies=[Depends(_require_binary_body)])
+async def recrypt_header_binary(settings: Annotated[UserSettings, Depends(get_user_settings)],
+                                request: Request) -> Response:
+    # As `/recrypt_header`, but with the raw header bytes as request and response body, without
+    # base64 and JSON encoding. The compute keypair id and expiration date are returned as
+    # response headers.
+
+    key_info = await fetch_compute_key_info(request)
+    compute_public_key_file = await _store_compute_public_key(settings, request, key_info)
+
+    out_header_file = await _recrypt_header(await request.body(),
+                                            key_info,
+                                            compute_public_key_file,
+                                            settings,
+                                            request)
+
+    return Response(
+        out_header_file.raw_contents,
+        media_type=BINARY_MEDIA_TYPE,
+        headers=_key_info_headers(key_info))
+
+
+@app.post(
+    '/recrypt_headers_binary',
+    response_class=RequestStreamingResponse,
+    dependencies=[Depends(_require_binary_body)])
+async def recrypt_headers_binary(settings: Annotated[UserSettings, Depends(get_user_settings)],
+                                 request: Request) -> RequestStreamingResponse:
+    # Takes raw headers as length-prefixed binary frames and streams back one result frame per
+    # header, in input order (see `streaming`). The compute keypair id and expiration date are
+    # returned as response headers.
+
+    key_info = await fetch_compute_key_info(request)
+    compute_public_key_file = await _store_compute_public_key(settings, request, key_info)
+
+    async def _recrypt_frame(frame: bytes) -> bytes:
+        try:
+            out_header_file = await _recrypt_header(frame,
+                                                    key_info,
+                                                    compute_public_key_file,
+                                                    settings,
+                                                    request)
+        except HTTPException as e:
+            return result_frame(e.status_code, str(e.detail).encode())
+        except Exception:
+            logger.exception('Recrypting a header of a batch failed')
+            return result_frame(500, b'Internal Server Error')
+        return result_frame(200, out_header_file.raw_contents)
+
+    async def _recrypt_stream() -> AsyncIterator[bytes]:
+        try:
+            async for out_frame in map_ordered(
+                    binary_frames(request), _recrypt_frame, settings.recrypt_batch_concurrency):
+                yield out_frame
+        except FrameTooLongError as e:
+            yield result_frame(413, str(e).encode())
+        except TruncatedFrameError as e:
+            yield result_frame(422, str(e).encode())
+
+    return RequestStreamingResponse(
+        _recrypt_stream(), media_type=BINARY_MEDIA_TYPE, headers=_key_info_headers(key_info))
@@ -1,41 +1,305 @@
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+import fcntl
+from functools import partial
+import os
 from pathlib import Path
+import shlex
 import subprocess
+import tempfile
+import time
+from typing import Any, Callable, Optional, Sequence, TypeVar
 
+from crypt4gh_recryptor_service.metrics import (SUBPROCESS_QUEUE_SECONDS,
+                                                SUBPROCESS_SPAWN_SECONDS,
+                                                SUBPROCESS_SPAWNS,
+                                                SUBPROCESS_TIMEOUTS)
 
-def run_in_subprocess(cmd: str, verbose: bool = False, capture_output: bool = False):
+STORAGE_IO_THREAD_NAME_PREFIX = 'storage-io'
+
+T = TypeVar('T')
+
+
+class SubprocessError(subprocess.CalledProcessError):
+    # Includes the captured stderr of the failed command in the error message
+    def __str__(self) -> str:
+        message = super().__str__()
+        stderr = self.stderr
+        if isinstance(stderr, bytes):
+            stderr = stderr.decode(errors='replace')
+        if stderr and stderr.strip():
+            message += f' Stderr: {stderr.strip()}'
+        return message
+
+
+# Caps the number of subprocesses running concurrently in this process, so that a traffic spike
+# can not fork-bomb the host. Set from the settings at startup, uncapped until then.
+_subprocess_semaphore: Optional[asyncio.Semaphore] = None
+
+
+def set_max_concurrent_subprocesses(max_concurrent: int):
+    global _subprocess_semaphore
+    _subprocess_semaphore = asyncio.Semaphore(max_concurrent)
+
+
+# Blocking filesystem calls of the request handlers run on a bounded pool of threads, so that a
+# slow (e.g. network) filesystem neither stalls the event loop nor uses up the default thread pool.
+# Set from the settings at startup. Until then, the default thread pool is used.
+_storage_io_executor: Optional[ThreadPoolExecutor] = None
+
+
+def set_storage_io_threads(num_threads: int):
+    global _storage_io_executor
+    previous_executor = _storage_io_executor
+    _storage_io_executor = ThreadPoolExecutor(
+        num_threads, thread_name_prefix=STORAGE_IO_THREAD_NAME_PREFIX)
+    if previous_executor is not None:
+        previous_executor.shutdown(wait=False)
+
+
+async def run_storage_io(func: Callable[..., T], *args: Any) -> T:
+    return await asyncio.get_running_loop().run_in_executor(_storage_io_executor,
+                                                            partial(func, *args))
+
+
+def _print_cmd(argv: Sequence[str]):
+    print('-' * 26)
+    print(f'Running `{shlex.join(argv)}`:')
+    print('-' * 26)
+    print()
+
+
+def _command_label(argv: Sequence[str]) -> str:
+    return Path(argv[0]).name
+
+
+def run_in_subprocess(argv: Sequence[str],
+                      verbose: bool = False,
+                      capture_output: bool = False,
+                      timeout: Optional[float] = None):
     if verbose:
-        print('-' * 26)
-        print(f'Running `{cmd}`:')
-        print('-' * 26)
-        print()
-    return subprocess.run(
-        cmd,
-        shell=True,
-        check=True,
-        capture_output=True if capture_output else False,
-        text=True if capture_output else False)
-
-
-async def async_run_in_subprocess(cmd: str, verbose: bool = False, capture_output: bool = False):
+        _print_cmd(argv)
+    SUBPROCESS_SPAWNS.inc(command=_command_label(argv))
+    # As in `async_run_in_subprocess()`, stderr is captured to be included in the error
+    try:
+        completed = subprocess.run(
+            argv,
+            check=True,
+            stdout=subprocess.PIPE if capture_output else None,
+            stderr=subprocess.PIPE,
+            text=True,
+            timeout=timeout)
+    except subprocess.TimeoutExpired:
+        SUBPROCESS_TIMEOUTS.inc(command=_command_label(argv))
+        raise
+    except subprocess.CalledProcessError as e:
+        raise SubprocessError(e.returncode, e.cmd, e.output, e.stderr) from e
+    if verbose and completed.stderr:
+        print(completed.stderr, end='')
+    return completed
+
+
+async def _acquire(semaphore: asyncio.Semaphore, timeout: Optional[float]):
+    # `asyncio.wait_for(semaphore.acquire(), timeout)` leaks a permit if the timeout fires just as
+    # the semaphore is acquired. The acquire is shielded instead, and undone if it got through.
+    acquire = asyncio.ensure_future(semaphore.acquire())
+    try:
+        await asyncio.wait_for(asyncio.shield(acquire), timeout)
+    except BaseException:
+        if acquire.done() and not acquire.cancelled():
+            semaphore.release()
+        else:
+            acquire.cancel()
+        raise
+
+
+@asynccontextmanager
+async def _subprocess_slot(command: str, timeout: Optional[float]):
+    semaphore = _subprocess_semaphore
+    if semaphore is None:
+        yield
+        return
+    start = time.perf_counter()
+    await _acquire(semaphore, timeout)
+    try:
+        SUBPROCESS_QUEUE_SECONDS.observe(time.perf_counter() - start, command=command)
+        yield
+    finally:
+        semaphore.release()
+
+
+async def _communicate(proc: asyncio.subprocess.Process,
+                       timeout: Optional[float]) -> tuple[bytes, bytes]:
+    try:
+        return await asyncio.wait_for(proc.communicate(), timeout)
+    except BaseException:
+        # Timed out or cancelled: do not leave the process running
+        proc.kill()
+        await proc.wait()
+        raise
+
+
+async def async_run_in_subprocess(argv: Sequence[str],
+                                  verbose: bool = False,
+                                  capture_output: bool = False,
+                                  timeout: Optional[float] = None) -> Optional[str]:
+    # Executes the command directly, without a shell. Stderr is captured, to be included in the
+    # error if the command fails. The timeout includes the time spent waiting for a free slot.
     if verbose:
-        print('-' * 26)
-        print(f'Running `{cmd}`:')
-        print('-' * 26)
-        print()
+        _print_cmd(argv)
+    command = _command_label(argv)
+    deadline = None if timeout is None else time.monotonic() + timeout
 
-    proc = await asyncio.create_subprocess_shell(
-        cmd, stdout=asyncio.subprocess.PIPE if capture_output else None, stderr=None)
+    try:
+        async with _subprocess_slot(command, timeout):
+            SUBPROCESS_SPAWNS.inc(command=command)
+            with SUBPROCESS_SPAWN_SECONDS.time(command=command):
+                proc = await asyncio.create_subprocess_exec(
+                    *argv,
+                    stdin=asyncio.subprocess.DEVNULL,
+                    stdout=asyncio.subprocess.PIPE if capture_output else None,
+                    stderr=asyncio.subprocess.PIPE)
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            stdout, stderr = await _communicate(proc, remaining)
+    except asyncio.TimeoutError:
+        SUBPROCESS_TIMEOUTS.inc(command=command)
+        raise subprocess.TimeoutExpired(list(argv), timeout) from None
 
-    stdout, stderr = await proc.communicate()
+    if verbose and stderr:
+        print(stderr.decode(errors='replace'), end='')
 
     if proc.returncode:
-        raise RuntimeError(f'[{cmd!r} exited with {proc.returncode}]')
+        raise SubprocessError(proc.returncode, list(argv), stdout, stderr)
 
     if capture_output:
         return stdout.decode()
+    return None
+
+
+def _cgroup_cpu_limit() -> Optional[float]:
+    # CPU quota of the container, from cgroup v2 or v1, if any
+    try:
+        quota, period = Path('/sys/fs/cgroup/cpu.max').read_text().split()
+        if quota != 'max' and int(period) > 0:
+            return int(quota) / int(period)
+        return None
+    except (OSError, ValueError):
+        pass
+    try:
+        quota = int(Path('/sys/fs/cgroup/cpu/cpu.cfs_quota_us').read_text())
+        period = int(Path('/sys/fs/cgroup/cpu/cpu.cfs_period_us').read_text())
+        return quota / period if quota > 0 and period > 0 else None
+    except (OSError, ValueError):
+        return None
+
+
+def available_cpus() -> int:
+    # CPUs this process may actually use: restricted by CPU affinity and by the cgroup CPU quota
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    cgroup_limit = _cgroup_cpu_limit()
+    if cgroup_limit is not None:
+        cpus = min(cpus, max(int(cgroup_limit), 1))
+    return max(cpus, 1)
+
+
+def shard_path(dir: Path, name: str) -> Path:
+    # Spreads content-addressed entries over `ab/cd/<name>` subdirectories of `dir`, keeping each
+    # directory small enough for fast lookups and listings
+    return dir.joinpath(name[0:2], name[2:4], name)
+
+
+def _list_dir(dir: Path) -> list[Path]:
+    try:
+        return list(dir.iterdir())
+    except FileNotFoundError:
+        return []  # Removed concurrently
+
+
+def list_sharded(dir: Path) -> list[Path]:
+    # Entries laid out by `shard_path()`. Other entries of `dir` (e.g. temporary files, or entries
+    # not yet migrated to the sharded layout) are skipped.
+    shard_dirs = [dir]
+    for _ in range(2):
+        shard_dirs = [
+            path for shard_dir in shard_dirs for path in _list_dir(shard_dir)
+            if len(path.name) == 2 and path.is_dir()
+        ]
+    return [path for shard_dir in shard_dirs for path in _list_dir(shard_dir)]
 
 
 def ensure_dirs(dir_path: Path):
     if not dir_path.exists():
         dir_path.mkdir(mode=0o700, parents=True)
+
+
+@contextmanager
+def file_lock(lock_path: Path):
+    # Exclusive advisory lock, shared between all processes (e.g. uvicorn workers) on the host
+    fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+TEMP_FILE_PREFIX = '.tmp-'
+
+
+def fsync_dir(dir: Path):
+    # Persists the creation, removal and renaming of entries in `dir`
+    fd = os.open(dir, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def ensure_dirs_durable(dir_path: Path):
+    # As `ensure_dirs()`, also persisting the creation of each missing directory
+    missing_dirs = []
+    while not dir_path.exists():
+        missing_dirs.append(dir_path)
+        dir_path = dir_path.parent
+    for missing_dir in reversed(missing_dirs):
+        try:
+            missing_dir.mkdir(mode=0o700)
+        except FileExistsError:
+            pass  # Created concurrently
+        fsync_dir(missing_dir.parent)
+
+
+def _write_and_sync(fd: int, contents: bytes):
+    with os.fdopen(fd, 'wb') as new_file:
+        new_file.write(contents)
+        new_file.flush()
+        os.fsync(new_file.fileno())
+
+
+def write_new_file(path: Path, contents: bytes):
+    # Fails if `path` exists. The file is created with mode 0600, so that its contents are never
+    # readable by others.
+    _write_and_sync(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), contents)
+
+
+def atomic_write(path: Path, contents: bytes):
+    # Readers (also in other processes) see either the previous or the new contents of `path`,
+    # both before and after a crash. The temporary file is created with O_EXCL and mode 0600.
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=TEMP_FILE_PREFIX)
+    try:
+        _write_and_sync(fd, contents)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    fsync_dir(path.parent)
@@ -0,0 +1,57 @@
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Any, AsyncContextManager, AsyncIterator, Callable
+
+from crypt4gh_recryptor_service.config import (_resolved_working_dir_env_var,
+                                               get_compute_settings,
+                                               get_paths,
+                                               get_user_settings,
+                                               ServerMode,
+                                               setup_files)
+from fastapi import FastAPI
+import pytest
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+RunningApp = AsyncContextManager[tuple[ASGIApp, dict[str, Any]]]
+
+
+@pytest.fixture
+def anyio_backend():
+    return 'asyncio'
+
+
+def _clear_settings_caches():
+    get_paths.cache_clear()
+    get_user_settings.cache_clear()
+    get_compute_settings.cache_clear()
+
+
+@pytest.fixture
+def working_dirs(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    # Fresh user and compute working dirs, as created at server startup
+    for server_mode in ServerMode:
+        monkeypatch.setenv(
+            _resolved_working_dir_env_var(server_mode), str(tmp_path.joinpath(server_mode.value)))
+    _clear_settings_caches()
+    for server_mode in ServerMode:
+        setup_files(server_mode)
+    yield tmp_path
+    _clear_settings_caches()
+
+
+@asynccontextmanager
+async def running_app(app: FastAPI) -> AsyncIterator[tuple[ASGIApp, dict[str, Any]]]:
+    # Runs the app lifespan and passes its state on to the requests, as uvicorn does. The state
+    # is yielded as well, allowing tests and benchmarks to replace parts of it.
+    async with app.router.lifespan_context(app) as state:
+        state = dict(state or {})
+
+        async def asgi(scope: Scope, receive: Receive, send: Send):
+            await app({**scope, 'state': dict(state)}, receive, send)
+
+        yield asgi, state
+
+
+@pytest.fixture(name='running_app')
+def running_app_fixture() -> Callable[[FastAPI], RunningApp]:
+    return running_app
@@ -0,0 +1,164 @@
+import asyncio
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from crypt4gh_recryptor_service import cache
+from crypt4gh_recryptor_service.cache import ComputeKeyInfoCache, RecryptResultCache, SingleFlight
+from crypt4gh_recryptor_service.models import ComputeKeyInfo, ComputeKeyInfoResponse
+from crypt4gh_recryptor_service.storage import HeaderFile, MemoryStorage
+import pytest
+
+START = datetime(2030, 1, 1)
+
+
+class _Clock(datetime):
+    current = START
+
+    @classmethod
+    def now(cls, tz=None):
+        return cls.current
+
+
+@pytest.fixture
+def clock(monkeypatch: pytest.MonkeyPatch) -> type[_Clock]:
+    monkeypatch.setattr(cache, 'datetime', _Clock)
+    monkeypatch.setattr(_Clock, 'current', START)
+    return _Clock
+
+
+class _Fetcher:
+    # Returns a new key info on every fetch, expiring `lifetime` after the fetch
+    def __init__(self, clock: type[_Clock], lifetime: timedelta):
+        self._clock = clock
+        self._lifetime = lifetime
+        self.num_fetches = 0
+
+    async def __call__(self) -> ComputeKeyInfoResponse:
+        self.num_fetches += 1
+        return ComputeKeyInfoResponse(
+            crypt4gh_compute_keypair_id=f'key{self.num_fetches}',
+            crypt4gh_compute_keypair_expiration_date=self._clock.now() + self._lifetime,
+            crypt4gh_compute_public_key='public key',
+        )
+
+
+async def _wait_for_fetches(key_info_cache: ComputeKeyInfoCache):
+    while key_info_cache._fetches._in_flight:
+        await asyncio.sleep(0)
+
+
+@pytest.mark.anyio
+async def test_single_flight_collapses_concurrent_calls():
+    single_flight: SingleFlight[str, int] = SingleFlight()
+    release = asyncio.Event()
+    num_calls = 0
+
+    async def call() -> int:
+        nonlocal num_calls
+        num_calls += 1
+        await release.wait()
+        return num_calls
+
+    callers = [asyncio.create_task(single_flight.do('key', call)) for _ in range(5)]
+    await asyncio.sleep(0)
+    assert single_flight.in_flight('key')
+    release.set()
+
+    assert await asyncio.gather(*callers) == [1] * 5
+    assert num_calls == 1
+    assert not single_flight.in_flight('key')
+
+
+@pytest.mark.anyio
+async def test_single_flight_survives_cancelled_caller():
+    single_flight: SingleFlight[str, str] = SingleFlight()
+    release = asyncio.Event()
+
+    async def call() -> str:
+        await release.wait()
+        return 'done'
+
+    cancelled = asyncio.create_task(single_flight.do('key', call))
+    waiting = asyncio.create_task(single_flight.do('key', call))
+    await asyncio.sleep(0)
+    cancelled.cancel()
+    release.set()
+
+    assert await waiting == 'done'
+    with pytest.raises(asyncio.CancelledError):
+        await cancelled
+
+
+@pytest.mark.anyio
+async def test_compute_key_info_cache_hit(clock: type[_Clock]):
+    key_info_cache = ComputeKeyInfoCache(safety_margin_secs=60, refresh_ahead_secs=600)
+    fetch = _Fetcher(clock, timedelta(hours=1))
+
+    key_info = await key_info_cache.get('node', fetch)
+    clock.current += timedelta(minutes=10)
+    assert await key_info_cache.get('node', fetch) == key_info
+    assert fetch.num_fetches == 1
+
+
+@pytest.mark.anyio
+async def test_compute_key_info_cache_refreshes_ahead_of_expiry(clock: type[_Clock]):
+    key_info_cache = ComputeKeyInfoCache(safety_margin_secs=60, refresh_ahead_secs=600)
+    fetch = _Fetcher(clock, timedelta(hours=1))
+    await key_info_cache.get('node', fetch)
+
+    # Within the refresh period, the cached key info is returned while refreshed in the background
+    clock.current += timedelta(minutes=50)
+    key_info = await key_info_cache.get('node', fetch)
+    assert key_info.crypt4gh_compute_keypair_id == 'key1'
+    await _wait_for_fetches(key_info_cache)
+    assert fetch.num_fetches == 2
+
+    key_info = await key_info_cache.get('node', fetch)
+    assert key_info.crypt4gh_compute_keypair_id == 'key2'
+    assert fetch.num_fetches == 2
+
+
+@pytest.mark.anyio
+async def test_compute_key_info_cache_refetches_stale_entries(clock: type[_Clock]):
+    key_info_cache = ComputeKeyInfoCache(safety_margin_secs=60, refresh_ahead_secs=600)
+    fetch = _Fetcher(clock, timedelta(hours=1))
+    await key_info_cache.get('node', fetch)
+
+    # Within the safety margin before expiry, the key info is fetched before returning
+    clock.current += timedelta(minutes=59, seconds=30)
+    key_info = await key_info_cache.get('node', fetch)
+    assert key_info.crypt4gh_compute_keypair_id == 'key2'
+    assert fetch.num_fetches == 2
+
+
+@pytest.mark.anyio
+async def test_compute_key_info_cache_skips_key_info_within_safety_margin(clock: type[_Clock]):
+    key_info_cache = ComputeKeyInfoCache(safety_margin_secs=60, refresh_ahead_secs=600)
+    fetch = _Fetcher(clock, timedelta(seconds=30))
+
+    await key_info_cache.get('node', fetch)
+    await key_info_cache.get('node', fetch)
+    assert fetch.num_fetches == 2
+    assert len(key_info_cache) == 0
+
+
+@pytest.mark.anyio
+async def test_recrypt_result_cache_separates_compute_public_keys(tmp_path: Path):
+    result_cache = RecryptResultCache(max_entries=10, ttl_secs=3600)
+    # Keypair ids are only unique per compute node
+    key_info = ComputeKeyInfo(
+        crypt4gh_compute_keypair_id='cnk:1',
+        crypt4gh_compute_keypair_expiration_date=datetime.now() + timedelta(days=1))
+    num_recrypts = 0
+
+    async def recrypt() -> HeaderFile:
+        nonlocal num_recrypts
+        num_recrypts += 1
+        return HeaderFile.from_bytes(
+            tmp_path, f'out{num_recrypts}'.encode(), storage=MemoryStorage(1))
+
+    node_a = await result_cache.get('in header', 'compute key a', key_info, recrypt)
+    node_b = await result_cache.get('in header', 'compute key b', key_info, recrypt)
+    assert node_a.raw_contents != node_b.raw_contents
+    assert await result_cache.get('in header', 'compute key a', key_info, recrypt) is node_a
+    assert num_recrypts == 2
@@ -0,0 +1,48 @@
+from pathlib import Path
+
+from crypt4gh_recryptor_service.crypt import (crypt4gh_recrypt_header,
+                                              generate_keypair,
+                                              parse_public_key,
+                                              write_keypair)
+from crypt4gh_recryptor_service.keyholder import PrivateKeyHolder
+from crypt4gh_recryptor_service.storage import HashedStrFile, HeaderFile, MemoryStorage
+from fastapi import HTTPException
+import pytest
+
+
+def test_parse_public_key():
+    keypair = generate_keypair('passphrase', 'comment')
+    assert len(parse_public_key(keypair.public_key.decode())) == 32
+
+
+@pytest.mark.parametrize(
+    'contents',
+    [
+        '',
+        '-----BEGIN PGP PUBLIC KEY BLOCK-----\nAAAA\n-----END PGP PUBLIC KEY BLOCK-----',
+        'ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAABAQ user@host',
+        '-----BEGIN CRYPT4GH PUBLIC KEY-----\nAAAA\n-----END CRYPT4GH PUBLIC KEY-----',
+        '-----BEGIN CRYPT4GH PUBLIC KEY-----\n!!!!\n-----END CRYPT4GH PUBLIC KEY-----',
+    ])
+def test_parse_public_key_rejects_invalid_keys(contents: str):
+    with pytest.raises(ValueError):
+        parse_public_key(contents)
+
+
+@pytest.mark.anyio
+async def test_recrypt_header_with_invalid_compute_public_key(tmp_path: Path):
+    private_key_path = tmp_path.joinpath('user_key.priv')
+    write_keypair(
+        generate_keypair('passphrase', 'comment'),
+        private_key_path,
+        tmp_path.joinpath('user_key.pub'))
+    storage = MemoryStorage(10)
+    in_header_file = HeaderFile.from_bytes(tmp_path, b'header', storage=storage)
+    compute_key_file = HashedStrFile(tmp_path, 'ssh-rsa AAAA', storage=storage)
+
+    # Caused by the compute node, not by the header
+    with pytest.raises(HTTPException) as exc_info:
+        await crypt4gh_recrypt_header(in_header_file,
+                                      compute_key_file,
+                                      PrivateKeyHolder(private_key_path, 'passphrase'))
+    assert exc_info.value.status_code == 502
@@ -0,0 +1,95 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from hashlib import sha256
+from pathlib import Path
+import sqlite3
+
+from crypt4gh_recryptor_service.crypt import generate_keypair, Keypair
+from crypt4gh_recryptor_service.keyindex import ComputeKeyEntry
+from crypt4gh_recryptor_service.keystore import (ComputeKeyStore,
+                                                 FileSystemComputeKeyStore,
+                                                 SqliteComputeKeyStore)
+from crypt4gh_recryptor_service.validators import to_iso
+import pytest
+
+USER_KEY_HASH = sha256(b'user public key').hexdigest()
+NUM_CONCURRENT_CREATES = 8
+EXPIRATION_DELTA_SECS = 3600
+
+
+@pytest.fixture(scope='module')
+def keypair() -> Keypair:
+    return generate_keypair('passphrase', 'comment')
+
+
+def _create_concurrently(store: ComputeKeyStore, keypair: Keypair) -> set[str]:
+    def create(_):
+        return store.create(USER_KEY_HASH, store.new_entry(), keypair).entry.key_id
+
+    with ThreadPoolExecutor(NUM_CONCURRENT_CREATES) as executor:
+        return set(executor.map(create, range(NUM_CONCURRENT_CREATES)))
+
+
+def test_sqlite_store_creates_one_keypair_for_concurrent_callers(tmp_path: Path, keypair: Keypair):
+    db_path = tmp_path.joinpath('compute_keys.sqlite3')
+    store = SqliteComputeKeyStore(db_path, 'cnk:', EXPIRATION_DELTA_SECS)
+    store.load()
+    try:
+        key_ids = _create_concurrently(store, keypair)
+    finally:
+        store.close()
+
+    assert len(key_ids) == 1
+    with sqlite3.connect(db_path) as connection:
+        rows = connection.execute('SELECT key_id FROM compute_keys').fetchall()
+    assert rows == [(key_ids.pop(),)]
+
+
+def test_filesystem_store_creates_one_keypair_for_concurrent_callers(tmp_path: Path,
+                                                                     keypair: Keypair):
+    compute_keys_dir = tmp_path.joinpath('compute_keys')
+    locks_dir = tmp_path.joinpath('locks')
+    compute_keys_dir.mkdir()
+    locks_dir.mkdir()
+    store = FileSystemComputeKeyStore(compute_keys_dir, locks_dir, 'cnk:', EXPIRATION_DELTA_SECS)
+    store.load()
+
+    key_ids = _create_concurrently(store, keypair)
+
+    assert len(key_ids) == 1
+    key_id = key_ids.pop()
+    assert [path.name for path in compute_keys_dir.rglob('cnk:*') if path.is_dir()] == [key_id]
+
+
+def test_sqlite_store_rotates_keypairs_about_to_expire(tmp_path: Path, keypair: Keypair):
+    store = SqliteComputeKeyStore(
+        tmp_path.joinpath('compute_keys.sqlite3'), 'cnk:', EXPIRATION_DELTA_SECS)
+    store.load()
+    try:
+        # Expires before the keypairs created next, as keypairs about to expire do
+        expiring_entry = ComputeKeyEntry.from_dir_names(
+            to_iso(datetime.now() + timedelta(minutes=10)), 'cnk:expiring')
+        current = store.create(USER_KEY_HASH, expiring_entry, keypair)
+        assert store.create(USER_KEY_HASH, store.new_entry(), keypair) == current
+
+        rotated = store.create(
+            USER_KEY_HASH,
+            store.new_entry(),
+            keypair,
+            min_remaining_secs=timedelta(minutes=20).total_seconds())
+        assert rotated != current
+        store.discard(USER_KEY_HASH)
+        assert store.lookup(USER_KEY_HASH) == rotated
+    finally:
+        store.close()
+
+
+@pytest.mark.parametrize('wal, journal_mode', [(False, 'delete'), (True, 'wal')])
+def test_sqlite_store_uses_wal_only_when_enabled(tmp_path: Path, wal: bool, journal_mode: str):
+    db_path = tmp_path.joinpath('compute_keys.sqlite3')
+    store = SqliteComputeKeyStore(db_path, 'cnk:', EXPIRATION_DELTA_SECS, wal=wal)
+    store.load()
+    store.close()
+
+    with sqlite3.connect(db_path) as connection:
+        assert connection.execute('PRAGMA journal_mode').fetchone() == (journal_mode,)
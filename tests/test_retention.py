@@ -0,0 +1,56 @@
+import os
+from pathlib import Path
+import time
+
+from crypt4gh_recryptor_service.retention import enforce_retention, RetentionPolicy
+from crypt4gh_recryptor_service.util import shard_path
+
+NAMES = ['a' * 64, 'b' * 64, 'c' * 64, 'd' * 64]
+
+
+def _write_files(dir: Path) -> list[Path]:
+    # One file per name, each 10 bytes and a minute older than the next
+    now = time.time()
+    paths = []
+    for i, name in enumerate(NAMES):
+        path = shard_path(dir, name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b'0123456789')
+        mtime = now - (len(NAMES) - i) * 60
+        os.utime(path, (mtime, mtime))
+        paths.append(path)
+    return paths
+
+
+def _remaining(paths: list[Path]) -> list[bool]:
+    return [path.exists() for path in paths]
+
+
+def test_enforce_retention_max_count_deletes_oldest_first(tmp_path: Path):
+    paths = _write_files(tmp_path)
+    # Touched when used, which makes the oldest file the youngest
+    os.utime(paths[0])
+
+    assert enforce_retention(tmp_path, RetentionPolicy(max_count=2)) == 2
+    assert _remaining(paths) == [True, False, False, True]
+
+
+def test_enforce_retention_max_bytes(tmp_path: Path):
+    paths = _write_files(tmp_path)
+
+    assert enforce_retention(tmp_path, RetentionPolicy(max_bytes=25)) == 2
+    assert _remaining(paths) == [False, False, True, True]
+
+
+def test_enforce_retention_max_age(tmp_path: Path):
+    paths = _write_files(tmp_path)
+
+    assert enforce_retention(tmp_path, RetentionPolicy(max_age_secs=150)) == 2
+    assert _remaining(paths) == [False, False, True, True]
+
+
+def test_enforce_retention_disabled(tmp_path: Path):
+    paths = _write_files(tmp_path)
+
+    assert enforce_retention(tmp_path, RetentionPolicy()) == 0
+    assert all(_remaining(paths))
@@ -0,0 +1,49 @@
+from pathlib import Path
+
+from crypt4gh_recryptor_service.storage import migrate_to_sharded_layout
+from crypt4gh_recryptor_service.util import shard_path
+
+HEADER_HASH = 'ab' * 32
+USER_KEY_HASH = 'cd' * 32
+
+
+def test_migrate_to_sharded_layout_moves_hashed_files(tmp_path: Path):
+    tmp_path.joinpath(HEADER_HASH).write_bytes(b'header')
+    tmp_path.joinpath('not-a-hash').write_bytes(b'other')
+
+    assert migrate_to_sharded_layout(tmp_path) == 1
+    assert shard_path(tmp_path, HEADER_HASH).read_bytes() == b'header'
+    assert not tmp_path.joinpath(HEADER_HASH).exists()
+    assert tmp_path.joinpath('not-a-hash').exists()
+
+    # Already migrated
+    assert migrate_to_sharded_layout(tmp_path) == 0
+
+
+def test_migrate_to_sharded_layout_merges_existing_files(tmp_path: Path):
+    sharded_path = shard_path(tmp_path, HEADER_HASH)
+    sharded_path.parent.mkdir(parents=True)
+    sharded_path.write_bytes(b'header')
+    tmp_path.joinpath(HEADER_HASH).write_bytes(b'header')
+
+    assert migrate_to_sharded_layout(tmp_path) == 1
+    assert sharded_path.read_bytes() == b'header'
+    assert not tmp_path.joinpath(HEADER_HASH).exists()
+
+
+def test_migrate_to_sharded_layout_merges_user_key_dirs(tmp_path: Path):
+    # Compute keys created before and after an upgrade, for the same user key
+    old_key_dir = tmp_path.joinpath(USER_KEY_HASH, '2030-01-01T00:00:00', 'cnk:old')
+    new_key_dir = shard_path(tmp_path, USER_KEY_HASH).joinpath('2030-01-02T00:00:00', 'cnk:new')
+    for key_dir in (old_key_dir, new_key_dir):
+        key_dir.mkdir(parents=True)
+        key_dir.joinpath(f'{key_dir.name}.pub').write_text('public key')
+
+    assert migrate_to_sharded_layout(tmp_path) == 1
+    user_dir = shard_path(tmp_path, USER_KEY_HASH)
+    assert sorted(path.name for path in user_dir.glob('*/*')) == ['cnk:new', 'cnk:old']
+    assert not tmp_path.joinpath(USER_KEY_HASH).exists()
+
+
+def test_migrate_to_sharded_layout_missing_dir(tmp_path: Path):
+    assert migrate_to_sharded_layout(tmp_path.joinpath('missing')) == 0
@@ -0,0 +1,86 @@
+import struct
+from typing import AsyncIterator
+
+from crypt4gh_recryptor_service.streaming import (binary_frames,
+                                                  DEFAULT_MAX_NDJSON_LINE_BYTES,
+                                                  FrameTooLongError,
+                                                  ndjson_lines,
+                                                  NDJSONLineTooLongError,
+                                                  result_frame,
+                                                  TruncatedFrameError)
+import pytest
+from starlette.requests import Request
+
+
+def _request(chunks: list[bytes]) -> Request:
+    messages = [{'type': 'http.request', 'body': chunk, 'more_body': True} for chunk in chunks]
+    messages.append({'type': 'http.request', 'body': b'', 'more_body': False})
+
+    async def receive():
+        return messages.pop(0)
+
+    return Request({'type': 'http', 'method': 'POST', 'headers': []}, receive)
+
+
+def _split(body: bytes, chunk_size: int) -> list[bytes]:
+    return [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+
+
+def _frame(item: bytes) -> bytes:
+    return struct.pack('<I', len(item)) + item
+
+
+async def _collect(items: AsyncIterator[bytes]) -> list[bytes]:
+    return [item async for item in items]
+
+
+@pytest.mark.anyio
+async def test_ndjson_lines_split_across_chunks():
+    body = b'{"a": 1}\n\n{"b": 2}\n  \n{"c": 3}'
+    lines = await _collect(ndjson_lines(_request(_split(body, 3))))
+    assert lines == [b'{"a": 1}', b'{"b": 2}', b'{"c": 3}']
+
+
+@pytest.mark.anyio
+async def test_ndjson_lines_rejects_long_lines():
+    body = b'{"a": 1}\n' + b'x' * (DEFAULT_MAX_NDJSON_LINE_BYTES + 1)
+    lines = []
+    with pytest.raises(NDJSONLineTooLongError):
+        async for line in ndjson_lines(_request(_split(body, 64 * 1024))):
+            lines.append(line)
+    assert lines == [b'{"a": 1}']
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('chunk_size', [1, 3, 1000])
+async def test_binary_frames_round_trip(chunk_size: int):
+    items = [b'header', b'', b'x' * 300]
+    body = b''.join(_frame(item) for item in items)
+    assert await _collect(binary_frames(_request(_split(body, chunk_size)))) == items
+
+
+@pytest.mark.anyio
+async def test_binary_frames_rejects_long_frames():
+    body = _frame(b'ok') + _frame(b'x' * 11)
+    frames = []
+    with pytest.raises(FrameTooLongError):
+        async for frame in binary_frames(_request([body]), max_frame_bytes=10):
+            frames.append(frame)
+    assert frames == []
+
+
+@pytest.mark.anyio
+async def test_binary_frames_rejects_truncated_body():
+    body = _frame(b'ok') + _frame(b'truncated')[:-1]
+    frames = []
+    with pytest.raises(TruncatedFrameError):
+        async for frame in binary_frames(_request(_split(body, 4))):
+            frames.append(frame)
+    assert frames == [b'ok']
+
+
+def test_result_frame():
+    frame = result_frame(406, b'error')
+    status_code, length = struct.unpack_from('<HI', frame)
+    assert (status_code, length) == (406, 5)
+    assert frame[struct.calcsize('<HI'):] == b'error'
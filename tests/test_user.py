@@ -0,0 +1,146 @@
+import base64
+from contextlib import asynccontextmanager
+import io
+import os
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable
+
+from crypt4gh import header, sodium
+from crypt4gh_recryptor_service.compute import app as compute_app
+from crypt4gh_recryptor_service.config import get_compute_settings, get_user_settings
+from crypt4gh_recryptor_service.crypt import (generate_keypair,
+                                              write_keypair,
+                                              X25519_CHACHA20_POLY1305)
+from crypt4gh_recryptor_service.exchange import ComputeNodeRouter
+from crypt4gh_recryptor_service.keyholder import load_private_key
+from crypt4gh_recryptor_service.streaming import BINARY_MEDIA_TYPE
+from crypt4gh_recryptor_service.user import app as user_app
+from fastapi import FastAPI
+import httpx
+import pytest
+
+from .conftest import RunningApp
+
+
+def _make_header(session_key: bytes, user_private_key: bytes, user_public_key: bytes) -> bytes:
+    packet = header.make_packet_data_enc(X25519_CHACHA20_POLY1305, session_key)
+    keys = [(X25519_CHACHA20_POLY1305, user_private_key, user_public_key)]
+    return header.serialize(header.encrypt(packet, keys))
+
+
+def _compute_private_key(key_id: str) -> bytes:
+    settings = get_compute_settings()
+    [private_key_path] = Path(settings.compute_keys_dir).rglob(f'{key_id}.priv')
+    return load_private_key(private_key_path, settings.private_key_passphrase)
+
+
+def _configure_user(yml_line: str):
+    with open(get_user_settings().yml_config_file_path, 'a') as yml_config_file:
+        yml_config_file.write(f'{yml_line}\n')
+    get_user_settings.cache_clear()
+
+
+def _write_user_keypair():
+    user_settings = get_user_settings()
+    write_keypair(
+        generate_keypair(user_settings.private_key_passphrase, user_settings.private_key_comment),
+        user_settings.user_private_key_path,
+        user_settings.user_public_key_path)
+
+
+def _new_header() -> tuple[bytes, bytes]:
+    user_settings = get_user_settings()
+    user_private_key = load_private_key(user_settings.user_private_key_path,
+                                        user_settings.private_key_passphrase)
+    session_key = os.urandom(32)
+    return session_key, _make_header(session_key,
+                                     user_private_key,
+                                     sodium.derive_pk(user_private_key))
+
+
+def _assert_recrypted(out_header: bytes, key_id: str, session_key: bytes):
+    # Only the compute keypair can decrypt the recrypted header, which holds the same session key
+    session_keys, _ = header.deconstruct(
+        io.BytesIO(out_header), [(X25519_CHACHA20_POLY1305, _compute_private_key(key_id), None)])
+    assert session_keys == [session_key]
+
+
+@asynccontextmanager
+async def _user_client(
+    running_app: Callable[[FastAPI], RunningApp]
+) -> AsyncIterator[tuple[httpx.AsyncClient, dict[str, Any]]]:
+    async with running_app(compute_app) as (compute_asgi, _), \
+            running_app(user_app) as (user_asgi, user_state):
+        # The in-process compute app acts as the compute node of the user app
+        async with ComputeNodeRouter(
+                get_user_settings(),
+                transport=httpx.ASGITransport(app=compute_asgi)) as compute_router:
+            user_state['compute_router'] = compute_router
+            async with httpx.AsyncClient(
+                    transport=httpx.ASGITransport(app=user_asgi), base_url='http://user') as client:
+                yield client, user_state
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('in_crypto_executor', [True, False])
+async def test_recrypt_header(working_dirs: Path,
+                              running_app: Callable[[FastAPI], RunningApp],
+                              in_crypto_executor: bool):
+    _configure_user(f'recrypt_in_crypto_executor: {str(in_crypto_executor).lower()}')
+    assert get_user_settings().recrypt_in_crypto_executor == in_crypto_executor
+    _write_user_keypair()
+    session_key, in_header = _new_header()
+
+    async with _user_client(running_app) as (client, user_state):
+        # With a crypto executor, only its workers unlock the user private key
+        assert user_state['user_private_key'].is_unlocked != in_crypto_executor
+        response = await client.post(
+            '/recrypt_header', json={'crypt4gh_header': base64.b64encode(in_header).decode()})
+
+    assert response.status_code == 200
+    result = response.json()
+    out_header = base64.b64decode(result['crypt4gh_header'])
+    assert out_header != in_header
+    _assert_recrypted(out_header, result['crypt4gh_compute_keypair_id'], session_key)
+
+
+@pytest.mark.anyio
+async def test_recrypt_header_binary(working_dirs: Path,
+                                     running_app: Callable[[FastAPI], RunningApp]):
+    _write_user_keypair()
+    session_key, in_header = _new_header()
+
+    async with _user_client(running_app) as (client, _):
+        response = await client.post(
+            '/recrypt_header_binary',
+            content=in_header,
+            headers={'Content-Type': BINARY_MEDIA_TYPE})
+        # JSON bodies belong to `/recrypt_header`
+        wrong_type_response = await client.post(
+            '/recrypt_header_binary',
+            json={'crypt4gh_header': base64.b64encode(in_header).decode()})
+
+    assert response.status_code == 200
+    assert response.headers['Content-Type'] == BINARY_MEDIA_TYPE
+    _assert_recrypted(response.content,
+                      response.headers['X-Crypt4gh-Compute-Keypair-Id'],
+                      session_key)
+    assert wrong_type_response.status_code == 415
+
+
+@pytest.mark.anyio
+async def test_recrypt_headers_rejects_batches_over_max_items(working_dirs: Path,
+                                                              running_app: Callable[[FastAPI],
+                                                                                    RunningApp]):
+    _configure_user('recrypt_batch_max_items: 2')
+    _write_user_keypair()
+    in_headers = [base64.b64encode(_new_header()[1]).decode() for _ in range(3)]
+
+    async with _user_client(running_app) as (client, _):
+        too_large_response = await client.post(
+            '/recrypt_headers', json={'crypt4gh_headers': in_headers})
+        response = await client.post('/recrypt_headers', json={'crypt4gh_headers': in_headers[:2]})
+
+    assert too_large_response.status_code == 422
+    assert response.status_code == 200
+    assert [result['status_code'] for result in response.json()['results']] == [200, 200]